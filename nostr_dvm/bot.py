@@ -3,26 +3,32 @@ import json
 import os
 import signal
 
-from nostr_sdk import (Keys, Timestamp, Filter, nip04_decrypt, nip44_decrypt, HandleNotification, EventBuilder, PublicKey,
-                       Options, Tag, Event, EventId, Nip19Event, Kind, NostrSigner, nip44_encrypt, Nip44Version,
+from nostr_sdk import (Keys, Timestamp, Filter, nip04_decrypt, HandleNotification, EventBuilder, PublicKey,
+                       Options, Tag, Event, EventId, Nip19Event, Kind, NostrSigner,
                        UnsignedEvent, UnwrappedGift, KindStandard, ClientBuilder, make_private_msg)
 
 from nostr_dvm.utils.admin_utils import admin_make_database_updates
 from nostr_dvm.utils.cashu_utils import redeem_cashu
-from nostr_dvm.utils.database_utils import get_or_add_user, update_user_balance, create_sql_table, update_sql_table
+from nostr_dvm.utils.crypto_utils import get_crypto_context
+from nostr_dvm.utils.database_utils import get_or_add_user, update_user_balance, create_sql_table, debit_user_balance
 from nostr_dvm.utils.definitions import EventDefinitions, InvoiceToWatch
+from nostr_dvm.utils.job_request_utils import JobRequest
+from nostr_dvm.utils.job_utils import JobRegistry
 from nostr_dvm.utils.nip89_utils import nip89_fetch_events_pubkey, NIP89Config
-from nostr_dvm.utils.nostr_utils import send_event, send_nip04_dm
+from nostr_dvm.utils.nostr_utils import send_event, nip04_dm_event, get_fallback_relays
 from nostr_dvm.utils.output_utils import PostProcessFunctionType, post_process_list_to_users, \
     post_process_list_to_events
+from nostr_dvm.utils.payment_utils import PaymentWatcher
 from nostr_dvm.utils.print_utils import bcolors
-from nostr_dvm.utils.zap_utils import parse_zap_event_tags, pay_bolt11_ln_bits, zaprequest, create_bolt11_ln_bits, \
-    check_bolt11_ln_bits_is_paid
+from nostr_dvm.utils.publish_utils import EventPublisher, PRIORITY_RESULT, PRIORITY_FEEDBACK
+from nostr_dvm.utils.relay_pool_utils import get_outbox_relay_pool
+from nostr_dvm.utils.zap_utils import parse_zap_event_tags, pay_bolt11_ln_bits, zaprequest, create_bolt11_ln_bits
 
 
 class Bot:
-    job_list: list
-    invoice_list: list
+    job_list: JobRegistry
+    invoice_list: JobRegistry
+    publisher: EventPublisher
 
     # This is a simple list just to keep track which events we created and manage, so we don't pay for other requests
 
@@ -30,6 +36,7 @@ class Bot:
         self.signer = None
         self.dvm_config = None
         self.keys = None
+        self.crypto = None
         self.admin_config = None
 
         self.client = None
@@ -46,17 +53,18 @@ class Bot:
         nip89config.PK = self.dvm_config.PRIVATE_KEY
         self.dvm_config.NIP89 = nip89config
         self.admin_config = admin_config
-        self.keys = Keys.parse(dvm_config.PRIVATE_KEY)
+        self.crypto = get_crypto_context(dvm_config)
+        self.keys = self.crypto.keys
         self.signer = NostrSigner.keys(self.keys)
         self.CHATBOT = False
 
         opts = Options().gossip(True)
         self.client = ClientBuilder().signer(NostrSigner.keys(self.keys)).opts(opts).build()
-        self.invoice_list = []
+        self.invoice_list = JobRegistry()
 
         pk = self.keys.public_key()
 
-        self.job_list = []
+        self.job_list = JobRegistry()
 
         print(bcolors.BLUE + "Nostr BOT public key: " + str(pk.to_bech32()) + " Hex: " + str(
             pk.to_hex()) + " Name: " + self.NAME + bcolors.ENDC)  # +
@@ -90,6 +98,34 @@ class Bot:
         create_sql_table(self.dvm_config.DB)
         await admin_make_database_updates(adminconfig=self.admin_config, dvmconfig=self.dvm_config, client=self.client)
 
+        async def send_with_client(relays, event):
+            # the client routes direct messages to the inbox relays of the receiver (gossip), our relays are only
+            # used for the rate limits
+            return await self.client.send_event(event)
+
+        async def client_relays(event):
+            return self.dvm_config.RELAY_LIST
+
+        outbox_pool = get_outbox_relay_pool(self.dvm_config)
+
+        async def resolve_fallback_relays(event, relays):
+            return await get_fallback_relays(event, relays, self.client, self.dvm_config)
+
+        # messages are sent in the background and rate limited per relay instead of sleeping before each message.
+        # Retries and the fallback go to exactly the relays they are given, which aren't all connected to our client
+        self.publisher = EventPublisher(self.dvm_config, send_with_client, client_relays,
+                                        retry_function=outbox_pool.send_event_to,
+                                        fallback_function=resolve_fallback_relays)
+        self.publisher.start()
+
+        async def send_dm(receiver, message, giftwrap, priority=PRIORITY_FEEDBACK):
+            if giftwrap:
+                event = await make_private_msg(self.signer, PublicKey.parse(receiver), message)
+            else:
+                event = nip04_dm_event(message, PublicKey.parse(receiver), self.keys)
+            # messages to the same user go one after another, so they arrive in the order we sent them
+            return self.publisher.publish(event, priority, lane=PublicKey.parse(receiver).to_hex())
+
         class NotificationHandler(HandleNotification):
             client = self.client
             dvm_config = self.dvm_config
@@ -192,11 +228,8 @@ class Bot:
                                         params_as_str = json.dumps(tags_str)
                                         print(params_as_str)
                                         #  and encrypt them
-                                        encrypted_params = nip44_encrypt(self.keys.secret_key(),
-                                                                         PublicKey.parse(
-                                                                             self.dvm_config.SUPPORTED_DVMS[
-                                                                                 index].PUBLIC_KEY),
-                                                                         params_as_str, Nip44Version.V2)
+                                        encrypted_params = self.crypto.encrypt(
+                                            self.dvm_config.SUPPORTED_DVMS[index].PUBLIC_KEY, params_as_str)
                                         #  add encrypted and p tag on the outside
                                         encrypted_tag = Tag.parse(['encrypted'])
                                         #  add the encrypted params to the content
@@ -216,7 +249,7 @@ class Bot:
                                              "dvm_key": self.dvm_config.SUPPORTED_DVMS[index].PUBLIC_KEY,
                                              "is_paid": False,
                                              "giftwrap": giftwrap}
-                                    self.job_list.append(entry)
+                                    self.job_list.add(entry["event_id"], entry, author=user.npub)
 
                                     # send the event to the DVM
                                     await send_event(nip90request, client=self.client, dvm_config=self.dvm_config)
@@ -238,26 +271,21 @@ class Bot:
                             expires = nostr_event.created_at().as_secs() + (60 * 60 * 24)
                             qr_code = "https://qrcode.tec-it.com/API/QRCode?data=" + invoice + "&backcolor=%23ffffff&size=small&quietzone=1&errorcorrection=H"
 
-                            self.invoice_list.append(
-                                InvoiceToWatch(sender=sender, bolt11=invoice, payment_hash=hash, is_paid=False,
-                                               expires=expires, amount=amount))
+                            self.invoice_list.add(hash,
+                                                  InvoiceToWatch(sender=sender, bolt11=invoice, payment_hash=hash,
+                                                                 is_paid=False, expires=expires, amount=amount),
+                                                  author=sender, payment_hash=hash, expires=expires)
+                            self.payment_watcher.watch(hash)
 
                             if requests_rq:
                                 message = invoice + "\n" + qr_code
                             else:
                                 message = invoice
-                            if giftwrap:
-                                event = await make_private_msg(self.signer, PublicKey.parse(sender), message,
-                                                               None)
-                                await self.client.send_event(event)
-
-                            else:
-                                await send_nip04_dm(self.client, message, PublicKey.parse(sender), self.dvm_config)
+                            await send_dm(sender, message, giftwrap)
 
 
 
                         elif decrypted_text.lower().startswith("balance"):
-                            await asyncio.sleep(2.0)
                             message = "Your current balance is " + str(user.balance) + (" Sats. Zap me to add to your "
                                                                                         "balance. I will use your "
                                                                                         "balance interact with the DVMs "
@@ -268,11 +296,7 @@ class Bot:
                                                                                         "100\" to receive an invoice of "
                                                                                         "100 sats (or any other amount) "
                                                                                         "to top up your balance")
-                            if giftwrap:
-                                event = await make_private_msg(self.signer, PublicKey.parse(sender), message)
-                                await self.client.send_event(event)
-                            else:
-                                await send_nip04_dm(self.client, message, PublicKey.parse(sender), self.dvm_config)
+                            await send_dm(sender, message, giftwrap)
                         elif decrypted_text.startswith("cashuA"):
                             print("Received Cashu token:" + decrypted_text)
                             cashu_redeemed, cashu_message, total_amount, fees = await redeem_cashu(decrypted_text,
@@ -281,24 +305,14 @@ class Bot:
                             print(cashu_message)
                             if cashu_message == "success":
                                 await update_user_balance(self.dvm_config.DB, sender, total_amount, client=self.client,
-                                                          config=self.dvm_config)
+                                                          config=self.dvm_config, publisher=self.publisher)
                             else:
-                                await asyncio.sleep(2.0)
                                 message = "Error: " + cashu_message + ". Token has not been redeemed."
 
-                                if giftwrap:
-                                    event = await make_private_msg(self.signer, PublicKey.parse(sender), message)
-                                    await self.client.send_event(event)
-                                else:
-                                    await send_nip04_dm(self.client, message, PublicKey.parse(sender), self.dvm_config)
+                                await send_dm(sender, message, giftwrap)
                         elif decrypted_text.lower().startswith("what's the second best"):
-                            await asyncio.sleep(2.0)
                             message = "No, there is no second best.\n\nhttps://cdn.nostr.build/p/mYLv.mp4"
-                            if giftwrap:
-                                event = await make_private_msg(self.signer, PublicKey.parse(sender), message)
-                                await self.client.send_event(event)
-                            else:
-                                await send_nip04_dm(self.client, message, PublicKey.parse(sender), self.dvm_config)
+                            await send_dm(sender, message, giftwrap)
                         else:
 
                             # Build an overview of known DVMs and send it to the user
@@ -330,7 +344,7 @@ class Bot:
                         entry = {"npub": user.npub, "event_id": nip90request.id().to_hex(),
                                  "dvm_key": self.DVM_KEY, "is_paid": False,
                                  "giftwrap": giftwrap}
-                        self.job_list.append(entry)
+                        self.job_list.add(entry["event_id"], entry, author=user.npub)
 
                         # send the event to the DVM
                         await send_event(nip90request, client=self.client, dvm_config=self.dvm_config)
@@ -360,20 +374,14 @@ class Bot:
 
                 if is_encrypted:
                     if ptag == self.keys.public_key().to_hex():
-                        try:
-                            tags_str = nip44_decrypt(Keys.parse(dvm_config.PRIVATE_KEY).secret_key(),
-                                                     nostr_event.author(), nostr_event.content())
-                        except:
-                            tags_str = nip04_decrypt(Keys.parse(dvm_config.PRIVATE_KEY).secret_key(),
-                                                     nostr_event.author(), nostr_event.content())
+                        tags_str, use_legacy_encryption = self.crypto.decrypt(nostr_event.author(),
+                                                                              nostr_event.content())
 
                         params = json.loads(tags_str)
-                        params.append(Tag.parse(["p", ptag]).as_vec())
-                        params.append(Tag.parse(["encrypted"]).as_vec())
-                        event_as_json = json.loads(nostr_event.as_json())
-                        event_as_json['tags'] = params
-                        event_as_json['content'] = ""
-                        nostr_event = Event.from_json(json.dumps(event_as_json))
+                        params.append(["p", ptag])
+                        params.append(["encrypted"])
+                        nostr_event = JobRequest.decrypted_from(nostr_event, params,
+                                                                use_legacy_encryption).parsed_event
 
                         for tag in nostr_event.tags().to_vec():
                             if tag.as_vec()[0] == "status":
@@ -389,16 +397,11 @@ class Bot:
                         return
 
                 if status == "success" or status == "error" or status == "processing" or status == "partial" and content != "":
-                    entry = next((x for x in self.job_list if x['event_id'] == etag), None)
+                    entry = self.job_list.get(etag)
                     if entry is not None and entry['dvm_key'] == nostr_event.author().to_hex():
                         user = await get_or_add_user(db=self.dvm_config.DB, npub=entry['npub'],
                                                      client=self.client, config=self.dvm_config)
-                        await asyncio.sleep(2.0)
-                        if entry["giftwrap"]:
-                            event = await make_private_msg(self.signer, PublicKey.parse(entry["npub"]), content)
-                            await self.client.send_event(event)
-                        else:
-                            await send_nip04_dm(self.client, content, PublicKey.parse(entry['npub']), self.dvm_config)
+                        await send_dm(entry["npub"], content, entry["giftwrap"])
                         print(status + ": " + content)
                         print(
                             "[" + self.NAME + "] Received reaction from " + nostr_event.author().to_hex() + " message to orignal sender " + user.name)
@@ -408,44 +411,33 @@ class Bot:
                         if tag.as_vec()[0] == "amount":
                             amount_msats = int(tag.as_vec()[1])
                             amount = int(amount_msats / 1000)
-                            entry = next((x for x in self.job_list if x['event_id'] == etag), None)
+                            entry = self.job_list.get(etag)
                             if entry is not None and entry['is_paid'] is False and entry[
                                 'dvm_key'] == nostr_event.author().to_hex():
                                 # if we get a bolt11, we pay and move on
                                 user = await get_or_add_user(db=self.dvm_config.DB, npub=entry["npub"],
                                                              client=self.client, config=self.dvm_config)
+                                # atomic, so concurrent requests can't spend the same balance twice
+                                balance = None
                                 if user.balance >= amount:
-                                    balance = max(user.balance - amount, 0)
-                                    update_sql_table(db=self.dvm_config.DB, npub=user.npub, balance=balance,
-                                                     iswhitelisted=user.iswhitelisted, isblacklisted=user.isblacklisted,
-                                                     nip05=user.nip05, lud16=user.lud16, name=user.name,
-                                                     lastactive=Timestamp.now().as_secs(), subscribed=user.subscribed)
+                                    balance = debit_user_balance(self.dvm_config.DB, user.npub, amount)
+                                if balance is not None:
 
                                     message = "Paid " + str(
                                         amount) + " Sats from balance to DVM. New balance is " + str(
                                         balance) + " Sats.\n"
-                                    if entry["giftwrap"]:
-                                        event = await make_private_msg(self.signer, PublicKey.parse(entry["npub"]), message)
-                                        await self.client.send_event(event)
-                                    else:
-                                        await send_nip04_dm(self.client, content, PublicKey.parse(entry['npub']),
-                                                            self.dvm_config)
+                                    await send_dm(entry["npub"], message if entry["giftwrap"] else content,
+                                                  entry["giftwrap"])
                                     print(
                                         "[" + self.NAME + "] Replying " + user.name + " with \"scheduled\" confirmation")
 
                                 else:
                                     print("Bot payment-required")
-                                    await asyncio.sleep(2.0)
                                     message = "Current balance: " + str(user.balance) + " Sats. Balance of " + str(
                                         amount) + " Sats required. Please zap me with at least " + str(
                                         int(amount - user.balance)) + " Sats, then try again."
 
-                                    if entry["giftwrap"]:
-                                        event = await make_private_msg(self.signer, PublicKey.parse(entry["npub"]), message)
-                                        await self.client.send_event(event)
-                                    else:
-                                        await send_nip04_dm(self.client, message, PublicKey.parse(entry['npub']),
-                                                            self.dvm_config)
+                                    await send_dm(entry["npub"], message, entry["giftwrap"])
                                     return
 
                                 if len(tag.as_vec()) > 2:
@@ -467,7 +459,7 @@ class Bot:
                                 try:
                                     print(bolt11)
                                     payment_hash = pay_bolt11_ln_bits(bolt11, self.dvm_config)
-                                    self.job_list[self.job_list.index(entry)]['is_paid'] = True
+                                    entry['is_paid'] = True
                                     print("[" + self.NAME + "] payment_hash: " + payment_hash +
                                           " Forwarding payment of " + str(amount) + " Sats to DVM")
                                 except Exception as e:
@@ -491,21 +483,18 @@ class Bot:
                     elif tag.as_vec()[0] == "encrypted":
                         is_encrypted = True
 
-                entry = next((x for x in self.job_list if x['event_id'] == etag), None)
+                entry = self.job_list.get(etag)
                 if entry is not None and entry[
                     'dvm_key'] == nostr_event.author().to_hex():
                     print(entry)
                     user = await get_or_add_user(db=self.dvm_config.DB, npub=entry['npub'],
                                                  client=self.client, config=self.dvm_config)
 
-                    self.job_list.remove(entry)
+                    self.job_list.remove(etag)
                     content = nostr_event.content()
                     if is_encrypted:
                         if ptag == self.keys.public_key().to_hex():
-                            try:
-                                content = nip44_decrypt(self.keys.secret_key(), nostr_event.author(), content)
-                            except:
-                                content = nip04_decrypt(self.keys.secret_key(), nostr_event.author(), content)
+                            content, _ = self.crypto.decrypt(nostr_event.author(), content)
                         else:
                             return
 
@@ -520,13 +509,7 @@ class Bot:
                                 content = post_process_list_to_users(content)
 
                     print("[" + self.NAME + "] Received results, message to orignal sender " + user.name)
-                    await asyncio.sleep(2.0)
-                    if entry["giftwrap"]:
-                        event = await make_private_msg(self.signer, PublicKey.parse(user.npub), content)
-
-                        await self.client.send_event(event)
-                    else:
-                        await send_nip04_dm(self.client, content, PublicKey.parse(user.npub), self.dvm_config)
+                    await send_dm(user.npub, content, entry["giftwrap"], PRIORITY_RESULT)
 
             except Exception as e:
                 print(e)
@@ -547,7 +530,7 @@ class Bot:
 
                 user = await get_or_add_user(self.dvm_config.DB, sender, client=self.client, config=self.dvm_config)
 
-                entry = next((x for x in self.job_list if x['event_id'] == etag), None)
+                entry = self.job_list.get(etag)
                 if entry is not None and entry['is_paid'] is True and entry['dvm_key'] == sender:
                     # if we get a bolt11, we pay and move on
                     user = await get_or_add_user(db=self.dvm_config.DB, npub=entry["npub"],
@@ -561,7 +544,8 @@ class Bot:
                             invoice_amount) + " Sats from " + str(
                             user.name))
                         await update_user_balance(self.dvm_config.DB, sender, invoice_amount, client=self.client,
-                                                  config=self.dvm_config, giftwrap=True)
+                                                  config=self.dvm_config, giftwrap=True,
+                                                  publisher=self.publisher)
 
                         # a regular note
                 elif not anon:
@@ -569,7 +553,7 @@ class Bot:
                         invoice_amount) + " Sats from " + str(
                         user.name))
                     await update_user_balance(self.dvm_config.DB, sender, invoice_amount, client=self.client,
-                                              config=self.dvm_config)
+                                              config=self.dvm_config, publisher=self.publisher)
 
             except Exception as e:
                 print("[" + self.NAME + "] Error during content decryption:" + str(e))
@@ -586,34 +570,20 @@ class Bot:
                                 " Sats\n\n")
                 index += 1
 
-            await asyncio.sleep(2.0)
 
             text = message + "\nSelect an Index and provide an input (e.g. \"2 A purple ostrich\")\nType \"index info\" to learn more about each DVM. (e.g. \"2 info\")\n\n Type \"balance\" to see your current balance"
-            if giftwrap:
-                event = await make_private_msg(self.signer, PublicKey.parse(sender), text)
-                await self.client.send_event(event)
-            else:
-                await send_nip04_dm(self.client, text, PublicKey.parse(sender), self.dvm_config)
+            await send_dm(sender, text, giftwrap)
 
         async def answer_blacklisted(nostr_event, giftwrap, sender):
             message = "Your are currently blocked from this service."
-            if giftwrap:
-                event = await make_private_msg(self.signer, PublicKey.parse(sender), message)
-                await self.client.send_event(event)
-            else:
-                await send_nip04_dm(self.client, message, PublicKey.parse(sender), self.dvm_config)
+            await send_dm(sender, message, giftwrap)
 
         async def answer_nip89(nostr_event, index, giftwrap, sender):
             info = await print_dvm_info(self.client, index)
             if info is None:
                 info = "No NIP89 Info found for " + self.dvm_config.SUPPORTED_DVMS[index].NAME
-            await asyncio.sleep(2.0)
 
-            if giftwrap:
-                event = await make_private_msg(self.signer, PublicKey.parse(sender), info)
-                await self.client.send_event(event)
-            else:
-                await send_nip04_dm(self.client, info, PublicKey.parse(sender), self.dvm_config)
+            await send_dm(sender, info, giftwrap)
 
         def build_params(decrypted_text, author, index):
             tags = []
@@ -772,28 +742,32 @@ class Bot:
 
 
 
-        asyncio.create_task(self.client.handle_notifications(NotificationHandler()))
+        async def on_invoice_paid(payment_hash):
+            invoice = self.invoice_list.get(payment_hash)
+            if invoice is None or invoice.is_paid:
+                return
+            print("is paid")
+            invoice.is_paid = True
 
-        try:
-            while True:
-                for invoice in self.invoice_list:
-                    if invoice.bolt11 != "" and invoice.payment_hash != "" and not invoice.payment_hash is None and not invoice.is_paid:
-                        ispaid = check_bolt11_ln_bits_is_paid(invoice.payment_hash, self.dvm_config)
-                        if ispaid and invoice.is_paid is False:
-                            print("is paid")
-                            invoice.is_paid = True
+            await update_user_balance(self.dvm_config.DB, invoice.sender, invoice.amount,
+                                      client=self.client,
+                                      config=self.dvm_config, publisher=self.publisher)
 
-                            await update_user_balance(self.dvm_config.DB, invoice.sender, invoice.amount,
-                                                      client=self.client,
-                                                      config=self.dvm_config)
+            print("[" + self.dvm_config.NIP89.NAME + "] updating balance from invoice list")
 
-                            print("[" + self.dvm_config.NIP89.NAME + "] updating balance from invoice list")
+        async def on_invoice_expired(payment_hash):
+            self.invoice_list.remove(payment_hash)
 
-                        elif ispaid is None:  # invoice expired
-                            self.invoice_list.remove(invoice)
+        self.payment_watcher = PaymentWatcher(self.dvm_config, on_invoice_paid, on_invoice_expired)
+        await self.payment_watcher.start()
 
-                    elif Timestamp.now().as_secs() > invoice.expires:
-                        self.invoice_list.remove(invoice)
+        asyncio.create_task(self.client.handle_notifications(NotificationHandler()))
+
+        try:
+            while True:
+                # invoices are checked by the payment watcher, we only clean up invoices that expired
+                for invoice in self.invoice_list.pop_expired(Timestamp.now().as_secs()):
+                    self.payment_watcher.unwatch(invoice.payment_hash)
 
                 await asyncio.sleep(1.0)
         except KeyboardInterrupt:
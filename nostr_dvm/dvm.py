@@ -2,27 +2,38 @@ import asyncio
 import json
 import os
 import sys
+import time
 from sys import platform
 
 from nostr_sdk import PublicKey, Keys, Client, Tag, Event, EventBuilder, Filter, HandleNotification, Timestamp, \
-    LogLevel, Options, nip04_encrypt, nip44_encrypt, Nip44Version, Kind, RelayLimits, uniffi_set_event_loop, ClientBuilder, NostrSigner
+    LogLevel, Options, Kind, RelayLimits, uniffi_set_event_loop, ClientBuilder, NostrSigner
 
 
 from nostr_dvm.utils.admin_utils import admin_make_database_updates, AdminConfig
 from nostr_dvm.utils.backend_utils import get_amount_per_task, check_task_is_supported, get_task
 from nostr_dvm.utils.cashu_utils import redeem_cashu
-from nostr_dvm.utils.database_utils import create_sql_table, get_or_add_user, update_sql_table, \
-    update_user_subscription
+from nostr_dvm.utils.database_utils import create_sql_table, get_or_add_user, update_user_subscription, \
+    debit_user_balance
+from nostr_dvm.utils.crypto_utils import get_crypto_context
 from nostr_dvm.utils.definitions import EventDefinitions, RequiredJobToWatch, JobToWatch
 from nostr_dvm.utils.dvmconfig import DVMConfig
+from nostr_dvm.utils.event_index_utils import get_event_index, DECRYPT_JOB_TAGS
+from nostr_dvm.utils.job_request_utils import JobRequest
+from nostr_dvm.utils.job_utils import JobRegistry
 from nostr_dvm.utils.mediasource_utils import input_data_file_duration
+from nostr_dvm.utils.metrics_utils import get_metrics, dump_metrics
 from nostr_dvm.utils.nip88_utils import nip88_has_active_subscription
 from nostr_dvm.utils.nostr_utils import get_event_by_id, get_referenced_event_by_id, check_and_decrypt_tags, \
-    send_event_outbox, print_send_result
+    get_outbox_relays, get_fallback_relays, print_send_result
 from nostr_dvm.utils.nut_wallet_utils import NutZapWallet
 from nostr_dvm.utils.output_utils import build_status_reaction
+from nostr_dvm.utils.payment_utils import PaymentWatcher
 from nostr_dvm.utils.print_utils import bcolors
-from nostr_dvm.utils.zap_utils import check_bolt11_ln_bits_is_paid, create_bolt11_ln_bits, parse_zap_event_tags, \
+from nostr_dvm.utils.publish_utils import EventPublisher, PRIORITY_RESULT, PRIORITY_FEEDBACK
+from nostr_dvm.utils.relay_list_utils import get_relay_list_cache
+from nostr_dvm.utils.relay_pool_utils import get_dvm_relay_pool, get_outbox_relay_pool
+from nostr_dvm.utils.scheduler_utils import JobScheduler
+from nostr_dvm.utils.zap_utils import create_bolt11_ln_bits, parse_zap_event_tags, \
     parse_amount_from_bolt11_invoice, zaprequest, pay_bolt11_ln_bits, create_bolt11_lud16
 
 #os.environ["RUST_BACKTRACE"] = "full"
@@ -34,8 +45,15 @@ class DVM:
     admin_config: AdminConfig
     keys: Keys
     client: Client
-    job_list: list
-    jobs_on_hold_list: list
+    job_list: JobRegistry
+    jobs_on_hold_list: JobRegistry
+    job_scheduler: JobScheduler
+    payment_watcher: PaymentWatcher
+    publisher: EventPublisher
+    background_tasks: set
+    metrics = None
+    event_index = None
+    crypto = None
     stop_thread = False
 
     def __init__(self, dvm_config, admin_config=None, stop_thread=False):
@@ -51,23 +69,37 @@ class DVM:
     async def run_dvm(self, dvm_config, admin_config, stop_thread):
         self.dvm_config = dvm_config
         self.admin_config = admin_config
-        self.keys = Keys.parse(dvm_config.PRIVATE_KEY)
+        self.crypto = get_crypto_context(dvm_config)
+        self.keys = self.crypto.keys
         relaylimits = RelayLimits.disable()
         opts = Options().relay_limits(relaylimits) #.difficulty(28)
 
         #self.client = Client(self.keys)
-        self.client = ClientBuilder().signer(NostrSigner.keys(self.keys)).opts(opts).build()
-        self.job_list = []
-        self.jobs_on_hold_list = []
+        if self.dvm_config.SHARE_RELAY_CONNECTIONS:
+            relay_pool = get_dvm_relay_pool(self.dvm_config)
+            self.client = relay_pool.client
+        else:
+            relay_pool = None
+            self.client = ClientBuilder().signer(NostrSigner.keys(self.keys)).opts(opts).build()
+        self.job_list = JobRegistry()
+        self.jobs_on_hold_list = JobRegistry()
+        self.background_tasks = set()
+        self.metrics = get_metrics(self.dvm_config)
+        self.event_index = get_event_index(self.dvm_config)
+        event_index = self.event_index
+        metrics = self.metrics
         pk = self.keys.public_key()
         print(bcolors.BLUE + "[" + self.dvm_config.NIP89.NAME + "] " + "Nostr DVM public key: " + str(
             pk.to_bech32()) + " Hex: " +
               str(pk.to_hex()) + " Supported DVM tasks: " +
               ', '.join(p.NAME + ":" + p.TASK for p in self.dvm_config.SUPPORTED_DVMS) + bcolors.ENDC)
 
-        for relay in self.dvm_config.RELAY_LIST:
-            await self.client.add_relay(relay)
-        await self.client.connect()
+        if relay_pool is not None:
+            await relay_pool.add_relays(self.dvm_config.RELAY_LIST)
+        else:
+            for relay in self.dvm_config.RELAY_LIST:
+                await self.client.add_relay(relay)
+            await self.client.connect()
 
         zap_filter = Filter().pubkey(pk).kinds([EventDefinitions.KIND_ZAP, EventDefinitions.KIND_NIP61_NUT_ZAP]).since(
             Timestamp.now())
@@ -78,8 +110,17 @@ class DVM:
         dvm_filter = (Filter().kinds(kinds).since(Timestamp.now()))
         create_sql_table(self.dvm_config.DB)
         await admin_make_database_updates(adminconfig=self.admin_config, dvmconfig=self.dvm_config, client=self.client)
-        await self.client.subscribe(dvm_filter, None)
-        await self.client.subscribe(zap_filter, None)
+        # the client might be shared with other DVMs, so we only handle events of our own subscriptions
+        subscription_ids = set()
+        subscription = await self.client.subscribe(dvm_filter, None)
+        subscription_ids.add(subscription.id)
+        subscription = await self.client.subscribe(zap_filter, None)
+        subscription_ids.add(subscription.id)
+        # relay lists published on our relays keep the inbox relays we reply to current
+        relay_list_cache = get_relay_list_cache(self.dvm_config)
+        relay_list_filter = Filter().kind(EventDefinitions.KIND_RELAY_ANNOUNCEMENT).since(Timestamp.now())
+        subscription = await self.client.subscribe(relay_list_filter, None)
+        subscription_ids.add(subscription.id)
 
         if self.dvm_config.ENABLE_NUTZAP:
             nutzap_wallet = NutZapWallet()
@@ -102,6 +143,8 @@ class DVM:
             keys = self.keys
 
             async def handle(self, relay_url, subscription_id, nostr_event: Event):
+                if subscription_id not in subscription_ids:
+                    return
                 if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
                     print(nostr_event.as_json())
                 if EventDefinitions.KIND_NIP90_EXTRACT_TEXT.as_u16() <= nostr_event.kind().as_u16() <= EventDefinitions.KIND_NIP90_GENERIC.as_u16():
@@ -110,28 +153,40 @@ class DVM:
                     await handle_zap(nostr_event)
                 elif nostr_event.kind().as_u16() == EventDefinitions.KIND_NIP61_NUT_ZAP.as_u16():
                     await handle_nutzap(nostr_event)
+                elif nostr_event.kind().as_u16() == EventDefinitions.KIND_RELAY_ANNOUNCEMENT.as_u16():
+                    relay_list_cache.add_event(nostr_event)
 
             async def handle_msg(self, relay_url, msg):
                 return
 
+        def run_in_background(coroutine):
+            # keep a reference, the loop only keeps weak ones and could collect the task before it's done
+            task = asyncio.create_task(coroutine)
+            self.background_tasks.add(task)
+            task.add_done_callback(on_background_task_done)
+
+        def on_background_task_done(task):
+            self.background_tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                print(bcolors.RED + "[" + self.dvm_config.NIP89.NAME + "] Background task failed: " + str(
+                    task.exception()) + bcolors.ENDC)
+
         async def handle_nip90_job_event(nip90_event):
             # decrypted encrypted events
 
-            nip90_event, use_legacy_encryption = check_and_decrypt_tags(nip90_event, self.dvm_config)
+            received_event = nip90_event
+            with metrics.span("check_and_decrypt_tags"):
+                nip90_event, use_legacy_encryption = check_and_decrypt_tags(nip90_event, self.dvm_config)
             # if event is encrypted, but we can't decrypt it (e.g. because its directed to someone else), return
             if nip90_event is None:
                 return
 
             task_is_free = False
             user_has_active_subscription = False
-            cashu = ""
-            p_tag_str = ""
-
-            for tag in nip90_event.tags().to_vec():
-                if tag.as_vec()[0] == "cashu":
-                    cashu = tag.as_vec()[1]
-                elif tag.as_vec()[0] == "p":
-                    p_tag_str = tag.as_vec()[1]
+            # the tags are parsed once here, the rest of the pipeline gets the same JobRequest from the event
+            request = JobRequest.of(nip90_event)
+            cashu = request.cashu
+            p_tag_str = request.p
 
             if p_tag_str != "" and p_tag_str != self.dvm_config.PUBLIC_KEY:
                 if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
@@ -139,13 +194,21 @@ class DVM:
                 return
 
             # check if task is supported by the current DVM
-            task_supported, task = await check_task_is_supported(nip90_event, client=self.client,
-                                                                 config=self.dvm_config)
+            with metrics.span("get_task"):
+                task_supported, task = await check_task_is_supported(nip90_event, client=self.client,
+                                                                     config=self.dvm_config)
             # if task is supported, continue, else do nothing.
             if task_supported:
+                metrics.inc("dvm_jobs_received_total", task=task)
+                # zaps on our reactions point to this request, keep it (and its decrypted tags) at hand
+                event_index.add(received_event, decrypted=(nip90_event, use_legacy_encryption),
+                                decryptor=DECRYPT_JOB_TAGS)
+                # look up where to reply while we check the request, the status and result wait for the same lookup
+                run_in_background(relay_list_cache.lookup([nip90_event.author()], self.client))
                 # fetch or add user contacting the DVM from/to local database
-                user = await get_or_add_user(self.dvm_config.DB, nip90_event.author().to_hex(), client=self.client,
-                                             config=self.dvm_config, skip_meta=False)
+                with metrics.span("get_or_add_user"):
+                    user = await get_or_add_user(self.dvm_config.DB, nip90_event.author().to_hex(),
+                                                 client=self.client, config=self.dvm_config, skip_meta=False)
                 # if user is blacklisted for some reason, send an error reaction and return
                 if user.isblacklisted:
                     # await send_job_status_reaction(nip90_event, "error", client=self.client, dvm_config=self.dvm_config)
@@ -155,7 +218,9 @@ class DVM:
                     print(
                         bcolors.MAGENTA + "[" + self.dvm_config.NIP89.NAME + "] Received new Request: " + task + " from " + user.name + " (" + PublicKey.parse(
                             user.npub).to_bech32() + ")" + bcolors.ENDC)
-                duration = await input_data_file_duration(nip90_event, dvm_config=self.dvm_config, client=self.client)
+                with metrics.span("input_data_file_duration", task=task):
+                    duration = await input_data_file_duration(nip90_event, dvm_config=self.dvm_config,
+                                                              client=self.client)
                 amount = get_amount_per_task(task, self.dvm_config, duration)
                 if amount is None:
                     return
@@ -250,7 +315,7 @@ class DVM:
                     #  when we reimburse users on error make sure to not send anything if it was free
                     if user.iswhitelisted or task_is_free:
                         amount = 0
-                    await do_work(nip90_event, amount)
+                    await schedule_work(nip90_event, amount, task, paid=cashu_redeemed)
                 # if task is directed to us via p tag and user has balance or is subscribed, do the job and update balance
                 elif (p_tag_str == self.dvm_config.PUBLIC_KEY and (
                         user.balance >= int(
@@ -258,11 +323,14 @@ class DVM:
                               p_tag_str == self.dvm_config.PUBLIC_KEY and user_has_active_subscription)):
 
                     if not user_has_active_subscription:
-                        balance = max(user.balance - int(amount), 0)
-                        update_sql_table(db=self.dvm_config.DB, npub=user.npub, balance=balance,
-                                         iswhitelisted=user.iswhitelisted, isblacklisted=user.isblacklisted,
-                                         nip05=user.nip05, lud16=user.lud16, name=user.name,
-                                         lastactive=Timestamp.now().as_secs(), subscribed=user.subscribed)
+                        # atomic, so concurrent jobs can't spend the same balance twice
+                        balance = debit_user_balance(self.dvm_config.DB, user.npub, int(amount))
+                        if balance is None:
+                            print("[" + self.dvm_config.NIP89.NAME + "] Insufficient balance for task: " + task)
+                            await send_job_status_reaction(nip90_event, "payment-required",
+                                                           False, int(amount), client=self.client,
+                                                           dvm_config=self.dvm_config)
+                            return
 
                         print(
                             "[" + self.dvm_config.NIP89.NAME + "] Using user's balance for task: " + task +
@@ -275,7 +343,7 @@ class DVM:
                                                    content=self.dvm_config.CUSTOM_PROCESSING_MESSAGE,
                                                    client=self.client, dvm_config=self.dvm_config)
 
-                    await do_work(nip90_event, amount)
+                    await schedule_work(nip90_event, amount, task, paid=True)
 
                 # else send a payment required event to user
                 elif p_tag_str == "" or p_tag_str == self.dvm_config.PUBLIC_KEY:
@@ -288,10 +356,7 @@ class DVM:
                         #                               False, 0, client=self.client,
                         #                               dvm_config=self.dvm_config)
                     else:
-                        bid = 0
-                        for tag in nip90_event.tags().to_vec():
-                            if tag.as_vec()[0] == 'bid':
-                                bid = int(tag.as_vec()[1])
+                        bid = int(request.bid) if request.bid is not None else 0
 
                         print(
                             "[" + self.dvm_config.NIP89.NAME + "] Payment required: New Nostr " + task + " Job event: "
@@ -331,8 +396,7 @@ class DVM:
                     zapped_event = None
                     for tag in nut_zap_event.tags().to_vec():
                         if tag.as_vec()[0] == 'e':
-                            zapped_event = await get_event_by_id(tag.as_vec()[1], client=self.client,
-                                                                 config=self.dvm_config)
+                            zapped_event = await event_index.fetch(tag.as_vec()[1], self.client, self.dvm_config)
 
                     if zapped_event is not None:
                         if zapped_event.kind() == EventDefinitions.KIND_FEEDBACK:
@@ -344,10 +408,12 @@ class DVM:
                                 if tag.as_vec()[0] == 'amount':
                                     amount = int(float(tag.as_vec()[1]) / 1000)
                                 elif tag.as_vec()[0] == 'e':
-                                    job_event = await get_event_by_id(tag.as_vec()[1], client=self.client,
-                                                                      config=self.dvm_config)
+                                    job_event = await event_index.fetch(tag.as_vec()[1], self.client,
+                                                                        self.dvm_config)
                                     if job_event is not None:
-                                        job_event, use_legacy_encryption = check_and_decrypt_tags(job_event, self.dvm_config)
+                                        job_event, use_legacy_encryption = event_index.decrypt(
+                                            job_event, lambda event: check_and_decrypt_tags(event, self.dvm_config),
+                                            DECRYPT_JOB_TAGS)
                                         if job_event is None:
                                             return
                                     else:
@@ -368,23 +434,19 @@ class DVM:
                                     await send_job_status_reaction(job_event, "processing", client=self.client,
                                                                    content=self.dvm_config.CUSTOM_PROCESSING_MESSAGE,
                                                                    dvm_config=self.dvm_config)
-                                    indices = [i for i, x in enumerate(self.job_list) if
-                                               x.event == job_event]
-                                    index = -1
-                                    if len(indices) > 0:
-                                        index = indices[0]
-                                    if index > -1:
-                                        if self.job_list[index].is_processed:
-                                            self.job_list[index].is_paid = True
-                                            await check_and_return_event(self.job_list[index].result, job_event)
-                                        elif not (self.job_list[index]).is_processed:
+                                    job = self.job_list.get(job_event.id().to_hex())
+                                    if job is not None:
+                                        if job.is_processed:
+                                            job.is_paid = True
+                                            await check_and_return_event(job.result, job_event)
+                                        elif not job.is_processed:
                                             # If payment-required appears before processing
-                                            self.job_list.pop(index)
+                                            self.job_list.remove(job_event.id().to_hex())
                                             print("Starting work...")
-                                            await do_work(job_event, received_amount)
+                                            await schedule_work(job_event, received_amount, task, paid=True)
                                     else:
                                         print("Job not in List, but starting work...")
-                                        await do_work(job_event, received_amount)
+                                        await schedule_work(job_event, received_amount, task, paid=True)
 
                                 else:
                                     await send_job_status_reaction(job_event, "payment-rejected",
@@ -411,7 +473,8 @@ class DVM:
                                                                                                  self.keys,
                                                                                                  self.dvm_config.NIP89.NAME,
                                                                                                  self.client,
-                                                                                                 self.dvm_config)
+                                                                                                 self.dvm_config,
+                                                                                                 event_index)
                 user = await get_or_add_user(db=self.dvm_config.DB, npub=sender, client=self.client,
                                              config=self.dvm_config)
 
@@ -426,10 +489,11 @@ class DVM:
                             if tag.as_vec()[0] == 'amount':
                                 amount = int(float(tag.as_vec()[1]) / 1000)
                             elif tag.as_vec()[0] == 'e':
-                                job_event = await get_event_by_id(tag.as_vec()[1], client=self.client,
-                                                                  config=self.dvm_config)
+                                job_event = await event_index.fetch(tag.as_vec()[1], self.client, self.dvm_config)
                                 if job_event is not None:
-                                    job_event, use_legacy_encryption = check_and_decrypt_tags(job_event, self.dvm_config)
+                                    job_event, use_legacy_encryption = event_index.decrypt(
+                                        job_event, lambda event: check_and_decrypt_tags(event, self.dvm_config),
+                                        DECRYPT_JOB_TAGS)
                                     if job_event is None:
                                         return
                                 else:
@@ -457,23 +521,19 @@ class DVM:
                                     await send_job_status_reaction(job_event, "processing", client=self.client,
                                                                    content=self.dvm_config.CUSTOM_PROCESSING_MESSAGE,
                                                                    dvm_config=self.dvm_config)
-                                    indices = [i for i, x in enumerate(self.job_list) if
-                                               x.event == job_event]
-                                    index = -1
-                                    if len(indices) > 0:
-                                        index = indices[0]
-                                    if index > -1:
-                                        if self.job_list[index].is_processed:
-                                            self.job_list[index].is_paid = True
-                                            await check_and_return_event(self.job_list[index].result, job_event)
-                                        elif not (self.job_list[index]).is_processed:
+                                    job = self.job_list.get(job_event.id().to_hex())
+                                    if job is not None:
+                                        if job.is_processed:
+                                            job.is_paid = True
+                                            await check_and_return_event(job.result, job_event)
+                                        elif not job.is_processed:
                                             # If payment-required appears before processing
-                                            self.job_list.pop(index)
+                                            self.job_list.remove(job_event.id().to_hex())
                                             print("Starting work...")
-                                            await do_work(job_event, invoice_amount)
+                                            await schedule_work(job_event, invoice_amount, task, paid=True)
                                     else:
                                         print("Job not in List, but starting work...")
-                                        await do_work(job_event, invoice_amount)
+                                        await schedule_work(job_event, invoice_amount, task, paid=True)
 
                                 else:
                                     await send_job_status_reaction(job_event, "payment-rejected",
@@ -507,60 +567,63 @@ class DVM:
             if not task_supported:
                 return False
 
-            for tag in nevent.tags().to_vec():
-                if tag.as_vec()[0] == 'i':
-                    if len(tag.as_vec()) < 3:
-                        print("Job Event missing/malformed i tag, skipping..")
-                        return False
-                    else:
-                        input = tag.as_vec()[1]
-                        input_type = tag.as_vec()[2]
-                        if input_type == "job":
-                            evt = await get_referenced_event_by_id(event_id=input, client=client,
-                                                                   kinds=EventDefinitions.ANY_RESULT,
-                                                                   dvm_config=dvmconfig)
-                            if evt is None:
-                                if append:
-                                    job_ = RequiredJobToWatch(event=nevent, timestamp=Timestamp.now().as_secs())
-                                    self.jobs_on_hold_list.append(job_)
-                                    await send_job_status_reaction(nevent, "chain-scheduled", True, 0,
-                                                                   client=client, dvm_config=dvmconfig)
-
-                                return False
+            for input_tag in JobRequest.of(nevent).inputs:
+                if len(input_tag) < 3:
+                    print("Job Event missing/malformed i tag, skipping..")
+                    return False
+                else:
+                    input = input_tag[1]
+                    input_type = input_tag[2]
+                    if input_type == "job":
+                        evt = await get_referenced_event_by_id(event_id=input, client=client,
+                                                               kinds=EventDefinitions.ANY_RESULT,
+                                                               dvm_config=dvmconfig)
+                        if evt is None:
+                            if append:
+                                job_ = RequiredJobToWatch(event=nevent, timestamp=Timestamp.now().as_secs())
+                                # remove jobs to look for after 20 minutes..
+                                self.jobs_on_hold_list.add(nevent.id().to_hex(), job_,
+                                                           author=nevent.author().to_hex(),
+                                                           expires=job_.timestamp + 60 * 20)
+                                await send_job_status_reaction(nevent, "chain-scheduled", True, 0,
+                                                               client=client, dvm_config=dvmconfig)
+
+                            return False
             else:
                 return True
 
         async def check_and_return_event(data, original_event: Event):
             amount = 0
-            for x in self.job_list:
-                if x.event == original_event:
-                    is_paid = x.is_paid
-                    amount = x.amount
-                    x.result = data
-                    x.is_processed = True
-                    if self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and not is_paid:
-                        await send_nostr_reply_event(data, original_event.as_json())
-                        await send_job_status_reaction(original_event, "success", amount,
-                                                       dvm_config=self.dvm_config
-                                                       )  # or payment-required, or both?
-                    elif not self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and not is_paid:
-                        await send_job_status_reaction(original_event, "success", amount,
-                                                       dvm_config=self.dvm_config
-                                                       )  # or payment-required, or both?
-
-                    if self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and is_paid:
-                        self.job_list.remove(x)
-                    elif not self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and is_paid:
-                        self.job_list.remove(x)
-                        await send_nostr_reply_event(data, original_event.as_json())
-                    break
+            x = self.job_list.get(original_event.id().to_hex())
+            if x is not None:
+                is_paid = x.is_paid
+                amount = x.amount
+                x.result = data
+                x.is_processed = True
+                if self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and not is_paid:
+                    await send_nostr_reply_event(data, original_event)
+                    await send_job_status_reaction(original_event, "success", amount,
+                                                   dvm_config=self.dvm_config
+                                                   )  # or payment-required, or both?
+                elif not self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and not is_paid:
+                    await send_job_status_reaction(original_event, "success", amount,
+                                                   dvm_config=self.dvm_config
+                                                   )  # or payment-required, or both?
+
+                if self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and is_paid:
+                    self.job_list.remove(original_event.id().to_hex())
+                elif not self.dvm_config.SHOW_RESULT_BEFORE_PAYMENT and is_paid:
+                    self.job_list.remove(original_event.id().to_hex())
+                    await send_nostr_reply_event(data, original_event)
 
+            else:
                 task = await get_task(original_event, self.client, self.dvm_config)
                 for dvm in self.dvm_config.SUPPORTED_DVMS:
                     if task == dvm.TASK or dvm.TASK == "generic":
                         try:
-                            post_processed = await dvm.post_process(data, original_event)
-                            await send_nostr_reply_event(post_processed, original_event.as_json())
+                            post_processed = await dvm.post_process(data,
+                                                                    JobRequest.of(original_event).parsed_event)
+                            await send_nostr_reply_event(post_processed, original_event)
                         except Exception as e:
                             print(e)
                             # Zapping back by error in post-processing is a risk for the DVM because work has been done,
@@ -585,7 +648,13 @@ class DVM:
                                     print(e)
 
         async def send_nostr_reply_event(content, original_event_as_str):
-            original_event = Event.from_json(original_event_as_str)
+            # the request event (or its JobRequest), its json works too
+            if isinstance(original_event_as_str, str):
+                original_event = Event.from_json(original_event_as_str)
+            else:
+                original_event = JobRequest.of(original_event_as_str).event
+                original_event_as_str = original_event.as_json()
+            request = JobRequest.of(original_event)
             request_tag = Tag.parse(["request", original_event_as_str])
             e_tag = Tag.parse(["e", original_event.id().to_hex()])
             p_tag = Tag.parse(["p", original_event.author().to_hex()])
@@ -594,35 +663,25 @@ class DVM:
             status_tag = Tag.parse(["status", "success"])
             reply_tags = [request_tag, e_tag, p_tag, alt_tag, status_tag]
 
-            relay_tag = None
-            for tag in original_event.tags().to_vec():
-                if tag.as_vec()[0] == "relays":
-                    relay_tag = tag
-                if tag.as_vec()[0] == "client":
-                    client = tag.as_vec()[1]
-                    reply_tags.append(Tag.parse(["client", client]))
-            if relay_tag is not None:
-                reply_tags.append(relay_tag)
+            for tag in request.tags_named("client"):
+                reply_tags.append(tag.tag)
+            relay_tags = request.tags_named("relays")
+            if len(relay_tags) > 0:
+                reply_tags.append(relay_tags[-1].tag)
 
-            encrypted = False
+            encrypted = request.encrypted
             is_legacy_encryption = False
             encryption_tags = []
-            for tag in original_event.tags().to_vec():
-
-
-                if tag.as_vec()[0] == "encrypted":
-                    encrypted = True
-                    encrypted_tag = Tag.parse(["encrypted"])
-                    encryption_tags.append(encrypted_tag)
-                    #_, is_legacy_encryption = check_and_decrypt_tags(original_event, dvm_config)
-
+            if encrypted:
+                encryption_tags.append(Tag.parse(["encrypted"]))
+                #_, is_legacy_encryption = check_and_decrypt_tags(original_event, dvm_config)
 
-            for tag in original_event.tags().to_vec():
-                if tag.as_vec()[0] == "i":
+            for tag in request.tags:
+                if tag.vec[0] == "i":
                     if not encrypted:
-                        reply_tags.append(tag)
-                elif tag.as_vec()[0] == "expiration":
-                    reply_tags.append(tag)
+                        reply_tags.append(tag.tag)
+                elif tag.vec[0] == "expiration":
+                    reply_tags.append(tag.tag)
 
             if encrypted:
                 encryption_tags.append(p_tag)
@@ -633,24 +692,24 @@ class DVM:
 
             if encrypted:
                 print(content)
-                if is_legacy_encryption:
-                    content = nip04_encrypt(self.keys.secret_key(), PublicKey.parse(original_event.author().to_hex()),
-                                            content)
-                else:
-
-                    content = nip44_encrypt(self.keys.secret_key(),
-                                            PublicKey.parse(original_event.author().to_hex()),
-                                            content, Nip44Version.V2)
+                content = self.crypto.encrypt(request.author, content, legacy=is_legacy_encryption)
 
                 reply_tags = encryption_tags
 
 
-            reply_event = EventBuilder(Kind(original_event.kind().as_u16() + 1000), str(content)).tags(reply_tags).sign_with_keys(
+            reply_event = EventBuilder(Kind(request.kind + 1000), str(content)).tags(reply_tags).sign_with_keys(
                 self.keys)
+            event_index.add(reply_event)
             #print(reply_event)
-            # send_event(reply_event, client=self.client, dvm_config=self.dvm_config)
-            response_status = await send_event_outbox(reply_event, client=self.client, dvm_config=self.dvm_config)
-            if response_status is not None:
+            # the publisher sends the result in the background, results go before any status update
+            self.publisher.publish(reply_event, PRIORITY_RESULT).add_done_callback(
+                lambda future: on_reply_sent(future, reply_event, original_event, time.perf_counter()))
+
+        def on_reply_sent(future, reply_event, original_event, queued_at):
+            metrics.observe("dvm_stage_seconds", time.perf_counter() - queued_at, stage="send_event_outbox",
+                            event="result")
+            response_status = future.result()
+            if len(response_status.success) > 0:
                 if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
                     print(bcolors.GREEN + "[" + self.dvm_config.NIP89.NAME + "] " + str(
                         original_event.kind().as_u16() + 1000) + " Job Response event sent: " + reply_event.as_json() + ". Success: " + str(
@@ -669,37 +728,31 @@ class DVM:
                                            content=None,
                                            dvm_config=None):
 
-            task = await get_task(original_event, client=client, dvm_config=dvm_config)
+            request = JobRequest.of(original_event)
+            original_event = request.event
+            task = await get_task(request, client=client, dvm_config=dvm_config)
             alt_description, reaction = build_status_reaction(status, task, amount, content, dvm_config)
 
-            e_tag = Tag.parse(["e", original_event.id().to_hex()])
-            p_tag = Tag.parse(["p", original_event.author().to_hex()])
+            e_tag = Tag.parse(["e", request.id])
+            p_tag = Tag.parse(["p", request.author])
             alt_tag = Tag.parse(["alt", alt_description])
             status_tag = Tag.parse(["status", status])
 
             reply_tags = [e_tag, alt_tag, status_tag]
 
-            relay_tag = None
-            for tag in original_event.tags().to_vec():
-                if tag.as_vec()[0] == "relays":
-                    relay_tag = tag
-                    break
+            relay_tag = request.tag("relays")
             if relay_tag is not None:
-                reply_tags.append(relay_tag)
+                reply_tags.append(relay_tag.tag)
 
             encryption_tags = []
 
-            encrypted = False
+            encrypted = request.encrypted
             is_legacy_encryption = False
-            expiration_tag = None
-            for tag in original_event.tags().to_vec():
-                if tag.as_vec()[0] == "encrypted":
-                    encrypted = True
-                    encrypted_tag = Tag.parse(["encrypted"])
-                    encryption_tags.append(encrypted_tag)
-                    #_, is_legacy_encryption = check_and_decrypt_tags(original_event, dvm_config)
-                elif tag.as_vec()[0] == "expiration":
-                    expiration_tag = tag
+            if encrypted:
+                encryption_tags.append(Tag.parse(["encrypted"]))
+                #_, is_legacy_encryption = check_and_decrypt_tags(original_event, dvm_config)
+            expiration_tags = request.tags_named("expiration")
+            expiration_tag = expiration_tags[-1].tag if len(expiration_tags) > 0 else None
 
             if encrypted:
                 encryption_tags.append(p_tag)
@@ -709,11 +762,10 @@ class DVM:
                 reply_tags.append(p_tag)
 
             if status == "success" or status == "error":  #
-                for x in self.job_list:
-                    if x.event == original_event:
-                        is_paid = x.is_paid
-                        amount = x.amount
-                        break
+                x = self.job_list.get(original_event.id().to_hex())
+                if x is not None:
+                    is_paid = x.is_paid
+                    amount = x.amount
 
             bolt11 = ""
             payment_hash = ""
@@ -740,15 +792,19 @@ class DVM:
                 else:
                     bolt11 = None
 
-            if not any(x.event == original_event for x in self.job_list):
-                self.job_list.append(
-                    JobToWatch(event=original_event,
-                               timestamp=original_event.created_at().as_secs(),
-                               amount=amount,
-                               is_paid=is_paid,
-                               status=status, result="", is_processed=False, bolt11=bolt11,
-                               payment_hash=payment_hash,
-                               expires=expires))
+            if original_event.id().to_hex() not in self.job_list:
+                self.job_list.add(original_event.id().to_hex(),
+                                  JobToWatch(event=original_event,
+                                             timestamp=original_event.created_at().as_secs(),
+                                             amount=amount,
+                                             is_paid=is_paid,
+                                             status=status, result="", is_processed=False, bolt11=bolt11,
+                                             payment_hash=payment_hash,
+                                             expires=expires),
+                                  author=original_event.author().to_hex(), payment_hash=payment_hash,
+                                  expires=expires)
+                if bolt11 is not None and bolt11 != "" and payment_hash is not None and payment_hash != "":
+                    self.payment_watcher.watch(payment_hash)
                 # print(str(self.job_list))
             if (status == "payment-required" or status == "payment-rejected" or (
                     status == "processing" and not is_paid)
@@ -768,13 +824,7 @@ class DVM:
                     str_tags.append(element.as_vec())
 
                 content = json.dumps(str_tags)
-                if is_legacy_encryption:
-                    content = nip04_encrypt(self.keys.secret_key(), PublicKey.parse(original_event.author().to_hex()),
-                                            content)
-                else:
-                    content = nip44_encrypt(self.keys.secret_key(),
-                                            PublicKey.parse(original_event.author().to_hex()),
-                                            content, version=Nip44Version.V2)
+                content = self.crypto.encrypt(request.author, content, legacy=is_legacy_encryption)
                 reply_tags = encryption_tags
 
             else:
@@ -783,11 +833,21 @@ class DVM:
             if expiration_tag is not None:
                 reply_tags.append(expiration_tag)
 
-            keys = Keys.parse(dvm_config.PRIVATE_KEY)
-            reaction_event = EventBuilder(EventDefinitions.KIND_FEEDBACK, str(content)).tags(reply_tags).sign_with_keys(keys)
-            # send_event(reaction_event, client=self.client, dvm_config=self.dvm_config)
-            response_status = await send_event_outbox(reaction_event, client=self.client, dvm_config=self.dvm_config)
-            if response_status is not None:
+            reaction_event = EventBuilder(EventDefinitions.KIND_FEEDBACK, str(content)).tags(reply_tags).sign_with_keys(
+                self.keys)
+            event_index.add(reaction_event)
+            # the publisher sends the reaction in the background, a newer status of the same job that is queued
+            # before this one was sent replaces it
+            self.publisher.publish(reaction_event, PRIORITY_FEEDBACK,
+                                   key="status:" + original_event.id().to_hex()).add_done_callback(
+                lambda future: on_reaction_sent(future, reaction_event, status, time.perf_counter()))
+            return reaction_event.as_json()
+
+        def on_reaction_sent(future, reaction_event, status, queued_at):
+            metrics.observe("dvm_stage_seconds", time.perf_counter() - queued_at, stage="send_event_outbox",
+                            event="status")
+            response_status = future.result()
+            if len(response_status.success) > 0:
                 if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
                     print(bcolors.YELLOW + "[" + self.dvm_config.NIP89.NAME + "] Sent Kind " + str(
                         EventDefinitions.KIND_FEEDBACK.as_u16()) + " Reaction: " + status + " " + reaction_event.as_json() +  ". Success: " + str(
@@ -802,9 +862,6 @@ class DVM:
             else:
                 print(bcolors.RED + "No success" + bcolors.ENDC)
 
-
-            return reaction_event.as_json()
-
         async def _read_stream(stream, cb):
             while True:
                 line = await stream.readline()
@@ -818,13 +875,13 @@ class DVM:
                                                            stdout=asyncio.subprocess.PIPE,
                                                            stderr=asyncio.subprocess.PIPE)
 
-        async def run_subprocess(python_bin, dvm_config, request_form, stdout_cb, stderr_cb):
+        async def run_subprocess(python_bin, dvm_config, request_form, stdout_cb, stderr_cb, output='output.txt'):
             print("Running subprocess, please wait..")
             process = await asyncio.create_subprocess_exec(
                 python_bin, dvm_config.SCRIPT,
                 '--request', json.dumps(request_form),
                 '--identifier', dvm_config.IDENTIFIER,
-                '--output', 'output.txt',
+                '--output', output,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
@@ -851,14 +908,15 @@ class DVM:
                     EventDefinitions.KIND_NIP90_EXTRACT_TEXT.as_u16() <= job_event.kind().as_u16() <= EventDefinitions.KIND_NIP90_GENERIC.as_u16())
                     or job_event.kind().as_u16() == EventDefinitions.KIND_DM.as_u16()):
 
-                task = await get_task(job_event, client=self.client, dvm_config=self.dvm_config)
+                request = JobRequest.of(job_event)
+                task = await get_task(request, client=self.client, dvm_config=self.dvm_config)
 
                 for dvm in self.dvm_config.SUPPORTED_DVMS:
                     result = ""
                     try:
                         if task == dvm.TASK or dvm.TASK == "generic":
 
-                            request_form = await dvm.create_request_from_nostr_event(job_event, self.client,
+                            request_form = await dvm.create_request_from_job_request(request, self.client,
                                                                                      self.dvm_config)
 
                             if dvm_config.USE_OWN_VENV:
@@ -871,32 +929,41 @@ class DVM:
                                 #                           '--request', json.dumps(request_form),
                                 #                           '--identifier', dvm_config.IDENTIFIER,
                                 #                           '--output', 'output.txt'])
-                                await run_subprocess(python_bin, dvm_config, request_form,
-                                                     lambda x: print("%s" % x.decode("utf-8").replace("\n", "")),
-                                                     lambda x: print("STDERR: %s" % x.decode("utf-8")))
+                                # jobs might run in parallel, so every job gets its own output file
+                                output_file = 'output_' + job_event.id().to_hex() + '.txt'
+                                with metrics.span("process", task=task):
+                                    await run_subprocess(python_bin, dvm_config, request_form,
+                                                         lambda x: print("%s" % x.decode("utf-8").replace("\n", "")),
+                                                         lambda x: print("STDERR: %s" % x.decode("utf-8")),
+                                                         output=output_file)
                                 print("Finished processing, loading data..")
 
-                                with open(os.path.abspath('output.txt'), encoding="utf-8") as f:
+                                with open(os.path.abspath(output_file), encoding="utf-8") as f:
                                     resultall = f.readlines()
                                     for line in resultall:
                                         if line != '\n':
                                             result += line
-                                os.remove(os.path.abspath('output.txt'))
+                                os.remove(os.path.abspath(output_file))
                                 assert not result.startswith("Error:")
                                 print(result)
 
                             else:  # Some components might have issues with running code in otuside venv.
                                 # We install locally in these cases for now
-                                result = await dvm.process(request_form)
+                                with metrics.span("process", task=task):
+                                    result = await self.job_scheduler.run_process(dvm, request_form)
                             try:
-                                post_processed = await dvm.post_process(result, job_event)
-                                await send_nostr_reply_event(post_processed, job_event.as_json())
+                                with metrics.span("post_process", task=task):
+                                    post_processed = await dvm.post_process(result, request.parsed_event)
+                                await send_nostr_reply_event(post_processed, job_event)
+                                metrics.inc("dvm_jobs_processed_total", task=task)
                             except Exception as e:
+                                metrics.inc("dvm_jobs_failed_total", task=task, stage="post_process")
                                 print(bcolors.RED + "[" + self.dvm_config.NIP89.NAME + "] Error: " + str(
                                     e) + bcolors.ENDC)
                                 await send_job_status_reaction(job_event, "error", content=str(e),
                                                                dvm_config=self.dvm_config)
                     except Exception as e:
+                        metrics.inc("dvm_jobs_failed_total", task=task, stage="process")
                         print(
                             bcolors.RED + "[" + self.dvm_config.NIP89.NAME + "] Error: " + str(e) + bcolors.ENDC)
 
@@ -921,6 +988,59 @@ class DVM:
 
                         return
 
+        async def schedule_work(job_event, amount, task, paid=None):
+            # Jobs are queued and processed by the scheduler's workers, so we don't block handling other events
+            if paid:
+                metrics.inc("dvm_jobs_paid_total", task=task)
+            if not await self.job_scheduler.submit(job_event, amount, task, paid):
+                metrics.inc("dvm_jobs_failed_total", task=task, stage="schedule")
+                await send_job_status_reaction(job_event, "error", content="The DVM is currently busy, please try "
+                                                                           "again later.",
+                                               dvm_config=self.dvm_config)
+
+        async def on_invoice_paid(payment_hash):
+            job = self.job_list.get_by_payment_hash(payment_hash)
+            if job is None or job.is_paid:
+                return
+            print("is paid")
+            job.is_paid = True
+            amount = parse_amount_from_bolt11_invoice(job.bolt11)
+            await send_job_status_reaction(job.event, "processing", True, 0,
+                                           content=self.dvm_config.CUSTOM_PROCESSING_MESSAGE,
+                                           client=self.client,
+                                           dvm_config=self.dvm_config)
+            print("[" + self.dvm_config.NIP89.NAME + "] doing work from joblist")
+            task = await get_task(job.event, client=self.client, dvm_config=self.dvm_config)
+            await schedule_work(job.event, amount, task, paid=True)
+
+        async def on_invoice_expired(payment_hash):
+            job = self.job_list.get_by_payment_hash(payment_hash)
+            if job is not None and not job.is_paid:
+                self.job_list.remove(job.event.id().to_hex())
+
+        outbox_pool = get_outbox_relay_pool(self.dvm_config)
+
+        async def resolve_outbox_relays(event):
+            return (await get_outbox_relays(event, self.client, self.dvm_config))[:5]
+
+        async def resolve_fallback_relays(event, relays):
+            return await get_fallback_relays(event, relays, self.client, self.dvm_config)
+
+        self.publisher = EventPublisher(self.dvm_config, outbox_pool.send_event_to, resolve_outbox_relays,
+                                        fallback_function=resolve_fallback_relays)
+        self.publisher.start()
+        self.job_scheduler = JobScheduler(self.dvm_config, do_work)
+        self.job_scheduler.start()
+        self.payment_watcher = PaymentWatcher(self.dvm_config, on_invoice_paid, on_invoice_expired)
+        await self.payment_watcher.start()
+
+        # gauges are only read when the metrics are exported
+        metrics.gauge("dvm_job_list_size", lambda: len(self.job_list))
+        metrics.gauge("dvm_jobs_on_hold", lambda: len(self.jobs_on_hold_list))
+        metrics.gauge("dvm_jobs_in_flight", lambda: self.job_scheduler.in_flight())
+        metrics.gauge("dvm_pending_invoices", lambda: len(self.payment_watcher.invoices))
+        metrics.gauge("dvm_publish_queue", lambda: self.publisher.pending())
+
         asyncio.create_task(self.client.handle_notifications(NotificationHandler()))
 
         try:
@@ -929,42 +1049,27 @@ class DVM:
                 for dvm in self.dvm_config.SUPPORTED_DVMS:
                     await dvm.schedule(self.dvm_config)
 
-                for job in self.job_list:
-                    if job.bolt11 != "" and job.payment_hash != "" and not job.payment_hash is None and not job.is_paid:
-                        ispaid = check_bolt11_ln_bits_is_paid(job.payment_hash, self.dvm_config)
-                        if ispaid and job.is_paid is False:
-                            print("is paid")
-                            job.is_paid = True
-                            amount = parse_amount_from_bolt11_invoice(job.bolt11)
-
-                            job.is_paid = True
-                            await send_job_status_reaction(job.event, "processing", True, 0,
-                                                           content=self.dvm_config.CUSTOM_PROCESSING_MESSAGE,
-                                                           client=self.client,
-                                                           dvm_config=self.dvm_config)
-                            print("[" + self.dvm_config.NIP89.NAME + "] doing work from joblist")
-                            await do_work(job.event, amount)
-                        elif ispaid is None:  # invoice expired
-                            self.job_list.remove(job)
-
-                    if Timestamp.now().as_secs() > job.expires:
-                        self.job_list.remove(job)
+                # invoices are checked by the payment watcher, we only clean up jobs that expired
+                for job in self.job_list.pop_expired(Timestamp.now().as_secs()):
+                    self.payment_watcher.unwatch(job.payment_hash)
 
                 for job in self.jobs_on_hold_list:
                     if await check_event_has_not_unfinished_job_input(job.event, False, client=self.client,
                                                                       dvmconfig=self.dvm_config):
+                        self.jobs_on_hold_list.remove(job.event.id().to_hex())
                         await handle_nip90_job_event(nip90_event=job.event)
-                        try:
-                            self.jobs_on_hold_list.remove(job)
-                        except:
-                            print("[" + self.dvm_config.NIP89.NAME + "] Error removing Job on Hold from List after expiry")
 
-                    if Timestamp.now().as_secs() > job.timestamp + 60 * 20:  # remove jobs to look for after 20 minutes..
-                        self.jobs_on_hold_list.remove(job)
+                self.jobs_on_hold_list.pop_expired(Timestamp.now().as_secs())
 
                 await asyncio.sleep(1)
         except BaseException:
             print("end")
 
+        await self.job_scheduler.stop()
+        await self.payment_watcher.stop()
+        await self.publisher.stop()
+        if self.dvm_config.ENABLE_METRICS and self.dvm_config.METRICS_DUMP_FILE != "":
+            dump_metrics(self.dvm_config.METRICS_DUMP_FILE)
+
         print("and now my watch has ended.")
 
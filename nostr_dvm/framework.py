@@ -2,6 +2,7 @@ import os
 import signal
 import time
 from nostr_dvm.utils.print_utils import bcolors
+from nostr_dvm.utils.relay_pool_utils import relay_pool_stats
 
 
 class DVMFramework:
@@ -33,3 +34,7 @@ class DVMFramework:
     def get_dvms(self):
         return self.dvms
 
+    def get_relay_stats(self):
+        # relay connections are shared by all DVMs of the framework, see relay_pool_utils
+        return relay_pool_stats()
+
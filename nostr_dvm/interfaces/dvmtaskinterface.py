@@ -15,6 +15,7 @@ from nostr_sdk import Keys, Kind, LogLevel
 from nostr_dvm.dvm import DVM
 from nostr_dvm.utils.admin_utils import AdminConfig
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
+from nostr_dvm.utils.job_request_utils import JobRequest
 from nostr_dvm.utils.nip88_utils import NIP88Config
 from nostr_dvm.utils.nip89_utils import NIP89Config, delete_nip_89
 from nostr_dvm.utils.output_utils import post_process_result
@@ -148,6 +149,15 @@ class DVMTaskInterface:
         """Parse input into a request form that will be given to the process method"""
         pass
 
+    async def is_input_supported_request(self, request: JobRequest, client=None, dvm_config=None) -> bool:
+        """Like is_input_supported, with the parsed request. Calls is_input_supported with its tags if not overwritten"""
+        return await self.is_input_supported(request.tags, client, dvm_config)
+
+    async def create_request_from_job_request(self, request: JobRequest, client=None, dvm_config=None) -> dict:
+        """Like create_request_from_nostr_event, with the parsed request. Calls create_request_from_nostr_event with
+        the event of the request (its tags already parsed) if not overwritten"""
+        return await self.create_request_from_nostr_event(request.parsed_event, client, dvm_config)
+
     async def process(self, request_form):
         "Process the data and return the result"
         pass
@@ -9,11 +9,13 @@ from nostr_sdk import Timestamp, Tag, Keys, Options, SecretKey, NostrSigner, Nos
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.utils import definitions
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database
 from nostr_dvm.utils.definitions import EventDefinitions
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config, check_and_set_d_tag_nip88, check_and_set_tiereventid_nip88
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag, create_amount_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_events
+from nostr_dvm.utils.sync_utils import database_synced, sync_database
 
 """
 This File contains a Module to discover popular notes
@@ -110,7 +112,7 @@ class DicoverContentLatestWiki(DVMTaskInterface):
         sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
         keys = Keys.parse(sk.to_hex())
 
-        database = NostrDatabase.lmdb(self.db_name)
+        database = get_database(self.db_name)
         # print(self.db_name)
         cli = ClientBuilder().database(database).signer(NostrSigner.keys(keys)).build()
         await cli.connect()
@@ -161,7 +163,8 @@ class DicoverContentLatestWiki(DVMTaskInterface):
         if dvm_config.SCHEDULE_UPDATES_SECONDS == 0:
             return 0
         else:
-            if Timestamp.now().as_secs() >= self.last_schedule + dvm_config.SCHEDULE_UPDATES_SECONDS:
+            if (Timestamp.now().as_secs() >= self.last_schedule + dvm_config.SCHEDULE_UPDATES_SECONDS or
+                    database_synced(self.dvm_config, self.db_name)):
                 if self.dvm_config.UPDATE_DATABASE:
                     await self.sync_db()
                 self.last_schedule = Timestamp.now().as_secs()
@@ -170,36 +173,9 @@ class DicoverContentLatestWiki(DVMTaskInterface):
 
     async def sync_db(self):
         try:
-            relaylimits = RelayLimits.disable()
-            opts = (Options().relay_limits(relaylimits))
-            sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-            keys = Keys.parse(sk.to_hex())
-            database = NostrDatabase.lmdb(self.db_name)
-            cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).opts(opts).build()
-
-            for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-                await cli.add_relay(relay)
-
-            await cli.connect()
-
-            timestamp_since = Timestamp.now().as_secs() - self.db_since
-            since = Timestamp.from_secs(timestamp_since)
-
-            filter1 = Filter().kinds([definitions.EventDefinitions.KIND_WIKI]).since(since)  # Notes, reactions, zaps
-
-            # filter = Filter().author(keys.public_key())
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print("[" + self.dvm_config.NIP89.NAME + "] Syncing notes of the last " + str(
-                    self.db_since) + " seconds.. this might take a while..")
-            dbopts = SyncOptions().direction(SyncDirection.DOWN)
-            await cli.sync(filter1, dbopts)
-            await cli.database().delete(Filter().until(Timestamp.from_secs(
-                Timestamp.now().as_secs() - self.db_since)))  # Clear old events so db doesn't get too full.
-            await cli.shutdown()
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print(
-                    "[" + self.dvm_config.NIP89.NAME + "] Done Syncing Notes of the last " + str(
-                        self.db_since) + " seconds..")
+            # the database is synced once for all DVMs that use it, see SyncCoordinator
+            kinds = [definitions.EventDefinitions.KIND_WIKI]
+            await sync_database(self.dvm_config, self.db_name, kinds, self.db_since)
         except Exception as e:
             print(e)
 
@@ -7,12 +7,14 @@ from nostr_sdk import Timestamp, Tag, Keys, Options, SecretKey, NostrSigner, Nos
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.utils import definitions
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database, get_database_view
 from nostr_dvm.utils.definitions import EventDefinitions
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config, check_and_set_d_tag_nip88, check_and_set_tiereventid_nip88
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag, create_amount_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_events
-from nostr_dvm.utils.zap_utils import parse_amount_from_bolt11_invoice
+from nostr_dvm.utils.sync_utils import database_synced, sync_database
+from nostr_dvm.utils.zap_ledger_utils import ZapLedger
 
 """
 This File contains a Module to discover popular notes by amount of zaps
@@ -103,11 +105,9 @@ class DicoverContentCurrentlyPopularZaps(DVMTaskInterface):
 
     async def calculate_result(self, request_form):
         from nostr_sdk import Filter
-        from types import SimpleNamespace
-        ns = SimpleNamespace()
 
         options = self.set_options(request_form)
-        database = NostrDatabase.lmdb(self.db_name)
+        database = get_database_view(self.db_name)
 
         timestamp_hour_ago = Timestamp.now().as_secs() - self.db_since
         since = Timestamp.from_secs(timestamp_hour_ago)
@@ -116,63 +116,16 @@ class DicoverContentCurrentlyPopularZaps(DVMTaskInterface):
         events = await database.query(filter1)
         if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
             print("[" + self.dvm_config.NIP89.NAME + "] Considering " + str(len(events.to_vec())) + " Events")
+        event_ids = {event.id().to_hex() for event in events.to_vec()
+                     if event.created_at().as_secs() > timestamp_hour_ago}
 
-        ns.finallist = {}
-        for event in events.to_vec():
-            if event.created_at().as_secs() > timestamp_hour_ago:
-                filt = Filter().kinds([definitions.EventDefinitions.KIND_ZAP]).event(event.id()).since(since)
-                zaps = await database.query(filt)
-                invoice_amount = 0
-                event_author = event.author().to_hex()
-                if len(zaps.to_vec()) >= self.min_reactions:
-                    has_preimage = False
-                    has_amount = False
-                    overall_amount = 0
-                    for zap in zaps.to_vec():
-                        if event_author == zap.author().to_hex():
-                            continue  # Skip self zaps..
-                        invoice_amount = 0
-                        for tag in zap.tags().to_vec():
-
-                            if tag.as_vec()[0] == 'bolt11':
-                                # print(tag.as_vec()[1])
-                                invoice_amount = parse_amount_from_bolt11_invoice(tag.as_vec()[1])
-
-                                has_amount = True
-                                if has_preimage:
-                                    break
-                                # print(invoice_amount)
-                            if tag.as_vec()[0] == 'preimage':
-                                if len(tag.as_vec()) > 1:
-                                    if tag.as_vec()[1] == "":
-                                        continue
-                                    elif tag.as_vec()[1] != "":
-
-                                        has_preimage = True  # TODO further check preimage
-                                        if has_amount:
-                                            overall_amount += invoice_amount
-                                            break
-                            # elif tag.as_vec()[0] == 'description':
-                            #    try:
-                            #        event = Event.from_json(tag.as_vec()[1])
-                            #        for tag in event.tags().to_vec():
-                            #            if tag.as_vec()[0] == "amount":
-                            #                invoice_amount = tag.as_vec()[1]
-                            #                overall_amount += invoice_amount
-
-                            #               has_amount = True
-                            #               if has_preimage:
-                            #                   break
-
-                            #    except:
-                            #        pass
-
-                    if has_preimage:
-                        ns.finallist[event.id().to_hex()] = overall_amount
+        # zap receipts are parsed once when they are synced, see ZapLedger
+        ledger = ZapLedger.get(self.db_name)
+        await ledger.refresh(database, timestamp_hour_ago)
+        finallist_sorted = ledger.top_events(timestamp_hour_ago, options["max_results"], self.min_reactions,
+                                             event_ids=event_ids, require_preimage=True)
 
         result_list = []
-
-        finallist_sorted = sorted(ns.finallist.items(), key=lambda x: x[1], reverse=True)[:int(options["max_results"])]
         for entry in finallist_sorted:
             # print(EventId.parse(entry[0]).to_bech32() + "/" + EventId.parse(entry[0]).to_hex() + ": " + str(entry[1]))
             e_tag = Tag.parse(["e", entry[0]])
@@ -200,7 +153,8 @@ class DicoverContentCurrentlyPopularZaps(DVMTaskInterface):
         if dvm_config.SCHEDULE_UPDATES_SECONDS == 0:
             return 0
         else:
-            if Timestamp.now().as_secs() >= self.last_schedule + dvm_config.SCHEDULE_UPDATES_SECONDS:
+            if (Timestamp.now().as_secs() >= self.last_schedule + dvm_config.SCHEDULE_UPDATES_SECONDS or
+                    database_synced(self.dvm_config, self.db_name)):
                 try:
                     if self.dvm_config.UPDATE_DATABASE:
                         await self.sync_db()
@@ -213,36 +167,10 @@ class DicoverContentCurrentlyPopularZaps(DVMTaskInterface):
 
     async def sync_db(self):
         try:
-            sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-            keys = Keys.parse(sk.to_hex())
-            database = NostrDatabase.lmdb(self.db_name)
-            cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).build()
-
-            for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-                await cli.add_relay(relay)
-
-            await cli.connect()
-
-            timestamp_since = Timestamp.now().as_secs() - self.db_since
-            since = Timestamp.from_secs(timestamp_since)
-
-            filter1 = Filter().kinds(
-                [definitions.EventDefinitions.KIND_NOTE, definitions.EventDefinitions.KIND_REACTION,
-                 definitions.EventDefinitions.KIND_ZAP]).since(since)  # Notes, reactions, zaps
-
-            # filter = Filter().author(keys.public_key())
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print("[" + self.dvm_config.NIP89.NAME + "] Syncing notes of the last " + str(
-                    self.db_since) + " seconds.. this might take a while..")
-            dbopts = SyncOptions().direction(SyncDirection.DOWN)
-            await cli.sync(filter1, dbopts)
-            await cli.database().delete(Filter().until(Timestamp.from_secs(
-                Timestamp.now().as_secs() - self.db_since)))  # Clear old events so db doesn't get too full.
-            await cli.shutdown()
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print(
-                    "[" + self.dvm_config.NIP89.NAME + "] Done Syncing Notes of the last " + str(
-                        self.db_since) + " seconds..")
+            # the database is synced once for all DVMs that use it, see SyncCoordinator
+            kinds = [definitions.EventDefinitions.KIND_NOTE, definitions.EventDefinitions.KIND_REACTION,
+                     definitions.EventDefinitions.KIND_ZAP]
+            await sync_database(self.dvm_config, self.db_name, kinds, self.db_since)
         except Exception as e:
             print(e)
 
@@ -8,11 +8,15 @@ from nostr_sdk import Timestamp, PublicKey, Tag, Keys, Options, SecretKey, Nostr
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.utils import definitions
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database
 from nostr_dvm.utils.definitions import EventDefinitions, relay_timeout
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
+from nostr_dvm.utils.follow_list_utils import get_follow_list_cache
 from nostr_dvm.utils.nip88_utils import NIP88Config, check_and_set_d_tag_nip88, check_and_set_tiereventid_nip88
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag, create_amount_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_events
+from nostr_dvm.utils.popularity_utils import count_interactions, top_events
+from nostr_dvm.utils.sync_utils import sync_database
 
 """
 This File contains a Module to discover popular notes
@@ -86,31 +90,15 @@ class DicoverContentCurrentlyPopularFollowers(DVMTaskInterface):
 
     async def process(self, request_form):
         from nostr_sdk import Filter
-        from types import SimpleNamespace
-        ns = SimpleNamespace()
 
         options = self.set_options(request_form)
-        relaylimits = RelayLimits.disable()
-        opts = (
-            Options().relay_limits(
-                relaylimits))
-        sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-        keys = Keys.parse(sk.to_hex())
+        database = get_database(self.db_name)
 
-        database = NostrDatabase.lmdb(self.db_name)
-        cli = ClientBuilder().database(database).signer(NostrSigner.keys(keys)).opts(opts).build()
-        for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-            await cli.add_relay(relay)
-
-        # ropts = RelayOptions().ping(False)
-        # cli.add_relay_with_opts("wss://nostr.band", ropts)
-
-        await cli.connect()
-
-        user = PublicKey.parse(options["user"])
-        followers_filter = Filter().author(user).kinds([Kind(3)])
-        followers = await cli.fetch_events(followers_filter, relay_timeout)
-        # print(followers)
+        # the follow list comes from the shared cache, the relays are only asked if it isn't fresh
+        follow_lists = get_follow_list_cache(self.dvm_config)
+        followings = await follow_lists.get_follows(options["user"])
+        if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
+            print("[" + self.dvm_config.NIP89.NAME + "] Follow lists: " + str(follow_lists.stats()))
 
         # Negentropy reconciliation
         # Query events from database
@@ -119,45 +107,19 @@ class DicoverContentCurrentlyPopularFollowers(DVMTaskInterface):
 
         result_list = []
 
-        if len(followers.to_vec()) > 0:
-            newest = 0
-            best_entry = followers.to_vec()[0]
-            for entry in followers.to_vec():
-                if entry.created_at().as_secs() > newest:
-                    newest = entry.created_at().as_secs()
-                    best_entry = entry
-
-            # print(best_entry.as_json())
-            followings = []
-            for tag in best_entry.tags().to_vec():
-                if tag.as_vec()[0] == "p":
-                    following = PublicKey.parse(tag.as_vec()[1])
-                    followings.append(following)
-
+        if followings:
             filter1 = Filter().kind(definitions.EventDefinitions.KIND_NOTE).authors(followings).since(since)
-            events = await cli.database().query(filter1)
+            events = await database.query(filter1)
             if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
                 print("[" + self.dvm_config.NIP89.NAME + "] Considering " + str(len(events.to_vec())) + " Events")
 
-            ns.finallist = {}
-            for event in events.to_vec():
-                # if event.created_at().as_secs() > timestamp_since:
-                filt = Filter().kinds(
-                    [definitions.EventDefinitions.KIND_ZAP, definitions.EventDefinitions.KIND_REACTION,
-                     definitions.EventDefinitions.KIND_REPOST,
-                     definitions.EventDefinitions.KIND_NOTE]).event(event.id()).since(since)
-                reactions = await cli.database().query(filt)
-                if len(reactions.to_vec()) >= self.min_reactions:
-                    ns.finallist[event.id().to_hex()] = len(reactions.to_vec())
-
-            finallist_sorted = sorted(ns.finallist.items(), key=lambda x: x[1], reverse=True)[
-                               :int(options["max_results"])]
+            event_ids = [event.id().to_hex() for event in events.to_vec()]
+            counts = await count_interactions(database, since, event_ids=set(event_ids))
+            finallist_sorted = top_events(counts, event_ids, options["max_results"], self.min_reactions)
             for entry in finallist_sorted:
                 # print(EventId.parse(entry[0]).to_bech32() + "/" + EventId.parse(entry[0]).to_hex() + ": " + str(entry[1]))
                 e_tag = Tag.parse(["e", entry[0]])
                 result_list.append(e_tag.as_vec())
-            # await cli.connect()
-            await cli.shutdown()
             if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
                 print("[" + self.dvm_config.NIP89.NAME + "] Filtered " + str(
                     len(result_list)) + " fitting events.")
@@ -189,35 +151,10 @@ class DicoverContentCurrentlyPopularFollowers(DVMTaskInterface):
 
     async def sync_db(self):
         try:
-            sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-            keys = Keys.parse(sk.to_hex())
-            database = NostrDatabase.lmdb(self.db_name)
-            cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).build()
-
-            for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-                await cli.add_relay(relay)
-
-            await cli.connect()
-
-            timestamp_since = Timestamp.now().as_secs() - self.db_since
-            since = Timestamp.from_secs(timestamp_since)
-
-            filter1 = Filter().kinds(
-                [definitions.EventDefinitions.KIND_NOTE, definitions.EventDefinitions.KIND_REACTION,
-                 definitions.EventDefinitions.KIND_ZAP]).since(since)  # Notes, reactions, zaps
-
-            # filter = Filter().author(keys.public_key())
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print("[" + self.dvm_config.NIP89.NAME + "] Syncing notes of the last " + str(
-                    self.db_since) + " seconds.. this might take a while..")
-            dbopts = SyncOptions().direction(SyncDirection.DOWN)
-            await cli.sync(filter1, dbopts)
-            await cli.database().delete(Filter().until(Timestamp.from_secs(
-                Timestamp.now().as_secs() - self.db_since)))  # Clear old events so db doesn't get too full.
-            await cli.shutdown()
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print("[" + self.dvm_config.NIP89.NAME + "] Done Syncing Notes of the last " + str(
-                    self.db_since) + " seconds..")
+            # the database is synced once for all DVMs that use it, see SyncCoordinator
+            kinds = [definitions.EventDefinitions.KIND_NOTE, definitions.EventDefinitions.KIND_REACTION,
+                     definitions.EventDefinitions.KIND_ZAP]
+            await sync_database(self.dvm_config, self.db_name, kinds, self.db_since)
         except Exception as e:
             print(e)
 
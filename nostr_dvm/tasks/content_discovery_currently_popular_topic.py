@@ -9,11 +9,15 @@ from nostr_sdk import Timestamp, Tag, Keys, Options, SecretKey, NostrSigner, Nos
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.utils import definitions
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database, get_database_view
 from nostr_dvm.utils.definitions import EventDefinitions
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config, check_and_set_d_tag_nip88, check_and_set_tiereventid_nip88
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag, create_amount_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_events
+from nostr_dvm.utils.popularity_utils import count_interactions, top_events
+from nostr_dvm.utils.sync_utils import database_synced, sync_database
+from nostr_dvm.utils.topic_utils import TopicMatcher, TopicIndex
 
 """
 This File contains a Module to discover popular notes by topics
@@ -144,12 +148,10 @@ class DicoverContentCurrentlyPopularbyTopic(DVMTaskInterface):
 
     async def calculate_result(self, request_form):
         from nostr_sdk import Filter
-        from types import SimpleNamespace
-        ns = SimpleNamespace()
 
         options = self.set_options(request_form)
         if self.database is None:
-            self.database = NostrDatabase.lmdb(self.db_name)
+            self.database = get_database_view(self.db_name)
 
         timestamp_since = Timestamp.now().as_secs() - self.db_since
         since = Timestamp.from_secs(timestamp_since)
@@ -158,33 +160,17 @@ class DicoverContentCurrentlyPopularbyTopic(DVMTaskInterface):
             print("Search List empty")
             return {}
 
-        filter = Filter().kind(definitions.EventDefinitions.KIND_NOTE).since(since).search(self.search_list[0])
-        events = await self.database.query(filter)
-        for word in self.search_list[1:]:
-            filter = Filter().kind(definitions.EventDefinitions.KIND_NOTE).since(since).search(word)
-            evts = await self.database.query(filter)
-            events = events.merge(evts)
-
-
-
+        # the notes of the database are classified once for all topic DVMs using it, see TopicIndex
+        matcher = TopicMatcher.get(self.search_list, self.must_list, self.avoid_list)
+        topic_index = TopicIndex.get(self.db_name)
+        event_ids = await topic_index.matching(self.database, matcher, timestamp_since)
         if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-            print("[" + self.dvm_config.NIP89.NAME + "] Considering " + str(len(events.to_vec())) + " Events")
-        ns.finallist = {}
-
-        for event in events.to_vec():
-            if all(ele in event.content().lower() for ele in self.must_list):
-                # if any(ele in event.content().lower() for ele in self.search_list):
-                if not any(ele in event.content().lower() for ele in self.avoid_list):
-                    filt = Filter().kinds(
-                        [definitions.EventDefinitions.KIND_ZAP, definitions.EventDefinitions.KIND_REACTION,
-                         definitions.EventDefinitions.KIND_REPOST,
-                         definitions.EventDefinitions.KIND_NOTE]).event(event.id()).since(since)
-                    reactions = await self.database.query(filt)
-                    if len(reactions.to_vec()) >= self.min_reactions:
-                        ns.finallist[event.id().to_hex()] = len(reactions.to_vec())
+            print("[" + self.dvm_config.NIP89.NAME + "] Considering " + str(len(event_ids)) + " of " + str(
+                topic_index.stats()["notes"]) + " Events")
 
+        counts = await count_interactions(self.database, since, event_ids=set(event_ids))
         result_list = []
-        finallist_sorted = sorted(ns.finallist.items(), key=lambda x: x[1], reverse=True)[:int(options["max_results"])]
+        finallist_sorted = top_events(counts, event_ids, options["max_results"], self.min_reactions)
         for entry in finallist_sorted:
             # print(EventId.parse(entry[0]).to_bech32() + "/" + EventId.parse(entry[0]).to_hex() + ": " + str(entry[1]))
             e_tag = Tag.parse(["e", entry[0]])
@@ -199,7 +185,8 @@ class DicoverContentCurrentlyPopularbyTopic(DVMTaskInterface):
         if dvm_config.SCHEDULE_UPDATES_SECONDS == 0:
             return 0
         else:
-            if Timestamp.now().as_secs() >= self.last_schedule + dvm_config.SCHEDULE_UPDATES_SECONDS:
+            if (Timestamp.now().as_secs() >= self.last_schedule + dvm_config.SCHEDULE_UPDATES_SECONDS or
+                    database_synced(self.dvm_config, self.db_name)):
                 if self.dvm_config.UPDATE_DATABASE:
                     await self.sync_db()
                 self.last_schedule = Timestamp.now().as_secs()
@@ -209,36 +196,10 @@ class DicoverContentCurrentlyPopularbyTopic(DVMTaskInterface):
 
     async def sync_db(self):
         try:
-            sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-            keys = Keys.parse(sk.to_hex())
-            database = NostrDatabase.lmdb(self.db_name)
-            cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).build()
-
-            for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-                await cli.add_relay(relay)
-
-            await cli.connect()
-
-            timestamp_since = Timestamp.now().as_secs() - self.db_since
-            since = Timestamp.from_secs(timestamp_since)
-
-            filter1 = Filter().kinds(
-                [definitions.EventDefinitions.KIND_NOTE, definitions.EventDefinitions.KIND_REACTION,
-                 definitions.EventDefinitions.KIND_ZAP]).since(since)  # Notes, reactions, zaps
-
-            # filter = Filter().author(keys.public_key())
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print("[" + self.dvm_config.NIP89.NAME + "] Syncing notes of the last " + str(
-                    self.db_since) + " seconds.. this might take a while..")
-            dbopts = SyncOptions().direction(SyncDirection.DOWN)
-            await cli.sync(filter1, dbopts)
-            await cli.database().delete(Filter().until(Timestamp.from_secs(
-                Timestamp.now().as_secs() - self.db_since)))  # Clear old events so db doesn't get too full.
-            await cli.shutdown()
-            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
-                print("[" + self.dvm_config.NIP89.NAME + "] Done Syncing Notes of the last " + str(
-                    self.db_since) + " seconds..")
-
+            # the database is synced once for all DVMs that use it, see SyncCoordinator
+            kinds = [definitions.EventDefinitions.KIND_NOTE, definitions.EventDefinitions.KIND_REACTION,
+                     definitions.EventDefinitions.KIND_ZAP]
+            await sync_database(self.dvm_config, self.db_name, kinds, self.db_since)
         except Exception as e:
             print(e)
 
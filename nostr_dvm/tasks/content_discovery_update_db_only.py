@@ -2,7 +2,6 @@ import json
 import json
 import os
 from datetime import timedelta
-from itertools import islice
 
 from nostr_sdk import Timestamp, PublicKey, Keys, Options, SecretKey, NostrSigner, NostrDatabase, \
     ClientBuilder, Filter, SyncOptions, SyncDirection, init_logger, LogLevel, Kind, \
@@ -17,7 +16,8 @@ from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config, check_and_set_d_tag_nip88, check_and_set_tiereventid_nip88
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag, create_amount_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_events
-from nostr_dvm.utils.wot_utils import build_wot_network
+from nostr_dvm.utils.sync_utils import sync_database
+from nostr_dvm.utils.wot_utils import WotMaintainer, apply_wot_filtering
 
 """
 This File contains a Module to update the database for content discovery dvms
@@ -44,6 +44,8 @@ class DicoverContentDBUpdateScheduler(DVMTaskInterface):
     result = ""
     database = None
     wot_counter = 0
+    wot_client = None
+    wot_generation = None
     max_db_size = 280
 
     async def init_dvm(self, name, dvm_config: DVMConfig, nip89config: NIP89Config, nip88config: NIP88Config = None,
@@ -133,47 +135,41 @@ class DicoverContentDBUpdateScheduler(DVMTaskInterface):
 
     async def sync_db(self):
         try:
-            relaylimits = RelayLimits.disable()
-            opts = (Options().relay_limits(relaylimits))
-            if self.dvm_config.WOT_FILTERING:
-                opts = opts.filtering_mode(RelayFilteringMode.WHITELIST)
-            sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-            keys = Keys.parse(sk.to_hex())
+            if not self.dvm_config.WOT_FILTERING:
+                # the database is synced once for all DVMs that use it, see SyncCoordinator. With WOT filtering,
+                # this DVM syncs on its own, as the filter only applies to its own client.
+                if self.database is None:
+                    self.database = await init_db(self.db_name, True, self.max_db_size)
+                kinds = [definitions.EventDefinitions.KIND_NOTE, definitions.EventDefinitions.KIND_REACTION,
+                         definitions.EventDefinitions.KIND_ZAP]
+                await sync_database(self.dvm_config, self.db_name, kinds, self.db_since)
+                return
+
             if self.database is None:
                 self.database = await init_db(self.db_name, True, self.max_db_size)
                 #self.database = NostrDatabase.lmdb(self.db_name)
 
-            cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(self.database).opts(opts).build()
-
-            for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-                await cli.add_relay(relay)
-
-            await cli.connect()
-
-            if self.dvm_config.WOT_FILTERING and self.wot_counter == 0:
-                print("Calculating WOT for " + str(self.dvm_config.WOT_BASED_ON_NPUBS))
-                filtering = cli.filtering()
-                index_map, G = await build_wot_network(self.dvm_config.WOT_BASED_ON_NPUBS,
-                                                       depth=self.dvm_config.WOT_DEPTH, max_batch=500,
-                                                       max_time_request=10, dvm_config=self.dvm_config)
-
-                # Do we actually need pagerank here?
-                # print('computing global pagerank...')
-                # tic = time.time()
-                # p_G = nx.pagerank(G, tol=1e-12)
-                # print("network after pagerank: " + str(len(p_G)))
-
-                wot_keys = []
-                for item in islice(G, len(G)):
-                    key = next((PublicKey.parse(pubkey) for pubkey, id in index_map.items() if id == item),
-                               None)
-                    wot_keys.append(key)
-
-                # toc = time.time()
-                # print(f'finished in {toc - tic} seconds')
-                await filtering.add_public_keys(wot_keys)
+            # the client stays connected, so its whitelist only needs the keys that changed since the last sync
+            if self.wot_client is None:
+                relaylimits = RelayLimits.disable()
+                opts = (Options().relay_limits(relaylimits)).filtering_mode(RelayFilteringMode.WHITELIST)
+                sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
+                keys = Keys.parse(sk.to_hex())
+                self.wot_client = ClientBuilder().signer(NostrSigner.keys(keys)).database(self.database).opts(
+                    opts).build()
+                for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
+                    await self.wot_client.add_relay(relay)
+                await self.wot_client.connect()
+            cli = self.wot_client
+
+            wot = WotMaintainer.get(self.dvm_config.WOT_BASED_ON_NPUBS, self.dvm_config.WOT_DEPTH,
+                                    self.dvm_config.SYNC_DB_RELAY_LIST)
+            if self.wot_counter == 0:
+                print("Updating WOT for " + str(self.dvm_config.WOT_BASED_ON_NPUBS))
+                await wot.update(self.dvm_config, self.dvm_config.SCHEDULE_UPDATES_SECONDS)
+            self.wot_generation = await apply_wot_filtering(cli, wot, self.wot_generation)
             self.wot_counter += 1
-            # only calculate wot every 10th call
+            # only update wot every 10th call
             if self.wot_counter >= 10:
                 self.wot_counter = 0
             # Mute public key
@@ -193,7 +189,6 @@ class DicoverContentDBUpdateScheduler(DVMTaskInterface):
             await cli.sync(filter1, dbopts)
             await cli.database().delete(Filter().until(Timestamp.from_secs(
                 Timestamp.now().as_secs() - self.db_since)))  # Clear old events so db doesn't get too full.
-            await cli.shutdown()
             if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
                 print(
                     "[" + self.dvm_config.IDENTIFIER + "] Done Syncing Notes of the last " + str(
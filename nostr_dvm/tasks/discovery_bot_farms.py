@@ -7,11 +7,13 @@ from nostr_sdk import Timestamp, Tag, Keys, Options, SecretKey, NostrSigner, Nos
 
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database
 from nostr_dvm.utils.definitions import EventDefinitions
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_users
+from nostr_dvm.utils.profile_index_utils import ProfileIndex
 
 """
 This File contains a Module to search for notes
@@ -27,6 +29,8 @@ class DiscoveryBotFarms(DVMTaskInterface):
     FIX_COST: float = 0
     dvm_config: DVMConfig
     last_schedule: int = 0
+    db_name = "db/nostr_profiles.db"
+    profile_index_checked = False
 
     async def init_dvm(self, name, dvm_config: DVMConfig, nip89config: NIP89Config, nip88config: NIP88Config = None,
                        admin_config: AdminConfig = None, options=None):
@@ -71,45 +75,22 @@ class DiscoveryBotFarms(DVMTaskInterface):
         return request_form
 
     async def process(self, request_form):
-        from nostr_sdk import Filter
         options = self.set_options(request_form)
 
-        sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-        keys = Keys.parse(sk.to_hex())
-
-        database = NostrDatabase.lmdb("db/nostr_profiles.db")
-        cli = ClientBuilder().database(database).signer(NostrSigner.keys(keys)).build()
-
-        await cli.add_relay("wss://relay.damus.io")
-        # cli.add_relay("wss://atl.purplerelay.com")
-        await cli.connect()
+        database = get_database(self.db_name)
+        index = ProfileIndex.get(self.db_name)
+        if not self.profile_index_checked:
+            # index the profiles that were synced before the index existed
+            await index.refresh(database)
+            self.profile_index_checked = True
 
-        # Negentropy reconciliation
-
-        # Query events from database
-
-        filter1 = Filter().kind(Kind(0))
-        events = await cli.database().query(filter1)
         result_list = []
-        print("Events: " + str(len(events.to_vec())))
-
         searchterms = str(options["search"]).split(";")
-        index = 0
-        if len(events.to_vec()) > 0:
-
-            for event in events.to_vec():
-                if index < options["max_results"]:
-                    try:
-                        if any(ext in event.content().lower() for ext in searchterms):
-                            p_tag = Tag.parse(["p", event.author().to_hex()])
-                            print(event.as_json())
-                            result_list.append(p_tag.as_vec())
-                            index += 1
-                    except Exception as exp:
-                        print(str(exp) + " " + event.author().to_hex())
-                else:
-                    break
-        await cli.shutdown()
+        for pubkey in index.search_phrases(searchterms, options["max_results"]):
+            p_tag = Tag.parse(["p", pubkey])
+            result_list.append(p_tag.as_vec())
+        print("Profiles found: " + str(len(result_list)))
+
         return json.dumps(result_list)
 
     async def post_process(self, result, event):
@@ -136,7 +117,7 @@ class DiscoveryBotFarms(DVMTaskInterface):
     async def sync_db(self):
         sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
         keys = Keys.parse(sk.to_hex())
-        database = NostrDatabase.lmdb("db/nostr_profiles.db")
+        database = get_database(self.db_name)
         cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).build()
 
         await cli.add_relay("wss://relay.damus.io")
@@ -148,8 +129,10 @@ class DiscoveryBotFarms(DVMTaskInterface):
         # filter = Filter().author(keys.public_key())
         print("Syncing Profile Database.. this might take a while..")
         dbopts = SyncOptions().direction(SyncDirection.DOWN)
-        await cli.sync(filter1, dbopts)
+        output = await cli.sync(filter1, dbopts)
         print("Done Syncing Profile Database.")
+        await ProfileIndex.get(self.db_name).refresh(database, output.report.received)
+        self.profile_index_checked = True
 
 
 # We build an example here that we can call by either calling this file directly from the main directory,
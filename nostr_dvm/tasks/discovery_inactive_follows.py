@@ -1,15 +1,15 @@
-import asyncio
 import json
 import os
-from threading import Thread
 
 from nostr_sdk import Client, Timestamp, PublicKey, Tag, Keys, Options, SecretKey, NostrSigner, Kind, RelayOptions, \
     RelayLimits, ClientBuilder
 
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
+from nostr_dvm.utils.activity_utils import get_activity_scanner
 from nostr_dvm.utils.admin_utils import AdminConfig
 from nostr_dvm.utils.definitions import EventDefinitions, relay_timeout_long, relay_timeout
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
+from nostr_dvm.utils.follow_list_utils import get_follow_list_cache
 from nostr_dvm.utils.nip88_utils import NIP88Config
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_users
@@ -68,93 +68,28 @@ class DiscoverInactiveFollows(DVMTaskInterface):
         from types import SimpleNamespace
         ns = SimpleNamespace()
 
-        sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-        keys = Keys.parse(sk.to_hex())
-        # relaylimits = RelayLimits().event_max_num_tags(max_num_tags=10000)
-        # relaylimits.event_max_size(None)
-        relaylimits = RelayLimits.disable()
-
-        opts = (Options().relay_limits(relaylimits))
-
-        cli = ClientBuilder().signer(NostrSigner.keys(keys)).opts(opts).build()
-        for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-            await cli.add_relay(relay)
-        await cli.add_relay("wss://nostr.band")
-
-        await cli.connect()
-
         options = self.set_options(request_form)
-        step = 20
 
-        followers_filter = Filter().author(PublicKey.parse(options["user"])).kind(Kind(3))
-        followers = await cli.fetch_events(followers_filter, relay_timeout)
-        if len(followers.to_vec()) > 0:
+        # the follow list comes from the shared cache, the relays are only asked if it isn't fresh
+        followings = await get_follow_list_cache(self.dvm_config).get_follows_hex(options["user"])
+        if followings is not None:
             result_list = []
-            newest = 0
-            best_entry = followers.to_vec()[0]
-            for entry in followers.to_vec():
-                print(len(best_entry.tags().to_vec()))
-                print(best_entry.created_at().as_secs())
-                if entry.created_at().as_secs() > newest:
-                    newest = entry.created_at().as_secs()
-                    best_entry = entry
-
-            followings = []
-            ns.dic = {}
-            tagcount = 0
-            for tag in best_entry.tags().to_vec():
-                tagcount += 1
-                if tag.as_vec()[0] == "p":
-                    following = tag.as_vec()[1]
-                    followings.append(following)
-                    ns.dic[following] = "False"
-            print("Followings: " + str(len(followings)) + " Tags: " + str(tagcount))
+            ns.dic = {following: "False" for following in followings}
+            print("Followings: " + str(len(followings)))
 
             not_active_since_seconds = int(options["since_days"]) * 24 * 60 * 60
-            dif = Timestamp.now().as_secs() - not_active_since_seconds
-            not_active_since = Timestamp.from_secs(dif)
-
-            async def scanList(users, instance, i, st, notactivesince):
-                from nostr_sdk import Filter
-
-                keys = Keys.parse(self.dvm_config.PRIVATE_KEY)
-                cli = Client(NostrSigner.keys(keys))
-                for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-                    await cli.add_relay(relay)
-                await cli.connect()
-                filter1 = Filter().author(PublicKey.parse(users[i])).since(notactivesince).limit(1)
-                event_from_authors = await cli.fetch_events(filter1, relay_timeout_long)
-                for j in range(i+1, i + st):
-                    filter1 = Filter().author(PublicKey.parse(users[j])).since(notactivesince).limit(1)
-                    events = await cli.fetch_events(filter1, relay_timeout_long)
-                    event_from_authors = event_from_authors.merge(events)
-
-                for author in event_from_authors.to_vec():
-                    instance.dic[author.author().to_hex()] = "True"
-                print(str(i) + "/" + str(len(users)))
-                await cli.shutdown()
-
-            threads = []
-            begin = 0
-            # Spawn some threads to speed things up
-            while begin < len(followings) - step:
-                t = Thread(target=asyncio.run, args=(scanList(followings, ns, begin, step, not_active_since),))
-                threads.append(t)
-                begin = begin + step - 1
-
-            # last to step size
-            missing_scans = (len(followings) - begin)
-            t = Thread(target=asyncio.run, args=(scanList(followings, ns, begin, missing_scans, not_active_since),))
-
-            threads.append(t)
-
-            # Start all threads
-            for x in threads:
-                x.start()
-
-            # Wait for all of them to finish
-            for x in threads:
-                x.join()
+            not_active_since = Timestamp.now().as_secs() - not_active_since_seconds
+
+            # latest note, repost or reaction of every follow since not_active_since, None for the inactive ones.
+            # With these kinds the scan can be answered from a synced database that has them.
+            scanner = get_activity_scanner(self.dvm_config)
+            latest = await scanner.latest_events(followings, not_active_since,
+                                                 [EventDefinitions.KIND_NOTE, EventDefinitions.KIND_REPOST,
+                                                  EventDefinitions.KIND_REACTION])
+            for following, event in latest.items():
+                if event is not None:
+                    ns.dic[following] = "True"
+            print("Activity scan: " + str(scanner.stats()))
 
             result = {k for (k, v) in ns.dic.items() if v == "False"}
 
@@ -10,6 +10,7 @@ from nostr_sdk import Timestamp, PublicKey, Tag, Keys, Options, SecretKey, Nostr
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.tasks.people_discovery_wot import DiscoverPeopleWOT
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database, get_database_view
 from nostr_dvm.utils.definitions import EventDefinitions
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config, check_and_set_d_tag_nip88, check_and_set_tiereventid_nip88
@@ -205,7 +206,7 @@ class DiscoverPeopleMyWOT(DVMTaskInterface):
 
         sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
         keys = Keys.parse(sk.to_hex())
-        database = NostrDatabase.lmdb(self.db_name)
+        database = get_database(self.db_name)
         cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).build()
 
         for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
@@ -245,7 +246,7 @@ async def analyse_users(user_ids=None, dunbar=100000000):
                 print(npub)
                 print(e)
 
-        database = NostrDatabase.lmdb("db/nostr_followlists.db")
+        database = get_database_view("db/nostr_followlists.db")
         followers_filter = Filter().authors(user_keys).kind(Kind(3))
         followers = await database.query(followers_filter)
         allfriends = []
@@ -1,21 +1,21 @@
-import csv
-import csv
 import json
 import os
+import time
 from datetime import timedelta
 
-import networkx as nx
-import pandas as pd
+import numpy as np
 from nostr_sdk import Timestamp, PublicKey, Tag, Keys, Options, SecretKey, NostrSigner, NostrDatabase, \
     ClientBuilder, Filter, SyncOptions, SyncDirection, init_logger, LogLevel, Kind
 
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database, get_database_view
 from nostr_dvm.utils.definitions import EventDefinitions
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config, check_and_set_d_tag_nip88, check_and_set_tiereventid_nip88
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag, create_amount_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_users
+from nostr_dvm.utils.wot_utils import sparse_pagerank
 
 """
 This File contains a Module to discover users followed by users you follow, based on WOT
@@ -83,6 +83,7 @@ class DiscoverPeopleWOT(DVMTaskInterface):
         print(user)
         hops = 2
         dunbar = 1000
+        personalized = False
 
         for tag in event.tags().to_vec():
             if tag.as_vec()[0] == 'i':
@@ -100,12 +101,15 @@ class DiscoverPeopleWOT(DVMTaskInterface):
                 elif param == "dunbar":  # check for param type
                     dunbar = int(tag.as_vec()[2])
                     print(dunbar)
+                elif param == "personalized":  # check for param type
+                    personalized = tag.as_vec()[2] == "true"
 
         options = {
             "user": user,
             "max_results": max_results,
             "hops": hops,
             "dunbar": dunbar,
+            "personalized": personalized,
         }
         request_form['options'] = json.dumps(options)
         return request_form
@@ -118,57 +122,56 @@ class DiscoverPeopleWOT(DVMTaskInterface):
         else:
             return self.result
 
-    async def calculate_hop(self, options, list_users, hop, dunbar):
-        print("Fetching hop: " + str(hop))
-        file = "db/" + options["user"] + ".csv"
-        friendlist = []
-        for friend in list_users:
-            for npub in friend.friends:
-                friendlist.append(npub)
-        print(len(friendlist))
-        user_friends_next_level = await analyse_users(friendlist, dunbar)
-        write_to_csv(user_friends_next_level, file)
-        return user_friends_next_level
+    async def calculate_hop(self, follow_edges, frontier, hop, dunbar):
+        print("Fetching hop: " + str(hop) + " (" + str(len(frontier)) + " npubs)")
+        user_friends_next_level = await analyse_users(list(frontier), dunbar)
+        next_frontier = set()
+        for friend in user_friends_next_level:
+            follow_edges.add(friend.user_id, friend.friends)
+            next_frontier.update(friend.friends)
+        return next_frontier
 
     async def calculate_result(self, request_form):
-        from types import SimpleNamespace
-        ns = SimpleNamespace()
-
         options = self.set_options(request_form)
-        file = "db/" + options["user"] + ".csv"
-        try:
-            print("Deleting existing file, creating new one")
-            os.remove(file)
-        except:
-            print("Creating new file")
-        # sync the database, this might take a while if it's empty or hasn't been updated in a long time
+        tic = time.time()
 
         # hop1
         user_id = PublicKey.parse(options["user"]).to_hex()
 
         user_friends_level1 = await analyse_users(
             [user_id])  # for the first user, ignore dunbar, thats the user after all.
-        friendlist = []
-        for npub in user_friends_level1[0].friends:
-            friendlist.append(npub)
-        levelusers = [Friend(user_id, friendlist)]
-        write_to_csv(levelusers, file)
-
+        if len(user_friends_level1) == 0:
+            return json.dumps([])
+        friendlist = user_friends_level1[0].friends
+        follow_edges = FollowEdges()
+        follow_edges.add(user_id, friendlist)
+
+        # every npub is only expanded once, even if it is reachable over several hops
+        visited = {user_id}
+        frontier = set(friendlist) - visited
         for i in range(1, int(options["hops"])):
-            levelusers = await self.calculate_hop(options, levelusers, i, int(options["dunbar"]))
+            visited.update(frontier)
+            frontier = await self.calculate_hop(follow_edges, frontier, i, int(options["dunbar"])) - visited
 
-        df = pd.read_csv(file, sep=',')
-        df.info()
-        df.tail()
+        sources, targets = follow_edges.arrays()
+        toc_hops = time.time()
 
-        G_fb = nx.read_edgelist(file, delimiter=",", create_using=nx.DiGraph(), nodetype=str)
-        print(G_fb)
-        pr = nx.pagerank(G_fb)
+        personalization = None
+        if options.get("personalized"):
+            personalization = {follow_edges.index[user_id]: 1}
+        pr = sparse_pagerank(sources, targets, len(follow_edges.pubkeys), personalization=personalization)
+        toc = time.time()
         # Use this to find people your followers follow
 
-        sorted_nodes = sorted([(node, pagerank) for node, pagerank in pr.items() if node not in friendlist],
-                              key=lambda x: pr[x[0]],
-                              reverse=True)[:int(options["max_results"])]
+        exclude = set(friendlist)
+        exclude.add(user_id)
+        ranked = np.argsort(-pr, kind="stable")
+        sorted_nodes = []
+        for node in ranked:
+            if len(sorted_nodes) >= int(options["max_results"]):
+                break
+            if follow_edges.pubkeys[node] not in exclude:
+                sorted_nodes.append((follow_edges.pubkeys[node], float(pr[node])))
         for node in sorted_nodes:
             print(node[0] + "," + str(node[1]))
 
@@ -178,6 +181,11 @@ class DiscoverPeopleWOT(DVMTaskInterface):
             e_tag = Tag.parse(["p", entry[0], str(entry[1])])
             result_list.append(e_tag.as_vec())
 
+        print("[" + self.dvm_config.NIP89.NAME + "] WOT of " + user_id + ": " + str(
+            len(follow_edges.pubkeys)) + " npubs, " + str(len(sources)) + " follows, edge arrays " + str(
+            round((sources.nbytes + targets.nbytes) / 1024 / 1024, 2)) + " MB, peak memory " + str(
+            peak_memory_mb()) + " MB, hops " + str(round(toc_hops - tic, 2)) + "s, pagerank " + str(
+            round(toc - toc_hops, 2)) + "s")
         if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
             print("[" + self.dvm_config.NIP89.NAME + "] Filtered " + str(
                 len(result_list)) + " fitting events.")
@@ -209,7 +217,7 @@ class DiscoverPeopleWOT(DVMTaskInterface):
     async def sync_db(self):
         sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
         keys = Keys.parse(sk.to_hex())
-        database = NostrDatabase.lmdb(self.db_name)
+        database = get_database(self.db_name)
         cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).build()
 
         for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
@@ -249,7 +257,7 @@ async def analyse_users(user_ids=None, dunbar=100000000):
                 print(npub)
                 print(e)
 
-        database = NostrDatabase.lmdb("db/nostr_followlists.db")
+        database = get_database_view("db/nostr_followlists.db")
         followers_filter = Filter().authors(user_keys).kind(Kind(3))
         followers = await database.query(followers_filter)
         allfriends = []
@@ -280,13 +288,44 @@ class Friend(object):
         self.friends = friends
 
 
-def write_to_csv(friends, file="friends222.csv"):
-    with open(file, 'a') as f:
-        writer = csv.writer(f)
-        for friend in friends:
-            for fren in friend.friends:
-                row = [friend.user_id, fren]
-                writer.writerow(row)
+class FollowEdges(object):
+    """Follow graph of a request as int32 edge arrays, every npub is interned as an index"""
+
+    def __init__(self):
+        self.index = {}
+        self.pubkeys = []
+        self.sources = []
+        self.targets = []
+
+    def intern(self, pubkey):
+        i = self.index.get(pubkey)
+        if i is None:
+            i = len(self.pubkeys)
+            self.index[pubkey] = i
+            self.pubkeys.append(pubkey)
+        return i
+
+    def add(self, user_id, friends):
+        targets = np.fromiter((self.intern(fren) for fren in friends), dtype=np.int32, count=len(friends))
+        self.sources.append(np.full(len(targets), self.intern(user_id), dtype=np.int32))
+        self.targets.append(targets)
+
+    def arrays(self):
+        """(sources, targets) without duplicate follows"""
+        if len(self.sources) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        edges = np.unique(np.concatenate(self.sources).astype(np.int64) * len(self.pubkeys) +
+                          np.concatenate(self.targets))
+        return (edges // len(self.pubkeys)).astype(np.int32), (edges % len(self.pubkeys)).astype(np.int32)
+
+
+def peak_memory_mb():
+    # peak resident memory of the process
+    try:
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    except ImportError:
+        return -1
 
 
 # We build an example here that we can call by either calling this file directly from the main directory,
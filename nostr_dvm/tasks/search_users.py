@@ -1,19 +1,20 @@
 import json
 import os
 from datetime import timedelta
-from itertools import islice
 
 from nostr_sdk import Timestamp, Tag, Keys, Options, SecretKey, NostrSigner, NostrDatabase, \
     ClientBuilder, Filter, SyncOptions, SyncDirection, Kind, PublicKey, RelayFilteringMode, RelayLimits
 
 from nostr_dvm.interfaces.dvmtaskinterface import DVMTaskInterface, process_venv
 from nostr_dvm.utils.admin_utils import AdminConfig
+from nostr_dvm.utils.database_utils import get_database
 from nostr_dvm.utils.definitions import EventDefinitions
 from nostr_dvm.utils.dvmconfig import DVMConfig, build_default_config
 from nostr_dvm.utils.nip88_utils import NIP88Config
 from nostr_dvm.utils.nip89_utils import NIP89Config, check_and_set_d_tag
 from nostr_dvm.utils.output_utils import post_process_list_to_users
-from nostr_dvm.utils.wot_utils import build_wot_network
+from nostr_dvm.utils.profile_index_utils import ProfileIndex
+from nostr_dvm.utils.wot_utils import WotMaintainer, apply_wot_filtering
 
 """
 This File contains a Module to search for notes
@@ -31,6 +32,9 @@ class SearchUser(DVMTaskInterface):
     last_schedule: int = 0
     db_name = "db/nostr_profiles.db"
     wot_counter = 0
+    wot_client = None
+    wot_generation = None
+    profile_index_checked = False
 
     async def init_dvm(self, name, dvm_config: DVMConfig, nip89config: NIP89Config, nip88config: NIP88Config = None,
                        admin_config: AdminConfig = None, options=None):
@@ -76,46 +80,21 @@ class SearchUser(DVMTaskInterface):
         return request_form
 
     async def process(self, request_form):
-        from nostr_sdk import Filter
         options = self.set_options(request_form)
 
-        sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
-        keys = Keys.parse(sk.to_hex())
-        database = NostrDatabase.lmdb(self.db_name)
-        cli = ClientBuilder().database(database).signer(NostrSigner.keys(keys)).build()
-
-        for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-            await cli.add_relay(relay)
-        # cli.add_relay("wss://atl.purplerelay.com")
-        await cli.connect()
-
-        # Negentropy reconciliation
-
-        # Query events from database
-
-        filter1 = Filter().kind(Kind(0))
-        events = await cli.database().query(filter1)
+        database = get_database(self.db_name)
+        index = ProfileIndex.get(self.db_name)
+        if not self.profile_index_checked:
+            # index the profiles that were synced before the index existed
+            await index.refresh(database)
+            self.profile_index_checked = True
 
         result_list = []
-        print("Events: " + str(len(events.to_vec())))
-        index = 0
-        if len(events.to_vec()) > 0:
-
-            for event in events.to_vec():
-                if index < options["max_results"]:
-                    try:
-                        searchterm = " " + options["search"].lower() + " "
-                        if options["search"].lower() in event.content().lower():
-                            p_tag = Tag.parse(["p", event.author().to_hex()])
-                            #print(event.as_json())
-                            result_list.append(p_tag.as_vec())
-                            index += 1
-                    except Exception as exp:
-                        print(str(exp) + " " + event.author().to_hex())
-                else:
-                    break
-
-        await cli.shutdown()
+        for pubkey in index.search(options["search"], options["max_results"]):
+            p_tag = Tag.parse(["p", pubkey])
+            result_list.append(p_tag.as_vec())
+        print("Profiles found: " + str(len(result_list)))
+
         return json.dumps(result_list)
 
     async def post_process(self, result, event):
@@ -142,41 +121,36 @@ class SearchUser(DVMTaskInterface):
     async def sync_db(self):
         sk = SecretKey.parse(self.dvm_config.PRIVATE_KEY)
         keys = Keys.parse(sk.to_hex())
-        database = NostrDatabase.lmdb(self.db_name)
+        database = get_database(self.db_name)
         relaylimits = RelayLimits.disable()
         opts = (Options().relay_limits(relaylimits))
         if self.dvm_config.WOT_FILTERING:
             opts = opts.filtering_mode(RelayFilteringMode.WHITELIST)
-        cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).opts(opts).build()
-
-        for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
-            await cli.add_relay(relay)
-        await cli.connect()
-        if self.dvm_config.WOT_FILTERING and self.wot_counter == 0:
-            print("Calculating WOT for " + str(self.dvm_config.WOT_BASED_ON_NPUBS))
-            filtering = cli.filtering()
-            index_map, G = await build_wot_network(self.dvm_config.WOT_BASED_ON_NPUBS,
-                                                   depth=self.dvm_config.WOT_DEPTH, max_batch=500,
-                                                   max_time_request=10, dvm_config=self.dvm_config)
-
-            # Do we actually need pagerank here?
-            # print('computing global pagerank...')
-            # tic = time.time()
-            # p_G = nx.pagerank(G, tol=1e-12)
-            # print("network after pagerank: " + str(len(p_G)))
-
-            wot_keys = []
-            for item in islice(G, len(G)):
-                key = next((PublicKey.parse(pubkey) for pubkey, id in index_map.items() if id == item),
-                           None)
-                wot_keys.append(key)
-
-            # toc = time.time()
-            # print(f'finished in {toc - tic} seconds')
-            await filtering.add_public_keys(wot_keys)
+        if self.dvm_config.WOT_FILTERING and self.wot_client is not None:
+            # the client stays connected, so its whitelist only needs the keys that changed since the last sync
+            cli = self.wot_client
+        else:
+            cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).opts(opts).build()
+
+            for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
+                await cli.add_relay(relay)
+            await cli.connect()
+            if self.dvm_config.WOT_FILTERING:
+                self.wot_client = cli
+
+        if self.dvm_config.WOT_FILTERING:
+            wot = WotMaintainer.get(self.dvm_config.WOT_BASED_ON_NPUBS, self.dvm_config.WOT_DEPTH,
+                                    self.dvm_config.SYNC_DB_RELAY_LIST)
+            if self.wot_counter == 0:
+                print("Updating WOT for " + str(self.dvm_config.WOT_BASED_ON_NPUBS))
+                await wot.update(self.dvm_config, self.dvm_config.SCHEDULE_UPDATES_SECONDS)
+            generation = self.wot_generation
+            self.wot_generation = await apply_wot_filtering(cli, wot, self.wot_generation)
+            if generation != self.wot_generation:
+                ProfileIndex.get(self.db_name).set_wot_scores(wot.pagerank())
 
         self.wot_counter += 1
-        # only calculate wot every 10th call
+        # only update wot every 10th call
         if self.wot_counter >= 10:
             self.wot_counter = 0
 
@@ -186,11 +160,14 @@ class SearchUser(DVMTaskInterface):
         print("Syncing Profile Database.. this might take a while..")
         try:
             dbopts = SyncOptions().direction(SyncDirection.DOWN)
-            await cli.sync(filter1, dbopts)
+            output = await cli.sync(filter1, dbopts)
             print("Done Syncing Profile Database.")
+            await ProfileIndex.get(self.db_name).refresh(database, output.report.received)
+            self.profile_index_checked = True
         except Exception as exp:
             print(str(exp))
-        await cli.shutdown()
+        if not self.dvm_config.WOT_FILTERING:
+            await cli.shutdown()
 
 
 # We build an example here that we can call by either calling this file directly from the main directory,
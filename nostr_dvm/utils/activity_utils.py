@@ -0,0 +1,211 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from nostr_sdk import Filter, PublicKey, Timestamp
+
+from nostr_dvm.utils.database_utils import get_database_view
+from nostr_dvm.utils.relay_pool_utils import RelayPool
+from nostr_dvm.utils.sync_utils import synced_database
+
+
+class ActivityEntry:
+    __slots__ = ("event", "since", "checked_at")
+
+    def __init__(self, event, since, checked_at):
+        self.event = event  # latest event of the author since `since`, None if there is none
+        self.since = since  # start of the scanned window, None if it was unbounded
+        self.checked_at = checked_at
+
+
+class ActivityScanner:
+    """
+    Finds the latest event of many authors at once, e.g. to find inactive follows or the latest note of everyone
+    a user follows. One scanner per relay list is shared by all DVMs of a process.
+
+    Authors are asked for in batches of BATCH_SIZE per filter, over the pooled connections of the relay list and
+    with up to CONCURRENCY requests in flight. Relays return the newest events first, so every author that shows
+    up in a relay's answer is resolved with their latest event on that relay; the remaining authors are asked for
+    again with until set to the oldest event of the answer, for up to MAX_ROUNDS rounds.
+
+    If a synced database has the kinds of a scan (see synced_database), the database is asked first. An author
+    with an event in the database is resolved with it, since the database has all their newer events too. If the
+    database covers the whole window, it answers for every author, otherwise the authors without an event in it
+    are scanned on the relays.
+
+    Results are cached per author for ttl seconds, so requests for overlapping follow lists only scan the authors
+    that aren't cached yet. Authors a relay scan didn't settle (the relay failed, or they were still open after
+    MAX_ROUNDS) are returned but not cached.
+    """
+
+    BATCH_SIZE = 250
+    LIMIT = 500
+    MAX_ROUNDS = 10
+    CONCURRENCY = 8
+
+    scanners = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(relays):
+        key = tuple(sorted(relays))
+        with ActivityScanner.lock:
+            scanner = ActivityScanner.scanners.get(key)
+            if scanner is None:
+                scanner = ActivityScanner(relays)
+                ActivityScanner.scanners[key] = scanner
+            return scanner
+
+    def __init__(self, relays, ttl=900, max_size=100000, max_time_request=10):
+        self.relays = list(relays)
+        self.pool = RelayPool.get("activity:" + ",".join(sorted(relays)))
+        self.ttl = ttl
+        self.max_size = max_size
+        self.timeout = timedelta(seconds=max_time_request)
+        self.cache = OrderedDict()  # (author, kinds) -> ActivityEntry
+        self.cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_cached(self, key, since, now):
+        # returns (True, event or None) if the cached scan covers the window since `since`
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is None or now - entry.checked_at > self.ttl:
+                self.misses += 1
+                return False, None
+            if entry.since is not None and (since is None or entry.since > since):
+                self.misses += 1
+                return False, None
+            self.cache.move_to_end(key)
+            self.hits += 1
+        event = entry.event
+        if event is not None and since is not None and event.created_at().as_secs() < since:
+            event = None
+        return True, event
+
+    def _set_cached(self, key, event, since, now):
+        with self.cache_lock:
+            self.cache[key] = ActivityEntry(event, since, now)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    async def latest_events(self, authors, since=None, kinds=None):
+        """
+        Returns {author (hex): latest event of the author since `since` (unix time), None if there is none}.
+        If kinds is given, only events of these kinds are considered.
+        """
+        now = time.time()
+        kinds_key = tuple(sorted(kind.as_u16() for kind in kinds)) if kinds else None
+
+        results = {}
+        missing = []
+        for author in authors:
+            if author in results:
+                continue
+            cached, event = self._get_cached((author, kinds_key), since, now)
+            if cached:
+                results[author] = event
+            else:
+                results[author] = None
+                missing.append(author)
+
+        if len(missing) == 0:
+            return results
+
+        found = {}
+        unsettled = set()
+        db_name, synced_since = synced_database(kinds) if kinds else (None, None)
+        if db_name is not None:
+            found = await self._scan_database(db_name, missing, max(since or 0, synced_since), kinds)
+            if since is None or since < synced_since:
+                # the database doesn't reach back far enough for authors without an event in it
+                missing_in_database = [author for author in missing if author not in found]
+                if len(missing_in_database) > 0:
+                    relay_found, unsettled = await self._scan_relays(missing_in_database, since, kinds)
+                    found.update(relay_found)
+        else:
+            found, unsettled = await self._scan_relays(missing, since, kinds)
+
+        for author in missing:
+            results[author] = found.get(author)
+            if author not in unsettled:
+                self._set_cached((author, kinds_key), found.get(author), since, now)
+        return results
+
+    async def _scan_database(self, db_name, authors, since, kinds):
+        database = get_database_view(db_name)
+        found = {}
+        for batch in range(0, len(authors), self.BATCH_SIZE):
+            filter = Filter().authors([PublicKey.parse(author) for author in authors[batch:batch + self.BATCH_SIZE]])
+            filter = filter.kinds(kinds)
+            if since is not None:
+                filter = filter.since(Timestamp.from_secs(since))
+            events = await database.query(filter)
+            _add_latest(found, events.to_vec())
+        return found
+
+    async def _scan_relays(self, authors, since, kinds):
+        """Returns ({author: latest event}, authors that weren't settled on every relay)"""
+        relays = await self.pool.add_relays(self.relays)
+        if len(relays) == 0:
+            return {}, set(authors)
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        found = {}
+        tasks = [self._scan_relay(relay, authors[batch:batch + self.BATCH_SIZE], since, kinds, found, semaphore)
+                 for relay in relays for batch in range(0, len(authors), self.BATCH_SIZE)]
+        unsettled = set()
+        for remaining in await asyncio.gather(*tasks):
+            unsettled.update(remaining)
+        return found, unsettled
+
+    async def _scan_relay(self, relay, authors, since, kinds, found, semaphore):
+        """Adds the latest events of the authors on the relay to found, returns the authors it didn't settle"""
+        remaining = set(authors)
+        until = None
+        for scan_round in range(self.MAX_ROUNDS):
+            filter = Filter().authors([PublicKey.parse(author) for author in remaining]).limit(self.LIMIT)
+            if kinds:
+                filter = filter.kinds(kinds)
+            if since is not None:
+                filter = filter.since(Timestamp.from_secs(since))
+            if until is not None:
+                filter = filter.until(Timestamp.from_secs(until))
+
+            try:
+                async with semaphore:
+                    events = (await self.pool.client.fetch_events_from([relay], filter, self.timeout)).to_vec()
+            except Exception as e:
+                print("Activity scan on " + relay + " failed: " + str(e))
+                return remaining
+
+            _add_latest(found, events)
+            for event in events:
+                remaining.discard(event.author().to_hex())
+            # less events than the limit means the relay has nothing more for these authors
+            if len(events) < self.LIMIT or len(remaining) == 0:
+                return set()
+
+            oldest = min(event.created_at().as_secs() for event in events)
+            # if the whole answer has the same timestamp, step back a second so we don't ask the same again
+            until = oldest if until is None or oldest < until else until - 1
+        return remaining
+
+    def stats(self):
+        with self.cache_lock:
+            return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses}
+
+
+def _add_latest(found, events):
+    for event in events:
+        author = event.author().to_hex()
+        latest = found.get(author)
+        if latest is None or event.created_at().as_secs() > latest.created_at().as_secs():
+            found[author] = event
+
+
+def get_activity_scanner(dvm_config):
+    return ActivityScanner.get(dvm_config.SYNC_DB_RELAY_LIST)
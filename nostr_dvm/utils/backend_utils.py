@@ -1,85 +1,115 @@
+import asyncio
 import os
 import signal
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from nostr_sdk import Event
 
 from nostr_dvm.utils.definitions import EventDefinitions
+from nostr_dvm.utils.job_request_utils import JobRequest
 from nostr_dvm.utils.mediasource_utils import check_source_type, media_source
 from nostr_dvm.utils.nostr_utils import get_event_by_id, get_referenced_event_by_id
 
 
+# The task of a job event doesn't change, but it is needed in several steps of a job. We remember it per DVM and
+# event, so referenced events and urls are only looked at once.
+TASK_MEMO_SIZE = 10000
+task_memo = OrderedDict()
+task_memo_lock = threading.Lock()
+
+
 async def get_task(event, client, dvm_config):
+    # event can be a JobRequest, too
+    request = JobRequest.of(event)
+    key = (id(dvm_config), request.id)
+    with task_memo_lock:
+        task = task_memo.get(key)
+        if task is not None:
+            task_memo.move_to_end(key)
+            return task
+
+    task = await resolve_task(request, client, dvm_config)
+    # don't remember failures, e.g. a referenced event that couldn't be fetched yet
+    if task is not None and not task.startswith("unknown"):
+        with task_memo_lock:
+            task_memo[key] = task
+            while len(task_memo) > TASK_MEMO_SIZE:
+                task_memo.popitem(last=False)
+    return task
+
+
+async def resolve_task(event, client, dvm_config):
+    request = JobRequest.of(event)
+    event = request.event
     try:
-        if event.kind() == EventDefinitions.KIND_NIP90_GENERIC:  # use this for events that have no id yet, inclufr j tag
-            for tag in event.tags().to_vec():
-                if tag.as_vec()[0] == 'j':
-                    return tag.as_vec()[1]
+        if request.kind == EventDefinitions.KIND_NIP90_GENERIC.as_u16():  # use this for events that have no id yet, inclufr j tag
+            if request.job is not None:
+                return request.job
             else:
                 return "unknown job: " + event.as_json()
-        elif event.kind() == EventDefinitions.KIND_DM:  # dm
-            for tag in event.tags().to_vec():
-                if tag.as_vec()[0] == 'j':
-                    return tag.as_vec()[1]
+        elif request.kind == EventDefinitions.KIND_DM.as_u16():  # dm
+            if request.job is not None:
+                return request.job
             else:
                 return "unknown job: " + event.as_json()
 
         # This looks a bit more complicated, but we do several tasks for text-extraction in the future
-        elif event.kind() == EventDefinitions.KIND_NIP90_EXTRACT_TEXT:
-            for tag in event.tags().to_vec():
-                if tag.as_vec()[0] == "i":
-                    if tag.as_vec()[2] == "url":
-                        file_type = check_url_is_readable(tag.as_vec()[1])
-                        print(file_type)
-                        if file_type == "pdf":
-                            return "pdf-to-text"
-                        elif file_type == "audio" or file_type == "video":
-                            return "speech-to-text"
-                        elif file_type == "image":
-                            return "image-to-text"
-                        else:
-                            return "unknown job"
-                    elif tag.as_vec()[2] == "event":
-                        evt = await get_event_by_id(tag.as_vec()[1], client=client, config=dvm_config)
-                        if evt is not None:
-                            if evt.kind() == 1063:
-                                for tg in evt.tags().to_vec():
-                                    if tg.as_vec()[0] == 'url':
-                                        file_type = check_url_is_readable(tg.as_vec()[1])
-                                        if file_type == "pdf":
-                                            return "pdf-to-text"
-                                        elif file_type == "audio" or file_type == "video":
-                                            return "speech-to-text"
-                                        else:
-                                            return "unknown job"
-                            else:
-                                return "unknown type"
+        elif request.kind == EventDefinitions.KIND_NIP90_EXTRACT_TEXT.as_u16():
+            for input_tag in request.inputs:
+                if input_tag[2] == "url":
+                    file_type = await check_url_is_readable_async(input_tag[1])
+                    print(file_type)
+                    if file_type == "pdf":
+                        return "pdf-to-text"
+                    elif file_type == "audio" or file_type == "video":
+                        return "speech-to-text"
+                    elif file_type == "image":
+                        return "image-to-text"
                     else:
                         return "unknown job"
-        elif event.kind() == EventDefinitions.KIND_NIP90_GENERATE_IMAGE:
+                elif input_tag[2] == "event":
+                    evt = await get_event_by_id(input_tag[1], client=client, config=dvm_config)
+                    if evt is not None:
+                        if evt.kind() == 1063:
+                            for tg in evt.tags().to_vec():
+                                if tg.as_vec()[0] == 'url':
+                                    file_type = await check_url_is_readable_async(tg.as_vec()[1])
+                                    if file_type == "pdf":
+                                        return "pdf-to-text"
+                                    elif file_type == "audio" or file_type == "video":
+                                        return "speech-to-text"
+                                    else:
+                                        return "unknown job"
+                        else:
+                            return "unknown type"
+                else:
+                    return "unknown job"
+        elif request.kind == EventDefinitions.KIND_NIP90_GENERATE_IMAGE.as_u16():
             has_image_tag = False
             has_text_tag = False
-            for tag in event.tags().to_vec():
-                if tag.as_vec()[0] == "i":
-                    if tag.as_vec()[2] == "url":
-                        file_type = check_url_is_readable(tag.as_vec()[1])
+            for input_tag in request.inputs:
+                if input_tag[2] == "url":
+                    file_type = await check_url_is_readable_async(input_tag[1])
+                    if file_type == "image":
+                        has_image_tag = True
+                        print("found image tag")
+                elif input_tag[2] == "job":
+                    evt = await get_referenced_event_by_id(event_id=input_tag[1], kinds=
+                    [EventDefinitions.KIND_NIP90_RESULT_EXTRACT_TEXT,
+                     EventDefinitions.KIND_NIP90_RESULT_TRANSLATE_TEXT,
+                     EventDefinitions.KIND_NIP90_RESULT_SUMMARIZE_TEXT],
+                                                           client=client,
+                                                           dvm_config=dvm_config)
+                    if evt is not None:
+                        file_type = await check_url_is_readable_async(evt.content())
                         if file_type == "image":
                             has_image_tag = True
-                            print("found image tag")
-                    elif tag.as_vec()[2] == "job":
-                        evt = await get_referenced_event_by_id(event_id=tag.as_vec()[1], kinds=
-                        [EventDefinitions.KIND_NIP90_RESULT_EXTRACT_TEXT,
-                         EventDefinitions.KIND_NIP90_RESULT_TRANSLATE_TEXT,
-                         EventDefinitions.KIND_NIP90_RESULT_SUMMARIZE_TEXT],
-                                                               client=client,
-                                                               dvm_config=dvm_config)
-                        if evt is not None:
-                            file_type = check_url_is_readable(evt.content())
-                            if file_type == "image":
-                                has_image_tag = True
-                    elif tag.as_vec()[2] == "text":
-                        has_text_tag = True
+                elif input_tag[2] == "text":
+                    has_text_tag = True
 
             if has_image_tag:
                 return "image-to-image"
@@ -92,7 +122,7 @@ async def get_task(event, client, dvm_config):
         else:
 
             for dvm in dvm_config.SUPPORTED_DVMS:
-                if dvm.KIND.as_u16() == event.kind().as_u16():
+                if dvm.KIND.as_u16() == request.kind:
                     return dvm.TASK
     except Exception as e:
         print("Get task: " + str(e))
@@ -130,17 +160,18 @@ async def check_task_is_supported(event: Event, client, config=None):
     try:
         dvm_config = config
         # Check for generic issues, event maformed, referenced event not found etc..
-        if not is_input_supported_generic(event.tags().to_vec(), client, dvm_config):
+        request = JobRequest.of(event)
+        if not is_input_supported_generic(request.tags, client, dvm_config):
             return False, ""
 
         # See if current dvm supports the task
-        task = await get_task(event, client=client, dvm_config=dvm_config)
+        task = await get_task(request, client=client, dvm_config=dvm_config)
         # if task not in (x.TASK for x in dvm_config.SUPPORTED_DVMS) and not task == "generic":
         #     return False, task
         # See if current dvm can handle input for given task
         for dvm in dvm_config.SUPPORTED_DVMS:
             if dvm.TASK == task:
-                if not await dvm.is_input_supported(event.tags().to_vec(), client, config):
+                if not await dvm.is_input_supported_request(request, client, config):
                     return False, task
         return True, task
 
@@ -148,7 +179,100 @@ async def check_task_is_supported(event: Event, client, config=None):
         print("Check task: " + str(e))
 
 
-def check_url_is_readable(url):
+class MediaTypeProber:
+    """
+    Finds out the content type of urls without downloading them: a HEAD request, or a GET of the first byte for
+    servers that don't answer HEAD requests properly. Results are cached for ttl seconds and concurrent probes of
+    the same url (also from other DVM threads) share one request.
+    """
+
+    def __init__(self, ttl=3600, max_size=10000, timeout=10, workers=8):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache = OrderedDict()  # url -> (expires, content type)
+        self.in_flight = {}  # url -> concurrent.futures.Future
+        self.lock = threading.Lock()
+
+    def fetch_content_type(self, url):
+        try:
+            res = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            content_type = res.headers.get('content-type')
+            if res.status_code >= 400 or content_type is None:
+                res = self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=self.timeout)
+                content_type = res.headers.get('content-type')
+                res.close()
+        except Exception as e:
+            print("Media type probe for " + url + " failed: " + str(e))
+            with self.lock:
+                self.in_flight.pop(url, None)
+            return None
+
+        if content_type is not None:
+            content_type = content_type.split(";")[0].strip().lower()
+        with self.lock:
+            self.cache[url] = (time.time() + self.ttl, content_type)
+            self.cache.move_to_end(url)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            self.in_flight.pop(url, None)
+        return content_type
+
+    def submit(self, url):
+        """Returns the cached content type, or a future of the running probe for url."""
+        with self.lock:
+            entry = self.cache.get(url)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.cache.move_to_end(url)
+                    return entry[1], None
+                del self.cache[url]
+            future = self.in_flight.get(url)
+            if future is None:
+                future = self.executor.submit(self.fetch_content_type, url)
+                self.in_flight[url] = future
+        return None, future
+
+    async def get_content_type(self, url):
+        content_type, future = self.submit(url)
+        if future is None:
+            return content_type
+        return await asyncio.wrap_future(future)
+
+    def get_content_type_blocking(self, url):
+        content_type, future = self.submit(url)
+        if future is None:
+            return content_type
+        return future.result()
+
+
+media_type_prober = MediaTypeProber()
+
+
+def media_type_from_content_type(url, content_type):
+    if content_type == 'audio/x-wav' or str(url).endswith(".wav") or content_type == 'audio/mpeg' or str(
+            url).endswith(
+        ".mp3") or content_type == 'audio/ogg' or str(url).endswith(".ogg"):
+        return "audio"
+    elif (content_type == 'image/png' or str(url).endswith(".png") or content_type == 'image/jpg' or str(
+            url).endswith(
+        ".jpg") or content_type == 'image/jpeg' or str(url).endswith(".jpeg") or content_type == 'image/png' or
+          str(url).endswith(".png")):
+        return "image"
+    elif content_type == 'video/mp4' or str(url).endswith(".mp4") or content_type == 'video/avi' or str(
+            url).endswith(
+        ".avi") or content_type == 'video/mov' or str(url).endswith(".mov"):
+        return "video"
+    elif (str(url)).endswith(".pdf"):
+        return "pdf"
+
+    # Otherwise we will not offer to do the job.
+    return None
+
+
+async def check_url_is_readable_async(url):
     if not str(url).startswith("http"):
         return None
 
@@ -157,28 +281,25 @@ def check_url_is_readable(url):
 
     if type == "url":
         # If link is comaptible with one of these file formats, move on.
-        req = requests.get(url)
-        content_type = req.headers['content-type']
-        if content_type == 'audio/x-wav' or str(url).endswith(".wav") or content_type == 'audio/mpeg' or str(
-                url).endswith(
-            ".mp3") or content_type == 'audio/ogg' or str(url).endswith(".ogg"):
-            return "audio"
-        elif (content_type == 'image/png' or str(url).endswith(".png") or content_type == 'image/jpg' or str(
-                url).endswith(
-            ".jpg") or content_type == 'image/jpeg' or str(url).endswith(".jpeg") or content_type == 'image/png' or
-              str(url).endswith(".png")):
-            return "image"
-        elif content_type == 'video/mp4' or str(url).endswith(".mp4") or content_type == 'video/avi' or str(
-                url).endswith(
-            ".avi") or content_type == 'video/mov' or str(url).endswith(".mov"):
-            return "video"
-        elif (str(url)).endswith(".pdf"):
-            return "pdf"
+        content_type = await media_type_prober.get_content_type(url)
+        return media_type_from_content_type(url, content_type)
     else:
         return type
 
-    # Otherwise we will not offer to do the job.
-    return None
+
+def check_url_is_readable(url):
+    if not str(url).startswith("http"):
+        return None
+
+    source = check_source_type(url)
+    type = media_source(source)
+
+    if type == "url":
+        # If link is comaptible with one of these file formats, move on.
+        content_type = media_type_prober.get_content_type_blocking(url)
+        return media_type_from_content_type(url, content_type)
+    else:
+        return type
 
 
 def get_amount_per_task(task, dvm_config, duration=1):
@@ -0,0 +1,171 @@
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from Crypto.Cipher import AES, ChaCha20
+from Crypto.Util.Padding import pad, unpad
+from nostr_sdk import Keys, PublicKey, generate_shared_key
+
+NIP44_VERSION = 2
+NIP44_SALT = b"nip44-v2"
+
+
+def is_nip04_payload(payload):
+    """NIP-04 payloads end with ?iv=<base64 iv>, NIP-44 payloads are plain (versioned) base64"""
+    return "?iv=" in payload
+
+
+def nip44_conversation_key(shared_x):
+    # HKDF-extract with the salt "nip44-v2"
+    return hmac.new(NIP44_SALT, shared_x, hashlib.sha256).digest()
+
+
+def _nip44_message_keys(conversation_key, nonce):
+    # HKDF-expand to 76 bytes: chacha key, chacha nonce, hmac key
+    okm = b""
+    block = b""
+    counter = 1
+    while len(okm) < 76:
+        block = hmac.new(conversation_key, block + nonce + bytes([counter]), hashlib.sha256).digest()
+        okm += block
+        counter += 1
+    return okm[0:32], okm[32:44], okm[44:76]
+
+
+def _nip44_padded_length(length):
+    if length <= 32:
+        return 32
+    next_power = 1 << (length - 1).bit_length()
+    chunk = 32 if next_power <= 256 else next_power // 8
+    return chunk * ((length - 1) // chunk + 1)
+
+
+def nip44_encrypt_with_key(conversation_key, plaintext, nonce=None):
+    data = plaintext.encode("utf-8")
+    if len(data) < 1 or len(data) > 65535:
+        raise ValueError("invalid plaintext length")
+    if nonce is None:
+        nonce = os.urandom(32)
+    chacha_key, chacha_nonce, hmac_key = _nip44_message_keys(conversation_key, nonce)
+    padded = struct.pack(">H", len(data)) + data + bytes(_nip44_padded_length(len(data)) - len(data))
+    ciphertext = ChaCha20.new(key=chacha_key, nonce=chacha_nonce).encrypt(padded)
+    mac = hmac.new(hmac_key, nonce + ciphertext, hashlib.sha256).digest()
+    return base64.b64encode(bytes([NIP44_VERSION]) + nonce + ciphertext + mac).decode("ascii")
+
+
+def nip44_decrypt_with_key(conversation_key, payload):
+    if len(payload) == 0 or payload[0] == "#":
+        raise ValueError("unknown NIP-44 version")
+    data = base64.b64decode(payload, validate=True)
+    if len(data) < 99 or data[0] != NIP44_VERSION:
+        raise ValueError("invalid NIP-44 payload")
+    nonce, ciphertext, mac = data[1:33], data[33:-32], data[-32:]
+    chacha_key, chacha_nonce, hmac_key = _nip44_message_keys(conversation_key, nonce)
+    if not hmac.compare_digest(mac, hmac.new(hmac_key, nonce + ciphertext, hashlib.sha256).digest()):
+        raise ValueError("invalid NIP-44 mac")
+    padded = ChaCha20.new(key=chacha_key, nonce=chacha_nonce).decrypt(ciphertext)
+    length = struct.unpack(">H", padded[0:2])[0]
+    if length < 1 or len(padded) != 2 + _nip44_padded_length(length):
+        raise ValueError("invalid NIP-44 padding")
+    return padded[2:2 + length].decode("utf-8")
+
+
+def nip04_encrypt_with_key(shared_x, plaintext):
+    iv = os.urandom(16)
+    ciphertext = AES.new(shared_x, AES.MODE_CBC, iv).encrypt(pad(plaintext.encode("utf-8"), AES.block_size))
+    return base64.b64encode(ciphertext).decode("ascii") + "?iv=" + base64.b64encode(iv).decode("ascii")
+
+
+def nip04_decrypt_with_key(shared_x, payload):
+    ciphertext, iv = payload.split("?iv=", 1)
+    plaintext = AES.new(shared_x, AES.MODE_CBC, base64.b64decode(iv)).decrypt(base64.b64decode(ciphertext))
+    return unpad(plaintext, AES.block_size).decode("utf-8")
+
+
+class CryptoContext:
+    """
+    Keys and shared secrets of a DVM for encrypted job requests and their replies. The keys are parsed once, the
+    ECDH secret and NIP-44 conversation key of a peer are derived on the first message and kept in an LRU of
+    max_size peers, so a status and the result for the same user don't derive them again.
+
+    decrypt looks at the payload to pick NIP-04 or NIP-44 instead of trying one and falling back to the other.
+    Use CryptoContext.get(private_key) to get the context of a DVM.
+    """
+
+    contexts = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(private_key, max_size=1000):
+        with CryptoContext.lock:
+            context = CryptoContext.contexts.get(private_key)
+            if context is None:
+                context = CryptoContext(private_key, max_size)
+                CryptoContext.contexts[private_key] = context
+            return context
+
+    def __init__(self, private_key, max_size=1000):
+        self.keys = Keys.parse(private_key)
+        self.secret_key = self.keys.secret_key()
+        self.public_key = self.keys.public_key().to_hex()
+        self.max_size = max_size
+        self.peers = OrderedDict()  # peer (hex) -> (ECDH x coordinate, NIP-44 conversation key)
+        self.cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _secrets(self, peer):
+        if isinstance(peer, PublicKey):
+            peer_hex = peer.to_hex()
+        else:
+            peer_hex = peer
+            peer = None
+        with self.cache_lock:
+            secrets = self.peers.get(peer_hex)
+            if secrets is not None:
+                self.peers.move_to_end(peer_hex)
+                self.hits += 1
+                return secrets
+            self.misses += 1
+        if peer is None:
+            peer = PublicKey.parse(peer_hex)
+        shared_x = generate_shared_key(self.secret_key, peer)
+        secrets = (shared_x, nip44_conversation_key(shared_x))
+        with self.cache_lock:
+            self.peers[peer_hex] = secrets
+            while len(self.peers) > self.max_size:
+                self.peers.popitem(last=False)
+        return secrets
+
+    def conversation_key(self, peer):
+        """NIP-44 conversation key with a peer (PublicKey or hex)"""
+        return self._secrets(peer)[1]
+
+    def decrypt(self, peer, payload):
+        """Returns (plaintext, True if the payload was NIP-04), raises ValueError if it can't be decrypted"""
+        shared_x, conversation_key = self._secrets(peer)
+        try:
+            if is_nip04_payload(payload):
+                return nip04_decrypt_with_key(shared_x, payload), True
+            return nip44_decrypt_with_key(conversation_key, payload), False
+        except Exception as e:
+            raise ValueError(str(e))
+
+    def encrypt(self, peer, plaintext, legacy=False):
+        """NIP-44 (v2) payload for a peer, NIP-04 if legacy"""
+        shared_x, conversation_key = self._secrets(peer)
+        if legacy:
+            return nip04_encrypt_with_key(shared_x, plaintext)
+        return nip44_encrypt_with_key(conversation_key, plaintext)
+
+    def stats(self):
+        with self.cache_lock:
+            return {"peers": len(self.peers), "hits": self.hits, "misses": self.misses}
+
+
+def get_crypto_context(dvm_config):
+    return CryptoContext.get(dvm_config.PRIVATE_KEY, dvm_config.CONVERSATION_KEY_CACHE_SIZE)
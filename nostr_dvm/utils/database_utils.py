@@ -3,8 +3,9 @@ import json
 import os
 import shutil
 import sqlite3
-from dataclasses import dataclass
-from logging import Filter
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
 from sqlite3 import Error
 
 from nostr_sdk import Timestamp, Keys, PublicKey, Filter, Kind, make_private_msg, NostrSigner, NostrDatabase
@@ -13,7 +14,7 @@ from nostr_dvm.utils.definitions import relay_timeout
 from nostr_dvm.utils.nostr_utils import send_nip04_dm
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
     npub: str
     balance: int
@@ -26,6 +27,156 @@ class User:
     subscribed: int
 
 
+class UserStore:
+    """
+    Access to the users table of a DVM database.
+
+    Every thread keeps one long-lived connection per database (in WAL mode, so readers don't block the writer),
+    statements are reused via sqlite's statement cache, and recently used users are kept in an LRU cache that is
+    written through on every change. Balance changes are done atomically in SQL (sats = sats - ?), so concurrent
+    jobs can't spend the same balance twice. Use UserStore.get(db) to get the shared store for a database.
+    """
+
+    stores = {}
+    stores_lock = threading.Lock()
+
+    @staticmethod
+    def get(db, cache_size=1000):
+        with UserStore.stores_lock:
+            store = UserStore.stores.get(db)
+            if store is None:
+                store = UserStore(db, cache_size)
+                UserStore.stores[db] = store
+            return store
+
+    def __init__(self, db, cache_size=1000):
+        self.db = db
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.local = threading.local()
+
+    def connection(self):
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.db, cached_statements=64)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self.local.con = con
+        return con
+
+    def _cache_get(self, npub):
+        with self.cache_lock:
+            user = self.cache.get(npub)
+            if user is None:
+                return None
+            self.cache.move_to_end(npub)
+            # hand out copies, so callers can't change the cached user
+            return replace(user)
+
+    def _cache_put(self, user):
+        with self.cache_lock:
+            self.cache[user.npub] = replace(user)
+            self.cache.move_to_end(user.npub)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _cache_remove(self, npub):
+        with self.cache_lock:
+            self.cache.pop(npub, None)
+
+    def get_user(self, npub):
+        user = self._cache_get(npub)
+        if user is not None:
+            return user
+        row = self.connection().execute("SELECT * FROM users WHERE npub=?", (npub,)).fetchone()
+        if row is None:
+            return None
+        if len(row) < 9:
+            add_sql_table_column(self.db)
+            row = tuple(row) + (0,)
+        user = User(npub=row[0], balance=row[1], iswhitelisted=row[2], isblacklisted=row[3], nip05=row[4],
+                    lud16=row[5], name=row[6], lastactive=row[7], subscribed=row[8])
+        if user.subscribed is None:
+            user.subscribed = 0
+        self._cache_put(user)
+        return user
+
+    def add_user(self, npub, sats, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed):
+        con = self.connection()
+        with con:
+            con.execute("INSERT or IGNORE INTO users VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (npub, sats, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed))
+        # the user might have existed before (INSERT or IGNORE), so it will be read from the db again
+        self._cache_remove(npub)
+
+    def update_user(self, npub, balance, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed):
+        con = self.connection()
+        with con:
+            con.execute(""" UPDATE users
+                      SET sats = ? ,
+                          iswhitelisted = ? ,
+                          isblacklisted = ? ,
+                          nip05 = ? ,
+                          lud16 = ? ,
+                          name = ? ,
+                          lastactive = ?,
+                          subscribed = ?
+                      WHERE npub = ?""",
+                        (balance, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed, npub))
+        self._cache_put(User(npub=npub, balance=balance, iswhitelisted=iswhitelisted, isblacklisted=isblacklisted,
+                             nip05=nip05, lud16=lud16, name=name, lastactive=lastactive, subscribed=subscribed))
+
+    def _update_fields(self, npub, fields):
+        """Set some columns of a user (never sats, see debit and credit), the cached user is updated in place"""
+        con = self.connection()
+        with con:
+            con.execute("UPDATE users SET " + ", ".join(column + " = ?" for column in fields) + " WHERE npub = ?",
+                        list(fields.values()) + [npub])
+        with self.cache_lock:
+            user = self.cache.get(npub)
+            if user is not None:
+                for column, value in fields.items():
+                    setattr(user, column, value)
+
+    def update_metadata(self, npub, nip05, lud16, name, lastactive):
+        self._update_fields(npub, {"nip05": nip05, "lud16": lud16, "name": name, "lastactive": lastactive})
+
+    def update_subscription(self, npub, subscribed, lastactive):
+        self._update_fields(npub, {"subscribed": subscribed, "lastactive": lastactive})
+
+    def _change_balance(self, npub, query, params):
+        con = self.connection()
+        with con:
+            cur = con.execute(query, params)
+            if cur.rowcount == 0:
+                return None
+            balance = con.execute("SELECT sats FROM users WHERE npub=?", (npub,)).fetchone()[0]
+        with self.cache_lock:
+            user = self.cache.get(npub)
+            if user is not None:
+                user.balance = balance
+                user.lastactive = params[1]
+        return balance
+
+    def debit(self, npub, sats):
+        """Atomically take sats from a user's balance. Returns the new balance, or None if it was insufficient."""
+        return self._change_balance(npub, "UPDATE users SET sats = sats - ?, lastactive = ? "
+                                          "WHERE npub = ? AND sats >= ?",
+                                    (int(sats), Timestamp.now().as_secs(), npub, int(sats)))
+
+    def credit(self, npub, sats):
+        """Atomically add sats to a user's balance. Returns the new balance, or None if the user doesn't exist."""
+        return self._change_balance(npub, "UPDATE users SET sats = sats + ?, lastactive = ? WHERE npub = ?",
+                                    (int(sats), Timestamp.now().as_secs(), npub))
+
+    def delete_user(self, npub):
+        con = self.connection()
+        with con:
+            con.execute("DELETE FROM users WHERE npub=?", (npub,))
+        self._cache_remove(npub)
+
+
 def create_sql_table(db):
     try:
         import os
@@ -65,79 +216,44 @@ def add_sql_table_column(db):
 
 def add_to_sql_table(db, npub, sats, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed):
     try:
-        con = sqlite3.connect(db)
-        cur = con.cursor()
-        data = (npub, sats, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed)
-        cur.execute("INSERT or IGNORE INTO users VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)", data)
-        con.commit()
-        con.close()
+        UserStore.get(db).add_user(npub, sats, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive,
+                                   subscribed)
     except Error as e:
         print("Error when Adding to DB: " + str(e))
 
 
 def update_sql_table(db, npub, balance, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed):
     try:
-        con = sqlite3.connect(db)
-        cur = con.cursor()
-        data = (balance, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive, subscribed, npub)
-
-        cur.execute(""" UPDATE users
-                  SET sats = ? ,
-                      iswhitelisted = ? ,
-                      isblacklisted = ? ,
-                      nip05 = ? ,
-                      lud16 = ? ,
-                      name = ? ,
-                      lastactive = ?,
-                      subscribed = ?
-                  WHERE npub = ?""", data)
-        con.commit()
-        con.close()
+        UserStore.get(db).update_user(npub, balance, iswhitelisted, isblacklisted, nip05, lud16, name, lastactive,
+                                      subscribed)
     except Error as e:
         print("Error Updating DB: " + str(e))
 
 
-def get_from_sql_table(db, npub):
+def update_user_metadata(db, npub, nip05, lud16, name, lastactive):
     try:
-        con = sqlite3.connect(db)
-        cur = con.cursor()
-        cur.execute("SELECT * FROM users WHERE npub=?", (npub,))
-        row = cur.fetchone()
-        con.close()
-        if row is None:
-            return None
-        else:
-
-            if len(row) < 9:
-                add_sql_table_column(db)
-                # Migrate 
-
-            user = User
-            user.npub = row[0]
-            user.balance = row[1]
-            user.iswhitelisted = row[2]
-            user.isblacklisted = row[3]
-            user.nip05 = row[4]
-            user.lud16 = row[5]
-            user.name = row[6]
-            user.lastactive = row[7]
-            user.subscribed = row[8]
-            if user.subscribed is None:
-                user.subscribed = 0
+        UserStore.get(db).update_metadata(npub, nip05, lud16, name, lastactive)
+    except Error as e:
+        print("Error Updating DB: " + str(e))
 
-            return user
 
+def get_from_sql_table(db, npub):
+    try:
+        return UserStore.get(db).get_user(npub)
     except Error as e:
         print("Error Getting from DB: " + str(e))
 
 
+def debit_user_balance(db, npub, sats):
+    try:
+        return UserStore.get(db).debit(npub, sats)
+    except Error as e:
+        print("Error Updating DB: " + str(e))
+
+
 def delete_from_sql_table(db, npub):
     try:
-        con = sqlite3.connect(db)
-        cur = con.cursor()
-        cur.execute("DELETE FROM users WHERE npub=?", (npub,))
-        con.commit()
-        con.close()
+        UserStore.get(db).delete_user(npub)
     except Error as e:
         print(e)
 
@@ -170,19 +286,15 @@ def list_db(db):
         print(e)
 
 
-async def update_user_balance(db, npub, additional_sats, client, config, giftwrap=False):
+async def update_user_balance(db, npub, additional_sats, client, config, giftwrap=False, publisher=None):
     user = get_from_sql_table(db, npub)
     if user is None:
-        name, nip05, lud16 = fetch_user_metadata(npub, client)
+        name, nip05, lud16 = await fetch_user_metadata(npub, client)
         add_to_sql_table(db, npub, (int(additional_sats) + config.NEW_USER_BALANCE), False, False,
                          nip05, lud16, name, Timestamp.now().as_secs(), 0)
         print("Adding User: " + npub + " (" + npub + ")")
     else:
-        user = get_from_sql_table(db, npub)
-        new_balance = int(user.balance) + int(additional_sats)
-        update_sql_table(db, npub, new_balance, user.iswhitelisted, user.isblacklisted, user.nip05, user.lud16,
-                         user.name,
-                         Timestamp.now().as_secs(), user.subscribed)
+        new_balance = UserStore.get(db).credit(npub, additional_sats)
         print("Updated user balance for: " + str(user.name) +
               " Zap amount: " + str(additional_sats) + " Sats. New balance: " + str(new_balance) + " Sats")
 
@@ -195,7 +307,10 @@ async def update_user_balance(db, npub, additional_sats, client, config, giftwra
             # always send giftwrapped. sorry not sorry.
             #if giftwrap:
             event = await make_private_msg(NostrSigner.keys(keys), PublicKey.parse(npub), message)
-            await client.send_event(event)
+            if publisher is not None:
+                publisher.publish(event, lane=PublicKey.parse(npub).to_hex())
+            else:
+                await client.send_event(event)
             #else:
             #    await send_nip04_dm(client, message, PublicKey.parse(npub), config)
 
@@ -208,12 +323,11 @@ def update_user_subscription(npub, subscribed_until, client, dvm_config):
                          nip05, lud16, name, Timestamp.now().as_secs(), 0)
         print("Adding User: " + npub + " (" + npub + ")")
     else:
-        user = get_from_sql_table(dvm_config.DB, npub)
-
-        update_sql_table(dvm_config.DB, npub, user.balance, user.iswhitelisted, user.isblacklisted, user.nip05,
-                         user.lud16,
-                         user.name,
-                         Timestamp.now().as_secs(), subscribed_until)
+        try:
+            # only the subscription, a full row update could undo a concurrent debit
+            UserStore.get(dvm_config.DB).update_subscription(npub, subscribed_until, Timestamp.now().as_secs())
+        except Error as e:
+            print("Error Updating DB: " + str(e))
         print("Updated user subscription for: " + str(user.name))
 
 
@@ -238,8 +352,7 @@ async def get_or_add_user(db, npub, client, config, update=False, skip_meta=Fals
         try:
             name, nip05, lud16 = await fetch_user_metadata(npub, client)
             print("Updating User: " + npub + " (" + npub + ")")
-            update_sql_table(db, user.npub, user.balance, user.iswhitelisted, user.isblacklisted, nip05,
-                             lud16, name, Timestamp.now().as_secs(), user.subscribed)
+            update_user_metadata(db, user.npub, nip05, lud16, name, Timestamp.now().as_secs())
             user = get_from_sql_table(db, npub)
             return user
         except Exception as e:
@@ -248,18 +361,70 @@ async def get_or_add_user(db, npub, client, config, update=False, skip_meta=Fals
     return user
 
 
+class DatabaseRegistry:
+    """
+    Process-wide registry of NostrDatabase (LMDB) handles. All DVMs of a process that use the same database path
+    share one handle, instead of each task opening (and memory mapping) the database again on every call.
+    """
+    handles = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(path):
+        with DatabaseRegistry.lock:
+            database = DatabaseRegistry.handles.get(path)
+            if database is None:
+                database = NostrDatabase.lmdb(path)
+                DatabaseRegistry.handles[path] = database
+            return database
+
+    @staticmethod
+    def forget(path):
+        with DatabaseRegistry.lock:
+            return DatabaseRegistry.handles.pop(path, None)
+
+    @staticmethod
+    def size_mb(path):
+        database_content = path + "/data.mdb"
+        if os.path.isfile(database_content):
+            return os.stat(database_content).st_size / (1024 * 1024)
+        return None
+
+
+class ReadOnlyDatabase:
+    """View on a shared database handle for DVMs that only read from it."""
+
+    READ_METHODS = ("query", "count", "event_by_id", "check_id", "metadata")
+
+    def __init__(self, database):
+        self.database = database
+
+    def __getattr__(self, name):
+        if name in ReadOnlyDatabase.READ_METHODS:
+            return getattr(self.database, name)
+        raise AttributeError("Database view is read-only, " + name + " is not available")
+
+
+def get_database(path):
+    return DatabaseRegistry.get(path)
+
+
+def get_database_view(path):
+    return ReadOnlyDatabase(DatabaseRegistry.get(path))
+
+
 async def init_db(database, wipe=False, limit=1000, print_filesize=True):
     # LMDB can't grow smaller, so by using this function we can wipe the database on init to avoid
     # it growing too big. If wipe is set to true, the database will be deleted once the size is above the limit param.
-    database_content = database + "/data.mdb"
-    if  os.path.isfile(database_content):
-        file_stats = os.stat(database_content)
-        sizeinmb = file_stats.st_size / (1024 * 1024)
+    sizeinmb = DatabaseRegistry.size_mb(database)
+    if sizeinmb is not None:
         if print_filesize:
             print("Filesize of database \"" + database + "\": " + str(sizeinmb) + " Mb.")
 
         if wipe and sizeinmb > limit:
             try:
+                # DVMs that already hold the old handle keep using it, new ones get the fresh database
+                DatabaseRegistry.forget(database)
                 shutil.rmtree(database)
                 print("Removed database due to large file size. Waiting for resync")
             except OSError as e:
@@ -267,9 +432,7 @@ async def init_db(database, wipe=False, limit=1000, print_filesize=True):
     else:
         print("Creating database: " + database)
 
-
-    return NostrDatabase.lmdb(database)
-
+    return DatabaseRegistry.get(database)
 
 
 async def fetch_user_metadata(npub, client):
@@ -46,6 +46,24 @@ class DVMConfig:
     # Make sure to set admin_utils.REBROADCAST_NIP89 = True on start.
 
     DELETE_ANNOUNCEMENT_ON_SHUTDOWN_POW = False
+    # DVMs in the same process with the same RELAY_LIST share their relay connections.
+    SHARE_RELAY_CONNECTIONS = True
+    # Replies to inbox relays reuse the connections of the outbox pool, relays unused for this long are dropped.
+    OUTBOX_RELAY_IDLE_TIMEOUT = 600
+    # Follow lists of users of personalized DVMs are cached (see FollowListCache) and served without asking the
+    # relays for FOLLOW_LIST_TTL seconds, stale lists up to FOLLOW_LIST_MAX_STALE seconds old are refreshed in the background.
+    FOLLOW_LIST_DB = "db/follow_lists.db"
+    FOLLOW_LIST_TTL = 600
+    FOLLOW_LIST_MAX_STALE = 86400
+    # Inbox relays (NIP-65) of the users we reply to are cached for RELAY_LIST_TTL seconds, the answer "no relays
+    # announced" for RELAY_LIST_NEGATIVE_TTL seconds. Relay lists seen on the DVM relays keep the cache current.
+    RELAY_LIST_TTL = 3600
+    RELAY_LIST_NEGATIVE_TTL = 300
+    # Events the DVM published and job requests it received are indexed by id (see EventIndex), so zaps are matched
+    # to their jobs without fetching both events from the relays. Indexed events older than this are removed.
+    EVENT_INDEX_MAX_AGE = 172800
+    # Encryption keys (NIP-04 and NIP-44) are derived once per user and kept for this many users (see CryptoContext)
+    CONVERSATION_KEY_CACHE_SIZE = 1000
     RELAY_TIMEOUT = 5
     RELAY_LONG_TIMEOUT = 30
     EXTERNAL_POST_PROCESS_TYPE = 0  # Leave this on None, except the DVM is external
@@ -53,6 +71,18 @@ class DVMConfig:
     LNBITS_ADMIN_KEY = ''  # In order to pay invoices, e.g. from the bot to DVMs, or reimburse users.
     LNBITS_URL = 'https://lnbits.com'
     PROVIDE_INVOICE = True
+    # Invoices are checked with an exponential backoff based on their age (in seconds).
+    PAYMENT_CHECK_MIN_INTERVAL = 1
+    PAYMENT_CHECK_MAX_INTERVAL = 60
+    PAYMENT_CHECK_BACKOFF_AGE = 60
+    # If set, LNbits notifies us on this (public) url once an invoice is paid, we listen on host:port for it.
+    # LNBITS_WEBHOOK_TOKEN is appended to the url as its last path segment, requests without it are rejected. A
+    # random token is used if it's empty. All DVMs of a process share one server per host:port, so every DVM needs
+    # its own token.
+    LNBITS_WEBHOOK_URL = ''
+    LNBITS_WEBHOOK_TOKEN = ''
+    LNBITS_WEBHOOK_HOST = '0.0.0.0'
+    LNBITS_WEBHOOK_PORT = 8899
     LN_ADDRESS = ''
     SCRIPT = ''
     IDENTIFIER = ''
@@ -71,6 +101,33 @@ class DVMConfig:
     LOGLEVEL = LogLevel.INFO
     KIND = None
 
+    # Job scheduling. Jobs are queued and processed by MAX_PARALLEL_JOBS workers. Paid jobs are served first and
+    # are never rejected, free jobs are rejected once MAX_JOBS_IN_FLIGHT jobs are queued or running.
+    MAX_PARALLEL_JOBS = 4
+    MAX_JOBS_IN_FLIGHT = 100
+    MAX_JOBS_PER_TASK = 0  # max running jobs per task, 0 = unlimited
+    MAX_JOBS_PER_USER = 2  # max running jobs per user, 0 = unlimited
+    PROCESS_IN_THREAD = False  # Run cpu bound process functions in a thread pool instead of on the event loop
+
+    # Publishing. Results, status reactions and bot messages are sent in the background by PUBLISH_WORKERS workers
+    # (see EventPublisher). Relays that fail are retried PUBLISH_MAX_RETRIES times, the first retry after
+    # PUBLISH_RETRY_BACKOFF seconds. Each relay gets at most PUBLISH_RELAY_RATE events per second (bursts of
+    # PUBLISH_RELAY_BURST), shared by all DVMs of the process.
+    PUBLISH_WORKERS = 4
+    PUBLISH_MAX_RETRIES = 3
+    PUBLISH_RETRY_BACKOFF = 2.0
+    PUBLISH_RELAY_RATE = 2.0
+    PUBLISH_RELAY_BURST = 10
+
+    # Per stage timings, job counters and gauges of the job pipeline (see metrics_utils). Off by default, when on
+    # they are served for all DVMs of the process in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+    # and as json on /metrics.json (METRICS_PORT = 0 disables the endpoint). If METRICS_DUMP_FILE is set, the metrics
+    # are written there as json when the DVM stops.
+    ENABLE_METRICS = False
+    METRICS_HOST = '127.0.0.1'
+    METRICS_PORT = 9464
+    METRICS_DUMP_FILE = ''
+
     DVM_KEY = None
     CHATBOT = None
 
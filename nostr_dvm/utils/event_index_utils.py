@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from nostr_sdk import Event
+
+from nostr_dvm.utils.nostr_utils import get_event_by_id
+
+# names of the decrypted views of an event, each decryptor has its own
+DECRYPT_JOB_TAGS = "job_tags"  # check_and_decrypt_tags, (event, use_legacy_encryption) of a received job
+DECRYPT_OWN_TAGS = "own_tags"  # check_and_decrypt_own_tags, the event of a reaction or result we published
+
+
+class EventIndex:
+    """
+    Events a DVM published (results and status reactions) and the job requests it received, by id. A zap on a
+    payment-required reaction is resolved to its job with two lookups here instead of two relay fetches.
+
+    The newest max_size events are kept in memory, together with their decrypted view once they have been
+    decrypted, so an encrypted job isn't decrypted again when its zap arrives. All events are also stored in an
+    sqlite file next to the DVM database, so zaps arriving after a restart are resolved too. Events older than
+    max_age are removed from the file. Lookups that miss the index fall back to the relays.
+    Use EventIndex.get(db_name) to get the index of a DVM.
+    """
+
+    PRUNE_INTERVAL = 1000  # adds between prunes of the file
+
+    indexes = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(db_name, max_age=172800, max_size=5000):
+        with EventIndex.lock:
+            index = EventIndex.indexes.get(db_name)
+            if index is None:
+                index = EventIndex(os.path.splitext(db_name)[0] + "_events.sqlite", max_age, max_size)
+                EventIndex.indexes[db_name] = index
+            return index
+
+    def __init__(self, path, max_age=172800, max_size=5000):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+        self.events = OrderedDict()  # event id (hex) -> Event
+        self.decrypted = {}  # event id (hex) -> {decryptor: decrypted view}, only for events in memory
+        self.adds = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._create()
+        self.prune()
+
+    def connection(self):
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, cached_statements=64)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self.local.con = con
+        return con
+
+    def _create(self):
+        con = self.connection()
+        with con:
+            con.execute(""" CREATE TABLE IF NOT EXISTS events (
+                                id TEXT PRIMARY KEY,
+                                kind INTEGER NOT NULL,
+                                created_at INTEGER NOT NULL,
+                                json TEXT NOT NULL
+                            ) WITHOUT ROWID; """)
+            con.execute("CREATE INDEX IF NOT EXISTS events_created_at ON events(created_at)")
+
+    def _remember(self, event_id, event, decrypted=None, decryptor=DECRYPT_JOB_TAGS):
+        with self.cache_lock:
+            self.events[event_id] = event
+            self.events.move_to_end(event_id)
+            if decrypted is not None:
+                self.decrypted.setdefault(event_id, {})[decryptor] = decrypted
+            while len(self.events) > self.max_size:
+                evicted, _ = self.events.popitem(last=False)
+                self.decrypted.pop(evicted, None)
+
+    def add(self, event, decrypted=None, decryptor=DECRYPT_JOB_TAGS):
+        """Index an event, decrypted is its decrypted view by decryptor (e.g. the result of check_and_decrypt_tags)
+        if known"""
+        event_id = event.id().to_hex()
+        self._remember(event_id, event, decrypted, decryptor)
+        con = self.connection()
+        with self.write_lock, con:
+            con.execute("INSERT OR IGNORE INTO events(id, kind, created_at, json) VALUES (?, ?, ?, ?)",
+                        (event_id, event.kind().as_u16(), event.created_at().as_secs(), event.as_json()))
+            self.adds += 1
+            prune = self.adds % self.PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def lookup(self, event_id):
+        """The indexed event with this id (hex), None if it isn't indexed"""
+        with self.cache_lock:
+            event = self.events.get(event_id)
+            if event is not None:
+                self.memory_hits += 1
+                return event
+        row = self.connection().execute("SELECT json FROM events WHERE id = ?", (event_id,)).fetchone()
+        if row is None:
+            return None
+        event = Event.from_json(row[0])
+        self._remember(event_id, event)
+        with self.cache_lock:
+            self.disk_hits += 1
+        return event
+
+    async def fetch(self, event_id, client, dvm_config):
+        """Like get_event_by_id, but the index is asked before the relays. Events found on the relays are added."""
+        event = self.lookup(event_id)
+        if event is not None:
+            return event
+        with self.cache_lock:
+            self.misses += 1
+        event = await get_event_by_id(event_id, client=client, config=dvm_config)
+        if event is not None and event.id().to_hex() == event_id:
+            self.add(event)
+        return event
+
+    def decrypt(self, event, decrypt, decryptor):
+        """decrypt(event), remembered per decryptor (e.g. DECRYPT_OWN_TAGS) for events in memory, so each event is
+        decrypted once by each of them"""
+        event_id = event.id().to_hex()
+        with self.cache_lock:
+            views = self.decrypted.get(event_id)
+            if views is not None and decryptor in views:
+                return views[decryptor]
+        decrypted = decrypt(event)
+        with self.cache_lock:
+            if event_id in self.events:
+                self.decrypted.setdefault(event_id, {})[decryptor] = decrypted
+        return decrypted
+
+    def prune(self):
+        """Remove the events older than max_age from the file"""
+        con = self.connection()
+        with self.write_lock, con:
+            con.execute("DELETE FROM events WHERE created_at < ?", (int(time.time() - self.max_age),))
+
+    def stats(self):
+        with self.cache_lock:
+            return {"in_memory": len(self.events), "memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses}
+
+
+def get_event_index(dvm_config):
+    return EventIndex.get(dvm_config.DB, dvm_config.EVENT_INDEX_MAX_AGE)
@@ -0,0 +1,300 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import timedelta
+
+from nostr_sdk import ClientBuilder, Options, RelayLimits, Filter, PublicKey, Timestamp, HandleNotification
+
+from nostr_dvm.utils.database_utils import get_database
+from nostr_dvm.utils.definitions import EventDefinitions
+
+
+class FollowListEntry:
+    __slots__ = ("created_at", "follows", "hex", "checked_at")
+
+    def __init__(self, created_at, follows, checked_at):
+        self.created_at = created_at  # created_at of the kind 3 event, 0 if the user has no follow list
+        self.follows = follows  # [PublicKey], None if the user has no follow list
+        self.hex = None  # follows as hex, converted on first use
+        self.checked_at = checked_at  # last time the list was known to be current, 0 if it came from the database
+
+
+class FollowListCache:
+    """
+    Follow lists (kind 3) of the users of personalized DVMs, so repeated requests of a user don't have to fetch
+    their follow list from the relays every time. One cache per relay list is shared by all DVMs of a process.
+
+    Lists are kept parsed in an LRU in memory and stored in an LMDB database. A list is fresh if it was fetched
+    less than ttl seconds ago, or if its user is part of the live kind 3 subscription that keeps the cached lists
+    up to date. Stale lists (and lists found only in the database) younger than max_stale are returned right away
+    and refreshed in the background, all other lookups wait for the relays. Concurrent lookups of the same user
+    share one fetch.
+
+    The cache runs its own connection and event loop in a background thread, DVMs call it from their own loops.
+    """
+
+    MAX_SUBSCRIBED = 5000
+    RESUBSCRIBE_INTERVAL = 30
+
+    caches = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(relays, db_name="db/follow_lists.db", ttl=600, max_stale=86400):
+        key = (db_name, tuple(sorted(relays)))
+        with FollowListCache.lock:
+            cache = FollowListCache.caches.get(key)
+            if cache is None:
+                cache = FollowListCache(relays, db_name, ttl, max_stale)
+                FollowListCache.caches[key] = cache
+            return cache
+
+    def __init__(self, relays, db_name="db/follow_lists.db", ttl=600, max_stale=86400, max_size=100000,
+                 max_time_request=5):
+        self.relays = list(relays)
+        self.db_name = db_name
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_size = max_size
+        self.timeout = timedelta(seconds=max_time_request)
+        self.subscription_id = "follow-lists-" + str(id(self))
+
+        self.cache = OrderedDict()  # user (hex) -> FollowListEntry
+        self.cache_lock = threading.Lock()
+        self.pending = {}  # user (hex) -> future of the running fetch
+        self.wanted = set()  # users that should be part of the live subscription
+        self.subscribed = set()  # users that are part of the live subscription
+        self.live = set()  # subscribed users whose cached list the subscription keeps up to date
+
+        self.database = None
+        self.client = None
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+        self.error = None  # why the background loop couldn't start
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+        self.live_updates = 0
+
+    async def start(self):
+        with self.cache_lock:
+            if self.thread is None:
+                self.started.clear()
+                self.thread = threading.Thread(target=lambda: asyncio.run(self._run()), daemon=True,
+                                               name="follow-lists")
+                self.thread.start()
+        if not self.started.is_set():
+            # the background loop connects in its own thread, don't block the event loop of the caller meanwhile
+            await asyncio.to_thread(self.started.wait)
+
+    async def _run(self):
+        cache = self
+        try:
+            self.loop = asyncio.get_running_loop()
+            self.database = get_database(self.db_name)
+            # received kind 3 events are stored in the database by the client
+            self.client = ClientBuilder().database(self.database).opts(
+                Options().relay_limits(RelayLimits.disable())).build()
+            for relay in self.relays:
+                await self.client.add_relay(relay)
+            await self.client.connect()
+            self.error = None
+        except Exception as e:
+            print("Follow list cache couldn't connect: " + str(e))
+            self._stopped(e)
+            return
+        finally:
+            self.started.set()
+
+        class FollowListHandler(HandleNotification):
+            async def handle(self, relay_url, subscription_id, event):
+                if subscription_id == cache.subscription_id and \
+                        event.kind().as_u16() == EventDefinitions.KIND_FOLLOW_LIST.as_u16():
+                    if cache._update(event, time.time()):
+                        cache.live_updates += 1
+
+            async def handle_msg(self, relay_url, msg):
+                return
+
+        asyncio.create_task(self.client.handle_notifications(FollowListHandler()))
+        while True:
+            await asyncio.sleep(self.RESUBSCRIBE_INTERVAL)
+            try:
+                await self._resubscribe()
+            except Exception as e:
+                print("Follow list subscription failed: " + str(e))
+
+    async def _resubscribe(self):
+        now = time.time()
+        with self.cache_lock:
+            if self.wanted == self.subscribed:
+                return
+            # the most recently used users, the subscription catches up on the ttl before it
+            users = [user for user in reversed(self.cache) if user in self.wanted][:self.MAX_SUBSCRIBED]
+            live = {user for user in users if now - self.cache[user].checked_at < self.ttl}
+            self.wanted = set(users)
+        if len(users) == 0:
+            await self.client.unsubscribe(self.subscription_id)
+        else:
+            filter = Filter().authors([PublicKey.parse(user) for user in users]) \
+                .kind(EventDefinitions.KIND_FOLLOW_LIST).since(Timestamp.from_secs(int(now - self.ttl)))
+            await self.client.subscribe_with_id(self.subscription_id, filter)
+        with self.cache_lock:
+            self.subscribed = set(users)
+            self.live = live
+
+    def _update(self, event, now):
+        """Store a kind 3 event if it's newer than the cached list, returns True if the list changed"""
+        user = event.author().to_hex()
+        created_at = event.created_at().as_secs()
+        with self.cache_lock:
+            entry = self.cache.get(user)
+            if entry is not None and entry.created_at >= created_at:
+                if entry.created_at == created_at:
+                    entry.checked_at = max(entry.checked_at, now)
+                return False
+        self._set(user, FollowListEntry(created_at, event.tags().public_keys(), now))
+        return True
+
+    def _set(self, user, entry):
+        with self.cache_lock:
+            self.cache[user] = entry
+            self.cache.move_to_end(user)
+            while len(self.cache) > self.max_size:
+                evicted, _ = self.cache.popitem(last=False)
+                self.wanted.discard(evicted)
+
+    async def _fetch(self, user):
+        try:
+            now = time.time()
+            events = await self.client.fetch_events(Filter().author(PublicKey.parse(user))
+                                                    .kind(EventDefinitions.KIND_FOLLOW_LIST), self.timeout)
+            newest = None
+            for event in events.to_vec():
+                if newest is None or event.created_at().as_secs() > newest.created_at().as_secs():
+                    newest = event
+            if newest is not None:
+                self._update(newest, now)
+            else:
+                with self.cache_lock:
+                    known = self.cache.get(user)
+                if known is None or known.follows is None:
+                    self._set(user, FollowListEntry(0, None, now))
+            with self.cache_lock:
+                self.wanted.add(user)
+        finally:
+            with self.cache_lock:
+                self.pending.pop(user, None)
+
+    def _stopped(self, error):
+        """The background loop is gone: fail the running fetches, the next lookup starts a new loop"""
+        with self.cache_lock:
+            self.error = error
+            self.loop = None
+            self.thread = None
+            pending = self.pending
+            self.pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def _refresh(self, user):
+        """Fetch the list of user in the background, returns a future that is done once it's cached"""
+        with self.cache_lock:
+            future = self.pending.get(user)
+            if future is None:
+                if self.loop is None:
+                    future = Future()
+                    future.set_exception(self.error if self.error is not None
+                                         else RuntimeError("follow list cache isn't running"))
+                    return future
+                future = asyncio.run_coroutine_threadsafe(self._fetch(user), self.loop)
+                self.pending[user] = future
+        return future
+
+    async def _from_database(self, user):
+        events = await self.database.query(Filter().author(PublicKey.parse(user))
+                                           .kind(EventDefinitions.KIND_FOLLOW_LIST))
+        newest = None
+        for event in events.to_vec():
+            if newest is None or event.created_at().as_secs() > newest.created_at().as_secs():
+                newest = event
+        if newest is None:
+            return None
+        entry = FollowListEntry(newest.created_at().as_secs(), newest.tags().public_keys(), 0)
+        self._set(user, entry)
+        return entry
+
+    def _is_fresh(self, user, entry, now):
+        return now - entry.checked_at < self.ttl or user in self.live
+
+    async def get_follows(self, user):
+        """[PublicKey] the user (hex or npub) follows, None if no follow list was found"""
+        entry = await self._lookup(user)
+        return entry.follows if entry is not None else None
+
+    async def get_follows_hex(self, user):
+        """[hex] the user (hex or npub) follows, None if no follow list was found"""
+        entry = await self._lookup(user)
+        if entry is None or entry.follows is None:
+            return None
+        if entry.hex is None:
+            entry.hex = [pk.to_hex() for pk in entry.follows]
+        return entry.hex
+
+    async def _lookup(self, user):
+        # users can be given as PublicKey, hex or npub, the cache is keyed by hex like the events
+        if isinstance(user, PublicKey):
+            user = user.to_hex()
+        else:
+            user = PublicKey.parse(user).to_hex()
+        await self.start()
+        now = time.time()
+        with self.cache_lock:
+            entry = self.cache.get(user)
+            if entry is not None:
+                self.cache.move_to_end(user)
+                self.wanted.add(user)
+                if self._is_fresh(user, entry, now):
+                    self.hits += 1
+                    return entry
+
+        if entry is None:
+            entry = await self._from_database(user)
+            if entry is not None:
+                with self.cache_lock:
+                    self.database_hits += 1
+                self._refresh(user)
+                return entry
+        elif entry.checked_at == 0 or now - entry.checked_at < self.max_stale:
+            with self.cache_lock:
+                self.stale_hits += 1
+            self._refresh(user)
+            return entry
+
+        with self.cache_lock:
+            self.misses += 1
+        try:
+            await asyncio.wrap_future(self._refresh(user))
+        except Exception as e:
+            print("Couldn't fetch follow list of " + user + ": " + str(e))
+        with self.cache_lock:
+            return self.cache.get(user, entry)
+
+    def stats(self):
+        with self.cache_lock:
+            lookups = self.hits + self.stale_hits + self.database_hits + self.misses
+            return {"cached": len(self.cache), "live": len(self.live), "hits": self.hits,
+                    "stale_hits": self.stale_hits, "database_hits": self.database_hits, "misses": self.misses,
+                    "live_updates": self.live_updates,
+                    "hit_rate": (lookups - self.misses) / lookups if lookups > 0 else 0.0}
+
+
+def get_follow_list_cache(dvm_config):
+    return FollowListCache.get(dvm_config.SYNC_DB_RELAY_LIST, dvm_config.FOLLOW_LIST_DB, dvm_config.FOLLOW_LIST_TTL,
+                               dvm_config.FOLLOW_LIST_MAX_STALE)
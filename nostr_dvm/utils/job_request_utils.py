@@ -0,0 +1,185 @@
+from nostr_sdk import Tag
+
+
+class ParsedTag:
+    """A tag whose values were read once, as_vec() doesn't call into nostr_sdk again"""
+    __slots__ = ("vec", "_tag")
+
+    def __init__(self, vec, tag=None):
+        self.vec = vec
+        self._tag = tag
+
+    @property
+    def tag(self):
+        """The nostr_sdk Tag, for building events. Decrypted tags are only parsed into one here."""
+        if self._tag is None:
+            self._tag = Tag.parse(self.vec)
+        return self._tag
+
+    def as_vec(self):
+        return self.vec
+
+
+class ParsedTags:
+    __slots__ = ("tags",)
+
+    def __init__(self, tags):
+        self.tags = tags
+
+    def to_vec(self):
+        return list(self.tags)
+
+
+class ParsedEvent:
+    """
+    Stands in for the event of a JobRequest where an Event is expected (e.g. create_request_from_nostr_event):
+    tags() returns the parsed tags, everything else is taken from the event. Don't pass it to nostr_sdk functions
+    that take an Event, use request.event for these.
+    """
+    __slots__ = ("request",)
+
+    def __init__(self, request):
+        self.request = request
+
+    def tags(self):
+        return ParsedTags(self.request.tags)
+
+    def content(self):
+        # the content of an encrypted request are its tags
+        if self.request.decrypted:
+            return ""
+        return self.request.event.content()
+
+    def __getattr__(self, name):
+        return getattr(self.request.event, name)
+
+
+class JobRequest:
+    """
+    The tags of a NIP90 job request, parsed once. Every layer of the pipeline used to walk event.tags() on its
+    own, and every tag.as_vec() call goes through the nostr_sdk bindings.
+
+    Use JobRequest.of(event): the request is built on first use and kept on the event object, so all later calls
+    with the same event return it without parsing again. For encrypted requests check_and_decrypt_tags keeps the
+    request with the decrypted tags on the event. Functions that accept a request also accept the event,
+    JobRequest.of(request) returns the request itself.
+    """
+    __slots__ = ("event", "id", "author", "kind", "created_at", "tags", "inputs", "params", "output", "p", "relays",
+                 "bid", "cashu", "expiration", "client", "encrypted", "job", "decrypted", "legacy_encryption",
+                 "_parsed_event")
+
+    def __init__(self, event, tags=None):
+        """tags: the tags as lists, instead of the tags of the event (e.g. the decrypted tags)"""
+        self.event = event
+        self.id = event.id().to_hex()
+        self.author = event.author().to_hex()
+        self.kind = event.kind().as_u16()
+        self.created_at = event.created_at().as_secs()
+        self.tags = []
+        self.inputs = []  # i tags as lists: ["i", value, type, (relay), (marker)]
+        self.params = {}  # param name -> values of its param tag
+        self.output = None
+        self.p = ""
+        self.relays = []
+        self.bid = None
+        self.cashu = ""
+        self.expiration = None
+        self.client = None
+        self.encrypted = False
+        self.job = None  # j tag, names the task of generic requests
+        self.decrypted = False
+        self.legacy_encryption = False  # the request was encrypted with NIP-04
+        self._parsed_event = None
+
+        if tags is None:
+            tags = [ParsedTag(tag.as_vec(), tag) for tag in event.tags().to_vec()]
+        else:
+            tags = [ParsedTag(vec) for vec in tags]
+        for tag in tags:
+            vec = tag.vec
+            self.tags.append(tag)
+            if len(vec) == 0:
+                continue
+            name = vec[0]
+            if name == "i":
+                self.inputs.append(vec)
+            elif name == "param":
+                if len(vec) > 1:
+                    self.params[vec[1]] = vec[2:]
+            elif name == "output":
+                if len(vec) > 1:
+                    self.output = vec[1]
+            elif name == "p":
+                if len(vec) > 1:
+                    self.p = vec[1]
+            elif name == "relays":
+                if len(self.relays) == 0:
+                    self.relays = vec[1:]
+            elif name == "bid":
+                if len(vec) > 1:
+                    self.bid = vec[1]
+            elif name == "cashu":
+                if len(vec) > 1:
+                    self.cashu = vec[1]
+            elif name == "expiration":
+                if len(vec) > 1:
+                    self.expiration = vec[1]
+            elif name == "client":
+                if len(vec) > 1:
+                    self.client = vec[1]
+            elif name == "encrypted":
+                self.encrypted = True
+            elif name == "j":
+                if len(vec) > 1 and self.job is None:
+                    self.job = vec[1]
+
+    @staticmethod
+    def of(event):
+        if isinstance(event, JobRequest):
+            return event
+        if isinstance(event, ParsedEvent):
+            return event.request
+        request = getattr(event, "_job_request", None)
+        if request is None:
+            request = JobRequest(event)
+            try:
+                event._job_request = request
+            except AttributeError:
+                pass
+        return request
+
+    @staticmethod
+    def decrypted_from(event, tags, legacy_encryption=False):
+        """The request with the decrypted tags of an encrypted event, kept on the event like JobRequest.of"""
+        request = JobRequest(event, tags)
+        request.decrypted = True
+        request.legacy_encryption = legacy_encryption
+        try:
+            event._job_request = request
+        except AttributeError:
+            pass
+        return request
+
+    @property
+    def parsed_event(self):
+        """The event with parsed tags, for hooks that take an event (see ParsedEvent)"""
+        if self._parsed_event is None:
+            self._parsed_event = ParsedEvent(self)
+        return self._parsed_event
+
+    def param(self, name, default=None):
+        """First value of a param tag"""
+        values = self.params.get(name)
+        if values is None or len(values) == 0:
+            return default
+        return values[0]
+
+    def tag(self, name):
+        """The first tag (a ParsedTag) with this name, None if there is none"""
+        for tag in self.tags:
+            if len(tag.vec) > 0 and tag.vec[0] == name:
+                return tag
+        return None
+
+    def tags_named(self, name):
+        return [tag for tag in self.tags if len(tag.vec) > 0 and tag.vec[0] == name]
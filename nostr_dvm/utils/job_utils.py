@@ -0,0 +1,104 @@
+import heapq
+
+
+class JobRegistry:
+    """
+    Keeps track of jobs (e.g. JobToWatch, RequiredJobToWatch or the bot's job entries) keyed by event id.
+
+    Lookups by id, payment hash and author are O(1), expired jobs are removed in O(log n) via a heap.
+    Iterating over the registry works on a snapshot, so jobs can be removed while iterating.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.authors = {}
+        self.payment_hashes = {}
+        self.by_payment_hash = {}
+        self.by_author = {}
+        self.expires = {}
+        self.expiry_heap = []
+
+    def add(self, key, job, author=None, payment_hash=None, expires=None):
+        if key in self.jobs:
+            self.remove(key)
+        self.jobs[key] = job
+        if author is not None:
+            self.authors[key] = author
+            self.by_author.setdefault(author, set()).add(key)
+        if payment_hash is not None and payment_hash != "":
+            self.payment_hashes[key] = payment_hash
+            self.by_payment_hash[payment_hash] = key
+        if expires is not None:
+            self.expires[key] = expires
+            heapq.heappush(self.expiry_heap, (expires, key))
+        return job
+
+    def get(self, key):
+        return self.jobs.get(key)
+
+    def get_by_payment_hash(self, payment_hash):
+        key = self.by_payment_hash.get(payment_hash)
+        if key is None:
+            return None
+        return self.jobs.get(key)
+
+    def get_by_author(self, author):
+        return [self.jobs[key] for key in self.by_author.get(author, ())]
+
+    def set_payment_hash(self, key, payment_hash):
+        old_hash = self.payment_hashes.pop(key, None)
+        if old_hash is not None:
+            self.by_payment_hash.pop(old_hash, None)
+        if payment_hash is not None and payment_hash != "":
+            self.payment_hashes[key] = payment_hash
+            self.by_payment_hash[payment_hash] = key
+
+    def set_expiry(self, key, expires):
+        # old heap entries are skipped lazily when they are popped
+        self.expires[key] = expires
+        heapq.heappush(self.expiry_heap, (expires, key))
+
+    def remove(self, key):
+        job = self.jobs.pop(key, None)
+        if job is None:
+            return None
+        author = self.authors.pop(key, None)
+        if author is not None:
+            keys = self.by_author.get(author)
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.by_author[author]
+        payment_hash = self.payment_hashes.pop(key, None)
+        if payment_hash is not None:
+            self.by_payment_hash.pop(payment_hash, None)
+        self.expires.pop(key, None)
+        return job
+
+    def pop_expired(self, now):
+        """Remove and return all jobs that expired before now."""
+        expired = []
+        while len(self.expiry_heap) > 0 and self.expiry_heap[0][0] < now:
+            expires, key = heapq.heappop(self.expiry_heap)
+            if self.expires.get(key) != expires:
+                # job was removed or its expiry changed in the meantime
+                continue
+            expired.append(self.remove(key))
+        if len(self.expiry_heap) > 2 * len(self.expires) + 64:
+            self.expiry_heap = [(expires, key) for key, expires in self.expires.items()]
+            heapq.heapify(self.expiry_heap)
+        return expired
+
+    def items(self):
+        return list(self.jobs.items())
+
+    def values(self):
+        return list(self.jobs.values())
+
+    def __contains__(self, key):
+        return key in self.jobs
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(list(self.jobs.values()))
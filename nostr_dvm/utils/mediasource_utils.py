@@ -6,6 +6,7 @@ from urllib.parse import urlparse
 import ffmpegio
 import requests
 
+from nostr_dvm.utils.job_request_utils import JobRequest
 from nostr_dvm.utils.nostr_utils import get_event_by_id
 from nostr_dvm.utils.scrapper.media_scrapper import YTDownload, get_media_duration
 
@@ -18,11 +19,10 @@ async def input_data_file_duration(event, dvm_config, client, start=0, end=0):
     input_value = ""
     input_type = ""
     count = 0
-    for tag in event.tags().to_vec():
-        if tag.as_vec()[0] == 'i':
-            input_value = tag.as_vec()[1]
-            input_type = tag.as_vec()[2]
-            count = count + 1
+    for input_tag in JobRequest.of(event).inputs:
+        input_value = input_tag[1]
+        input_type = input_tag[2]
+        count = count + 1
 
     if input_type == "text":
         return len(input_value)
@@ -0,0 +1,292 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of the latency histograms in seconds, relay round trips up to long running jobs
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+HELP = {
+    "dvm_stage_seconds": "Time spent in a stage of the job pipeline",
+    "dvm_stage_errors_total": "Stages that ended with an exception",
+    "dvm_jobs_received_total": "Job requests for a supported task",
+    "dvm_jobs_paid_total": "Jobs that were paid (or free) and scheduled",
+    "dvm_jobs_processed_total": "Jobs whose result was sent",
+    "dvm_jobs_failed_total": "Jobs that failed",
+    "dvm_job_list_size": "Jobs waiting for payment or results",
+    "dvm_jobs_on_hold": "Jobs waiting for their input jobs",
+    "dvm_jobs_in_flight": "Jobs queued or running in the scheduler",
+    "dvm_pending_invoices": "Invoices watched by the payment watcher",
+    "dvm_publish_queue": "Events waiting to be published",
+}
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Span:
+    """Times a stage of the pipeline: with metrics.span("process", task=task): ..."""
+    __slots__ = ("metrics", "stage", "labels", "start")
+
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe("dvm_stage_seconds", time.perf_counter() - self.start, stage=self.stage, **self.labels)
+        if exc_type is not None:
+            self.metrics.inc("dvm_stage_errors_total", stage=self.stage, **self.labels)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullMetrics:
+    """Used when metrics are disabled, every call is a no-op"""
+    enabled = False
+
+    def span(self, stage, **labels):
+        return NULL_SPAN
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set_gauge(self, name, value, **labels):
+        pass
+
+    def gauge(self, name, function):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of one DVM, labeled with its name. Stages of the job pipeline are
+    timed with span(), gauges can be given as functions that are only evaluated when the metrics are exported.
+
+    All DVMs of a process with ENABLE_METRICS share one MetricsServer that serves the metrics in the Prometheus
+    text format on /metrics and as json on /metrics.json. If metrics are disabled, get_metrics returns a
+    NullMetrics, so instrumented code only pays for a method call.
+    """
+
+    registries = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(name):
+        with Metrics.lock:
+            metrics = Metrics.registries.get(name)
+            if metrics is None:
+                metrics = Metrics(name)
+                Metrics.registries[name] = metrics
+            return metrics
+
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.gauge_functions = {}  # name -> function returning the current value
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def span(self, stage, **labels):
+        return Span(self, stage, labels)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def gauge(self, name, function):
+        with self.lock:
+            self.gauge_functions[name] = function
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(LATENCY_BUCKETS)
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    def snapshot(self):
+        """(counters, gauges, histograms) with the dvm label added, histograms as (buckets, counts, sum, count)"""
+        dvm = (("dvm", self.name),)
+        gauges = {}
+        for name, function in list(self.gauge_functions.items()):
+            try:
+                gauges[(name, dvm)] = function()
+            except Exception as e:
+                print("[" + self.name + "] Metrics: gauge " + name + " failed: " + str(e))
+        with self.lock:
+            counters = {(name, dvm + labels): value for (name, labels), value in self.counters.items()}
+            gauges.update({(name, dvm + labels): value for (name, labels), value in self.gauges.items()})
+            histograms = {(name, dvm + labels): (histogram.buckets, list(histogram.counts), histogram.sum,
+                                                 histogram.count)
+                          for (name, labels), histogram in self.histograms.items()}
+        return counters, gauges, histograms
+
+
+def _all_snapshots():
+    with Metrics.lock:
+        registries = list(Metrics.registries.values())
+    counters, gauges, histograms = {}, {}, {}
+    for metrics in registries:
+        c, g, h = metrics.snapshot()
+        counters.update(c)
+        gauges.update(g)
+        histograms.update(h)
+    return counters, gauges, histograms
+
+
+def _labels(labels, extra=()):
+    labels = labels + extra
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                          for key, value in labels) + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound is None else repr(float(bound))
+
+
+def to_prometheus():
+    """All metrics of the process in the Prometheus text exposition format"""
+    counters, gauges, histograms = _all_snapshots()
+    lines = []
+    for samples, metric_type in [(counters, "counter"), (gauges, "gauge")]:
+        for name in sorted({name for name, labels in samples}):
+            lines.append("# HELP " + name + " " + HELP.get(name, name))
+            lines.append("# TYPE " + name + " " + metric_type)
+            for (sample_name, labels), value in sorted(samples.items()):
+                if sample_name == name:
+                    lines.append(name + _labels(labels) + " " + repr(float(value)))
+    for name in sorted({name for name, labels in histograms}):
+        lines.append("# HELP " + name + " " + HELP.get(name, name))
+        lines.append("# TYPE " + name + " histogram")
+        for (sample_name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            if sample_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + [None], counts):
+                cumulative += bucket_count
+                lines.append(name + "_bucket" + _labels(labels, (("le", _format_bound(bound)),)) + " " +
+                             str(cumulative))
+            lines.append(name + "_sum" + _labels(labels) + " " + repr(total))
+            lines.append(name + "_count" + _labels(labels) + " " + str(count))
+    return "\n".join(lines) + "\n"
+
+
+def to_json():
+    """All metrics of the process as a dict, histograms with their (non cumulative) bucket counts"""
+    counters, gauges, histograms = _all_snapshots()
+    result = {"counters": [], "gauges": [], "histograms": []}
+    for (name, labels), value in sorted(counters.items()):
+        result["counters"].append({"name": name, "labels": dict(labels), "value": value})
+    for (name, labels), value in sorted(gauges.items()):
+        result["gauges"].append({"name": name, "labels": dict(labels), "value": value})
+    for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+        result["histograms"].append({"name": name, "labels": dict(labels), "buckets": list(buckets),
+                                     "counts": counts, "sum": total, "count": count,
+                                     "mean": total / count if count > 0 else 0.0})
+    return result
+
+
+def dump_metrics(path):
+    with open(path, "w") as f:
+        json.dump(to_json(), f, indent=2)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body = to_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(to_json()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class MetricsServer:
+    """One http server per process for the metrics of all DVMs, running in a background thread"""
+
+    servers = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def start(host, port):
+        with MetricsServer.lock:
+            if (host, port) in MetricsServer.servers:
+                return MetricsServer.servers[(host, port)]
+            try:
+                server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+            except OSError as e:
+                print("Metrics server couldn't listen on " + host + ":" + str(port) + ": " + str(e))
+                return None
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+            MetricsServer.servers[(host, port)] = server
+            print("Serving metrics on http://" + host + ":" + str(port) + "/metrics")
+            return server
+
+
+def get_metrics(dvm_config):
+    """The metrics of a DVM, a NullMetrics if ENABLE_METRICS is off"""
+    if not dvm_config.ENABLE_METRICS:
+        return NullMetrics()
+    if dvm_config.METRICS_PORT:
+        MetricsServer.start(dvm_config.METRICS_HOST, dvm_config.METRICS_PORT)
+    return Metrics.get(dvm_config.NIP89.NAME)
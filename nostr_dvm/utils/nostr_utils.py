@@ -5,11 +5,15 @@ from pathlib import Path
 from typing import List
 
 import dotenv
-from nostr_sdk import Filter, Client, Alphabet, EventId, Event, PublicKey, Tag, Keys, nip04_decrypt, nip44_decrypt,  Metadata, Options, \
+from nostr_sdk import Filter, Client, Alphabet, EventId, Event, PublicKey, Tag, Keys, nip04_encrypt,  Metadata, Options, \
     Nip19Event, SingleLetterTag, RelayLimits, SecretKey, Connection, ConnectionTarget, \
     EventBuilder, Kind, ClientBuilder, SendEventOutput, NostrSigner
 
+from nostr_dvm.utils.crypto_utils import get_crypto_context
 from nostr_dvm.utils.definitions import EventDefinitions, relay_timeout
+from nostr_dvm.utils.job_request_utils import JobRequest
+from nostr_dvm.utils.relay_list_utils import get_relay_list_cache, parse_read_relays
+from nostr_dvm.utils.relay_pool_utils import get_outbox_relay_pool
 
 
 async def get_event_by_id(event_id_str: str, client: Client, config=None) -> Event | None:
@@ -111,15 +115,8 @@ async def get_inbox_relays(event_to_send: Event, client: Client, dvm_config):
         return []
     else:
         nip65event = events.to_vec()[0]
-        relays = []
-        for tag in nip65event.tags().to_vec():
-            if ((tag.as_vec()[0] == 'r' and len(tag.as_vec()) == 2)
-                    or ((tag.as_vec()[0] == 'r' and len(tag.as_vec()) == 3) and tag.as_vec()[2] == "read")):
-                rtag = tag.as_vec()[1]
-                if rtag.rstrip("/") not in dvm_config.AVOID_OUTBOX_RELAY_LIST:
-                    if rtag.startswith("ws") and " " not in rtag:
-                        relays.append(rtag)
-        return relays
+        return [relay for relay in parse_read_relays(nip65event)
+                if relay.rstrip("/") not in dvm_config.AVOID_OUTBOX_RELAY_LIST]
 
 
 async def get_dm_relays(event_to_send: Event, client: Client, dvm_config):
@@ -175,7 +172,7 @@ async def get_main_relays(event_to_send: Event, client: Client, dvm_config):
             return []
 
 
-async def send_event_outbox(event: Event, client, dvm_config) -> SendEventOutput | None:
+async def get_outbox_relays(event: Event, client, dvm_config):
     # 1. OK, Let's overcomplicate things.
     # 2. If our event has a relays tag, we just send the event to these relay in the classical way.
     relays = dvm_config.RELAY_LIST
@@ -193,11 +190,15 @@ async def send_event_outbox(event: Event, client, dvm_config) -> SendEventOutput
             break
 
     #print(relays)
-    # 3. If we couldn't find relays, we look in the receivers inbox
+    # 3. If we couldn't find relays, we look in the receivers inbox. Relay lists are cached (see RelayListCache),
+    # so the lookup only goes to the relays for receivers we haven't seen for a while.
+    relay_list_cache = get_relay_list_cache(dvm_config)
+    receivers = [tag.as_vec()[1] for tag in event.tags().to_vec() if tag.as_vec()[0] == 'p' and len(tag.as_vec()) > 1]
     inbox_relays = []
     if relays == dvm_config.RELAY_LIST:
         print("[" + dvm_config.NIP89.NAME + "] No relay tags found, replying to inbox relays")
-        inbox_relays = await get_inbox_relays(event, client, dvm_config)
+        inbox_relays = [relay for relay in await relay_list_cache.get_inbox_relays(receivers, client)
+                        if relay.rstrip("/") not in dvm_config.AVOID_OUTBOX_RELAY_LIST]
         relays = list(set(relays + inbox_relays))
 
    # print(relays)
@@ -205,31 +206,33 @@ async def send_event_outbox(event: Event, client, dvm_config) -> SendEventOutput
     # 4. If we don't find inbox relays (e.g. because the user didn't announce them, we just send to our default relays
     if relays == dvm_config.RELAY_LIST and dvm_config != inbox_relays:
         print("[" + dvm_config.NIP89.NAME + "] No Inbox found, replying to generic relays")
-        main_relays = await get_main_relays(event, client, dvm_config)
+        main_relays = [relay for relay in await relay_list_cache.get_legacy_relays(receivers, client)
+                       if relay.rstrip("/") not in dvm_config.AVOID_OUTBOX_RELAY_LIST]
         relays = list(set(relays + main_relays))
+    return relays
+
+
+async def get_fallback_relays(event: Event, relays, client, dvm_config):
+    # the relays we tried plus the generic relays of the receivers, for events no relay accepted
+    receivers = [tag.as_vec()[1] for tag in event.tags().to_vec() if tag.as_vec()[0] == 'p' and len(tag.as_vec()) > 1]
+    main_relays = [relay for relay in await get_relay_list_cache(dvm_config).get_legacy_relays(receivers, client)
+                   if relay.rstrip("/") not in dvm_config.AVOID_OUTBOX_RELAY_LIST]
+    return list(set(relays + main_relays))
+
 
+async def send_event_outbox(event: Event, client, dvm_config) -> SendEventOutput | None:
+    relays = await get_outbox_relays(event, client, dvm_config)
 
-        # 5. Otherwise, we create a new Outbox client with the inbox relays and send the event there
-    relaylimits = RelayLimits.disable()
-    connection = Connection().addr("127.0.0.1:9050").target(ConnectionTarget.ONION)
-    opts = Options().relay_limits(relaylimits).connection(connection)
-    sk = SecretKey.parse(dvm_config.PRIVATE_KEY)
-    keys = Keys.parse(sk.to_hex())
-    outboxclient = ClientBuilder().signer(NostrSigner.keys(keys)).opts(opts).build()
+    # 5. Otherwise, we send the event to the inbox relays, using the warm connections of the outbox relay pool
+    outbox_pool = get_outbox_relay_pool(dvm_config)
     #print("[" + dvm_config.NIP89.NAME + "] Receiver Inbox relays: " + str(relays))
 
     for relay in relays[:5]:
-        try:
-            if not relay.startswith("ws://") and not relay.startswith("wss://"):
-                raise Exception("wrong Scheme")
-            await outboxclient.add_relay(relay)
-        except:
+        if not relay.startswith("ws://") and not relay.startswith("wss://"):
             print("[" + dvm_config.NIP89.NAME + "] " + relay + " couldn't be added to outbox relays")
-    #
-    await outboxclient.connect()
     try:
         #print("Connected, sending event")
-        event_response = await outboxclient.send_event(event)
+        event_response = await outbox_pool.send_event_to(relays[:5], event)
 
     except Exception as e:
         event_response = None
@@ -237,28 +240,16 @@ async def send_event_outbox(event: Event, client, dvm_config) -> SendEventOutput
 
     # 5. Fallback, if we couldn't send the event to any relay, we try to send to generic relays instead.
     if event_response is None:
-        main_relays = await get_main_relays(event, client, dvm_config)
-        relays = list(set(relays + main_relays))
+        relays = await get_fallback_relays(event, relays, client, dvm_config)
         if len(relays) == 0:
             return None
-        for relay in relays:
-            try:
-                if not relay.startswith("ws://") and not relay.startswith("wss://"):
-                    raise Exception("wrong Scheme")
-                await outboxclient.add_relay(relay)
-            except:
-                print("[" + dvm_config.NIP89.NAME + "] " + relay + " couldn't be added to outbox relays")
         try:
-            await outboxclient.connect()
-            event_response = await outboxclient.send_event(event)
+            event_response = await outbox_pool.send_event_to(relays, event)
         except Exception as e:
             # Love yourself then.
             event_response = None
             print(e)
 
-
-    await outboxclient.shutdown()
-
     return event_response
 
 
@@ -284,13 +275,9 @@ async def send_event(event: Event, client: Client, dvm_config, broadcast=False):
         if len(relays) == 0:
             relays = relay_list
 
-        for relay in relays:
-            if relay not in dvm_config.RELAY_LIST:
-                try:
-                    await client.add_relay(relay)
-                except:
-                    print("[" + dvm_config.NIP89.NAME + "] " + relay + " couldn't be added to relays")
-
+        # the client may be shared by all DVMs of the process, so its relays aren't changed per event. Relays
+        # outside our relay list are reached through the outbox relay pool instead.
+        extra_relays = [relay for relay in relays if relay not in dvm_config.RELAY_LIST]
 
         await client.connect()
 
@@ -300,32 +287,46 @@ async def send_event(event: Event, client: Client, dvm_config, broadcast=False):
             print(e)
             response_status = None
 
-        for relay in relays:
-            if relay not in dvm_config.RELAY_LIST:
-                await client.force_remove_relay(relay)
+        if len(extra_relays) > 0:
+            try:
+                extra_status = await get_outbox_relay_pool(dvm_config).send_event_to(extra_relays, event)
+            except Exception as e:
+                print("[" + dvm_config.NIP89.NAME + "] " + str(extra_relays) + " couldn't be reached: " + str(e))
+                extra_status = None
+            response_status = merge_send_results(response_status, extra_status)
         return response_status
     except Exception as e:
         print(e)
 
 
+def merge_send_results(first: SendEventOutput | None, second: SendEventOutput | None) -> SendEventOutput | None:
+    if first is None or second is None:
+        return first if second is None else second
+    success = list(dict.fromkeys([str(relay) for relay in first.success + second.success]))
+    failed = {str(relay): error for relay, error in list(first.failed.items()) + list(second.failed.items())
+              if str(relay) not in success}
+    return SendEventOutput(id=first.id, success=success, failed=failed)
+
+
 def print_send_result(response_status):
     print("Success: " + str(response_status.success) + " Failed: " + str(response_status.failed) + " EventID: "
           + response_status.id.to_hex() + " / " + response_status.id.to_bech32())
 
 
 def check_and_decrypt_tags(event, dvm_config):
-    is_encrypted = False
+    """
+    Returns (event, True if it was encrypted with NIP-04). For encrypted requests the event is a view of the
+    received event with the decrypted tags (see JobRequest), None if it can't be decrypted by this DVM.
+    """
     use_legacy_encryption = False
 
     try:
-        p = ""
-        for tag in event.tags().to_vec():
-            if tag.as_vec()[0] == 'encrypted':
-                is_encrypted = True
-            elif tag.as_vec()[0] == 'p':
-                p = tag.as_vec()[1]
+        request = JobRequest.of(event)
+        if request.decrypted:
+            return request.parsed_event, request.legacy_encryption
 
-        if is_encrypted:
+        if request.encrypted:
+            p = request.p
             if p != dvm_config.PUBLIC_KEY:
                 print("[" + dvm_config.NIP89.NAME + "] Task encrypted and not addressed to this DVM, "
                                                     "skipping..")
@@ -333,24 +334,16 @@ def check_and_decrypt_tags(event, dvm_config):
 
             elif p == dvm_config.PUBLIC_KEY:
                 try:
-                    tags_str = nip04_decrypt(Keys.parse(dvm_config.PRIVATE_KEY).secret_key(),
-                                             event.author(), event.content())
-                except:
-                    try:
-                        tags_str = nip44_decrypt(Keys.parse(dvm_config.PRIVATE_KEY).secret_key(),
-                                                 event.author(), event.content())
-                    except:
-                        print("Wrong Nip44 Format")
-                        return None, False
-                    use_legacy_encryption = True
+                    tags_str, use_legacy_encryption = get_crypto_context(dvm_config).decrypt(event.author(),
+                                                                                             event.content())
+                except ValueError:
+                    print("Wrong Nip44 Format")
+                    return None, False
 
                 params = json.loads(tags_str)
-                params.append(Tag.parse(["p", p]).as_vec())
-                params.append(Tag.parse(["encrypted"]).as_vec())
-                event_as_json = json.loads(event.as_json())
-                event_as_json['tags'] = params
-                event_as_json['content'] = ""
-                event = Event.from_json(json.dumps(event_as_json))
+                params.append(["p", p])
+                params.append(["encrypted"])
+                event = JobRequest.decrypted_from(event, params, use_legacy_encryption).parsed_event
     except Exception as e:
         print(e)
 
@@ -359,34 +352,23 @@ def check_and_decrypt_tags(event, dvm_config):
 
 def check_and_decrypt_own_tags(event, dvm_config):
     try:
-        is_encrypted = False
-        p = ""
-        for tag in event.tags().to_vec():
-            if tag.as_vec()[0] == 'encrypted':
-                is_encrypted = True
-            elif tag.as_vec()[0] == 'p':
-                p = tag.as_vec()[1]
+        request = JobRequest.of(event)
+        if request.decrypted:
+            return request.parsed_event
 
-        if is_encrypted:
-            if dvm_config.PUBLIC_KEY != event.author().to_hex():
+        if request.encrypted:
+            p = request.p
+            if dvm_config.PUBLIC_KEY != request.author:
                 print("[" + dvm_config.NIP89.NAME + "] Task encrypted and not addressed to this DVM, "
                                                     "skipping..")
                 return None
 
-            elif event.author().to_hex() == dvm_config.PUBLIC_KEY:
-                try:
-                    tags_str = nip44_decrypt(Keys.parse(dvm_config.PRIVATE_KEY).secret_key(),
-                                             PublicKey.parse(p), event.content())
-                except:
-                    tags_str = nip04_decrypt(Keys.parse(dvm_config.PRIVATE_KEY).secret_key(),
-                                             PublicKey.parse(p), event.content())
+            elif request.author == dvm_config.PUBLIC_KEY:
+                tags_str, use_legacy_encryption = get_crypto_context(dvm_config).decrypt(p, event.content())
                 params = json.loads(tags_str)
-                params.append(Tag.parse(["p", p]).as_vec())
-                params.append(Tag.parse(["encrypted"]).as_vec())
-                event_as_json = json.loads(event.as_json())
-                event_as_json['tags'] = params
-                event_as_json['content'] = ""
-                event = Event.from_json(json.dumps(event_as_json))
+                params.append(["p", p])
+                params.append(["encrypted"])
+                event = JobRequest.decrypted_from(event, params, use_legacy_encryption).parsed_event
     except Exception as e:
         print(e)
 
@@ -433,20 +415,21 @@ async def update_profile(dvm_config, client, lud16="", broadcast=True):
 
     print("[" + dvm_config.NIP89.NAME + "] Setting profile metadata for " + keys.public_key().to_bech32() + "...")
     print(metadata.as_json())
+    # signed with our own keys, the client may be shared with other DVMs and sign with theirs
+    event = EventBuilder.metadata(metadata).sign_with_keys(keys)
     if broadcast:
-       for relay in dvm_config.ANNOUNCE_RELAY_LIST:
-           await client.add_relay(relay)
-       await client.connect()
+        return await send_event(event, client, dvm_config, broadcast=True)
+    return await client.send_event(event)
 
-    return await client.set_metadata(metadata)
+
+def nip04_dm_event(msg, receiver: PublicKey, keys: Keys) -> Event:
+    content = nip04_encrypt(keys.secret_key(), receiver, msg)
+    ptag = Tag.parse(["p", receiver.to_hex()])
+    return EventBuilder(Kind(4), content).tags([ptag]).sign_with_keys(keys)
 
 
 async def send_nip04_dm(client: Client, msg, receiver: PublicKey, dvm_config):
-    keys = Keys.parse(dvm_config.PRIVATE_KEY)
-    signer = NostrSigner.keys(keys)
-    content = await signer.nip04_encrypt(receiver, msg)
-    ptag = Tag.parse(["p", receiver.to_hex()])
-    event = EventBuilder(Kind(4), content).tags([ptag]).sign_with_keys(Keys.parse(dvm_config.PRIVATE_KEY))
+    event = nip04_dm_event(msg, receiver, Keys.parse(dvm_config.PRIVATE_KEY))
     await client.send_event(event)
 
     # relays = await get_dm_relays(event, client, dvm_config)
@@ -846,4 +846,6 @@ class NutZapWallet:
             .set_nip05("")
         print("[" + name + "] Setting profile metadata for " + keys.public_key().to_bech32() + "...")
         print(metadata.as_json())
-        await client.set_metadata(metadata)
+        # signed with our own keys, the client may be shared with other DVMs
+        event = EventBuilder.metadata(metadata).sign_with_keys(keys)
+        await client.send_event(event)
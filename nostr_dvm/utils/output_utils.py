@@ -11,6 +11,7 @@ from nostr_sdk import Tag, PublicKey, EventId, Keys, EventBuilder, LogLevel
 from pyupload.uploader import CatboxUploader
 
 from nostr_dvm.utils.definitions import EventDefinitions
+from nostr_dvm.utils.job_request_utils import JobRequest
 from nostr_dvm.utils.nip98_utils import generate_nip98_header
 from nostr_dvm.utils.nostr_utils import send_event_outbox
 from nostr_dvm.utils.print_utils import bcolors
@@ -33,11 +34,11 @@ def post_process_result(anno, original_event):
         has_output_tag = False
         output_format = "text/plain"
 
-        for tag in original_event.tags().to_vec():
-            if tag.as_vec()[0] == "output":
-                output_format = tag.as_vec()[1]
-                has_output_tag = True
-                print("requested output is " + str(output_format) + "...")
+        output = JobRequest.of(original_event).output
+        if output is not None:
+            output_format = output
+            has_output_tag = True
+            print("requested output is " + str(output_format) + "...")
 
         if has_output_tag:
             print("Output Tag found: " + output_format)
@@ -0,0 +1,276 @@
+import asyncio
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from nostr_dvm.utils.print_utils import bcolors
+from nostr_dvm.utils.zap_utils import proxies, get_webhook_token
+
+
+class LNbitsClient:
+    """
+    LNbits API client for payment status checks. It keeps one pooled HTTP session per client and runs the
+    blocking requests in a worker thread, so checking invoices doesn't stall the event loop.
+    """
+
+    def __init__(self, dvm_config, pool_size=10, timeout=10):
+        self.url = dvm_config.LNBITS_URL
+        self.headers = {'X-API-Key': dvm_config.LNBITS_INVOICE_KEY, 'Content-Type': 'application/json',
+                        'charset': 'UTF-8'}
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.proxies.update(proxies)
+
+    def _get(self, path, params=None):
+        res = self.session.get(self.url + path, headers=self.headers, params=params, timeout=self.timeout)
+        return json.loads(res.text)
+
+    async def check_paid(self, payment_hash):
+        """Same semantics as check_bolt11_ln_bits_is_paid: True if paid, False if pending, None on error."""
+        try:
+            obj = await asyncio.to_thread(self._get, "/api/v1/payments/" + payment_hash)
+            if obj.get("paid"):
+                return obj["paid"]
+            else:
+                return False
+        except Exception:
+            return None
+
+    async def check_paid_batch(self, payment_hashes, limit=500):
+        """
+        Check many invoices at once by listing the latest payments of the wallet. Invoices that are not part of
+        the list are checked one by one.
+        """
+        result = {}
+        payment_hashes = set(payment_hashes)
+        try:
+            payments = await asyncio.to_thread(self._get, "/api/v1/payments", {"limit": limit})
+            for payment in payments:
+                payment_hash = payment.get("payment_hash")
+                if payment_hash in payment_hashes:
+                    if payment.get("status") is not None:
+                        result[payment_hash] = payment["status"] == "success"
+                    else:
+                        result[payment_hash] = payment.get("pending") is False
+        except Exception as e:
+            print("LNBITS: " + str(e))
+
+        missing = [payment_hash for payment_hash in payment_hashes if payment_hash not in result]
+        if len(missing) > 0:
+            statuses = await asyncio.gather(*[self.check_paid(payment_hash) for payment_hash in missing])
+            for payment_hash, status in zip(missing, statuses):
+                result[payment_hash] = status
+        return result
+
+    def close(self):
+        self.session.close()
+
+
+class WatchedInvoice:
+    __slots__ = ("payment_hash", "created_at", "next_check")
+
+    def __init__(self, payment_hash, created_at):
+        self.payment_hash = payment_hash
+        self.created_at = created_at
+        self.next_check = created_at
+
+
+class PaymentWatcher:
+    """
+    Watches unpaid invoices and calls on_paid(payment_hash) once an invoice is settled, or
+    on_expired(payment_hash) if LNbits doesn't know the invoice (anymore).
+
+    Invoices are polled in batches with an exponential backoff based on their age: a fresh invoice is checked
+    every PAYMENT_CHECK_MIN_INTERVAL seconds, the interval doubles every PAYMENT_CHECK_BACKOFF_AGE seconds of
+    invoice age up to PAYMENT_CHECK_MAX_INTERVAL. If LNBITS_WEBHOOK_URL is set, LNbits calls us once an invoice
+    is paid (see PaymentWebhookServer) and the invoice resolves right away, polling only remains as a fallback.
+    """
+
+    def __init__(self, dvm_config, on_paid, on_expired=None, lnbits_client=None):
+        self.dvm_config = dvm_config
+        self.on_paid = on_paid
+        self.on_expired = on_expired
+        self.lnbits_client = lnbits_client if lnbits_client is not None else LNbitsClient(dvm_config)
+        self.invoices = {}
+        self.task = None
+        self.loop = None
+        self.webhook_server = None
+
+    def watch(self, payment_hash, created_at=None):
+        if payment_hash is None or payment_hash == "":
+            return
+        if created_at is None:
+            created_at = time.time()
+        self.invoices[payment_hash] = WatchedInvoice(payment_hash, created_at)
+
+    def unwatch(self, payment_hash):
+        self.invoices.pop(payment_hash, None)
+
+    def _check_interval(self, invoice, now):
+        age = max(now - invoice.created_at, 0)
+        interval = self.dvm_config.PAYMENT_CHECK_MIN_INTERVAL * (
+                2 ** int(age // self.dvm_config.PAYMENT_CHECK_BACKOFF_AGE))
+        return min(interval, self.dvm_config.PAYMENT_CHECK_MAX_INTERVAL)
+
+    async def resolve(self, payment_hash):
+        """Check a watched invoice right away, e.g. when we get notified by a webhook. Only LNbits decides if it's
+        paid, a notification alone never is."""
+        if payment_hash not in self.invoices:
+            return
+        is_paid = await self.lnbits_client.check_paid(payment_hash)
+        if is_paid and self.invoices.pop(payment_hash, None) is not None:
+            await self.on_paid(payment_hash)
+
+    async def check_due(self):
+        now = time.time()
+        due = [invoice for invoice in self.invoices.values() if invoice.next_check <= now]
+        if len(due) == 0:
+            return
+        for invoice in due:
+            invoice.next_check = now + self._check_interval(invoice, now)
+
+        statuses = await self.lnbits_client.check_paid_batch([invoice.payment_hash for invoice in due])
+        for payment_hash, is_paid in statuses.items():
+            if payment_hash not in self.invoices:
+                continue
+            if is_paid:
+                del self.invoices[payment_hash]
+                await self.on_paid(payment_hash)
+            elif is_paid is None:  # invoice expired or unknown
+                del self.invoices[payment_hash]
+                if self.on_expired is not None:
+                    await self.on_expired(payment_hash)
+
+    async def run(self):
+        while True:
+            try:
+                await self.check_due()
+            except Exception as e:
+                print(bcolors.RED + "Payment watcher: " + str(e) + bcolors.ENDC)
+            await asyncio.sleep(1.0)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.dvm_config.LNBITS_WEBHOOK_URL != "":
+            # all DVMs of the process share the server, if it can't listen we rely on polling
+            self.webhook_server = PaymentWebhookServer.start(self.dvm_config.LNBITS_WEBHOOK_HOST,
+                                                             self.dvm_config.LNBITS_WEBHOOK_PORT)
+            if self.webhook_server is not None:
+                self.webhook_server.register(get_webhook_token(self.dvm_config), self)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.webhook_server is not None:
+            self.webhook_server.unregister(get_webhook_token(self.dvm_config))
+            self.webhook_server = None
+        self.lnbits_client.close()
+
+
+class PaymentWebhookRequestHandler(BaseHTTPRequestHandler):
+
+    def _respond(self, status, message, headers=None):
+        self.send_response(status, message)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    def _watcher(self):
+        token = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        return self.server.webhooks.find(token)
+
+    def do_POST(self):
+        watcher = self._watcher()
+        if watcher is None:
+            self._respond(404, "Not Found")
+            return
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(content_length) if content_length > 0 else b""
+            payment_hash = json.loads(body).get("payment_hash")
+        except Exception as e:
+            print("Payment webhook: " + str(e))
+            self._respond(400, "Bad Request")
+            return
+        if payment_hash is not None:
+            # the watcher lives on the event loop of its DVM, not on the thread of the server
+            asyncio.run_coroutine_threadsafe(watcher.resolve(payment_hash), watcher.loop)
+        self._respond(200, "OK")
+
+    def do_GET(self):
+        if self._watcher() is None:
+            self._respond(404, "Not Found")
+        else:
+            self._respond(405, "Method Not Allowed", {"Allow": "POST"})
+
+    do_PUT = do_GET
+    do_DELETE = do_GET
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PaymentWebhookServer:
+    """
+    One http server per process for the LNbits invoice webhooks of all DVMs, running in a background thread.
+    LNbits posts the payment (including its payment_hash) to the webhook url given on invoice creation once the
+    invoice is paid. Every PaymentWatcher registers the secret token its webhook url ends with, requests are
+    dispatched to the watcher of their token, requests for an unknown token get a 404. The payment is confirmed
+    with LNbits before the invoice resolves.
+    """
+
+    servers = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def start(host, port):
+        with PaymentWebhookServer.lock:
+            if (host, port) in PaymentWebhookServer.servers:
+                return PaymentWebhookServer.servers[(host, port)]
+            try:
+                server = ThreadingHTTPServer((host, port), PaymentWebhookRequestHandler)
+            except OSError as e:
+                print(bcolors.RED + "Payment webhook server couldn't listen on " + host + ":" + str(port) + ": " + str(
+                    e) + bcolors.ENDC)
+                return None
+            server.daemon_threads = True
+            server.webhooks = PaymentWebhookServer()
+            threading.Thread(target=server.serve_forever, daemon=True, name="payment-webhooks").start()
+            PaymentWebhookServer.servers[(host, port)] = server.webhooks
+            print("Listening for LNbits webhooks on " + host + ":" + str(port))
+            return server.webhooks
+
+    def __init__(self):
+        self.watchers = {}  # token -> PaymentWatcher
+        self.lock = threading.Lock()
+
+    def register(self, token, payment_watcher):
+        with self.lock:
+            self.watchers[token] = payment_watcher
+
+    def unregister(self, token):
+        with self.lock:
+            self.watchers.pop(token, None)
+
+    def find(self, token):
+        with self.lock:
+            watchers = list(self.watchers.items())
+        match = None
+        for registered, payment_watcher in watchers:
+            # compare every token in constant time, so response times don't leak them
+            if hmac.compare_digest(token.encode("utf-8"), registered.encode("utf-8")):
+                match = payment_watcher
+        return match
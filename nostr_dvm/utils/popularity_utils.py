@@ -0,0 +1,55 @@
+import heapq
+
+from nostr_sdk import Filter
+
+from nostr_dvm.utils.definitions import EventDefinitions
+
+# Reactions, zaps, reposts and replies all count as an interaction with the note they reference.
+INTERACTION_KINDS = [EventDefinitions.KIND_ZAP, EventDefinitions.KIND_REACTION, EventDefinitions.KIND_REPOST,
+                     EventDefinitions.KIND_NOTE]
+
+
+async def count_interactions(database, since=None, kinds=None, tag_name="e", event_ids=None, counts=None):
+    """
+    Count interactions per referenced event with a single database query.
+
+    All events of the given kinds since `since` are fetched at once and grouped by the events they reference in
+    their `tag_name` tags (e.g. "e", or "E" for NIP22 comments). An interaction referencing the same event multiple
+    times counts once, like a per-event Filter().event(id) query would. If event_ids is given, only these events
+    are counted. Pass an existing dict as counts to add to it, e.g. when counting several kinds with different tags.
+
+    Returns a dict of event id (hex) -> number of interactions.
+    """
+    if kinds is None:
+        kinds = INTERACTION_KINDS
+    if counts is None:
+        counts = {}
+
+    filt = Filter().kinds(kinds)
+    if since is not None:
+        filt = filt.since(since)
+    interactions = await database.query(filt)
+
+    for interaction in interactions.to_vec():
+        referenced = set()
+        for tag in interaction.tags().to_vec():
+            tag_vec = tag.as_vec()
+            if len(tag_vec) > 1 and tag_vec[0] == tag_name:
+                referenced.add(tag_vec[1])
+        for event_id in referenced:
+            if event_ids is None or event_id in event_ids:
+                counts[event_id] = counts.get(event_id, 0) + 1
+    return counts
+
+
+def top_events(counts, event_ids, max_results, min_interactions=0):
+    """
+    Returns the max_results (event id, count) pairs out of event_ids with the most interactions, most popular first.
+    Events with less than min_interactions are skipped. Ties keep the order of event_ids.
+    """
+    candidates = []
+    for event_id in event_ids:
+        count = counts.get(event_id, 0)
+        if count >= min_interactions:
+            candidates.append((event_id, count))
+    return heapq.nlargest(int(max_results), candidates, key=lambda x: x[1])
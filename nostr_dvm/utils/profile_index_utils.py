@@ -0,0 +1,192 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from nostr_sdk import Filter, Kind, EventId
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+class ProfileIndex:
+    """
+    Full text search over the profiles (kind 0) of a profile database, kept in an sqlite FTS5 index next to it.
+
+    The name, display_name, nip05 and about fields are parsed once when a profile is indexed. After every sync the
+    events the sync received are added (refresh), a full rebuild from the database only happens if the index is
+    missing or doesn't have the same number of profiles as the database. Searches match every term as a prefix
+    and rank by WoT score first (if set with set_wot_scores), then by bm25.
+    Use ProfileIndex.get(db_name) to get the shared index of a database.
+    """
+
+    BATCH_SIZE = 500
+
+    indexes = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(db_name):
+        with ProfileIndex.lock:
+            index = ProfileIndex.indexes.get(db_name)
+            if index is None:
+                index = ProfileIndex(os.path.splitext(db_name)[0] + "_search.sqlite")
+                ProfileIndex.indexes[db_name] = index
+            return index
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self._create()
+
+    def connection(self):
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, cached_statements=64)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self.local.con = con
+        return con
+
+    def _create(self):
+        con = self.connection()
+        with con:
+            con.execute(""" CREATE TABLE IF NOT EXISTS profiles (
+                                id INTEGER PRIMARY KEY,
+                                pubkey TEXT UNIQUE NOT NULL,
+                                created_at INTEGER NOT NULL,
+                                name TEXT,
+                                display_name TEXT,
+                                nip05 TEXT,
+                                about TEXT
+                            ); """)
+            # kept apart from the profiles, so profiles indexed after set_wot_scores get their score too
+            con.execute(""" CREATE TABLE IF NOT EXISTS wot_scores (
+                                pubkey TEXT PRIMARY KEY,
+                                score REAL NOT NULL
+                            ) WITHOUT ROWID; """)
+            con.execute(""" CREATE VIRTUAL TABLE IF NOT EXISTS profiles_fts USING fts5(
+                                name, display_name, nip05, about,
+                                content='profiles', content_rowid='id',
+                                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                            ); """)
+            con.execute(""" CREATE TRIGGER IF NOT EXISTS profiles_ai AFTER INSERT ON profiles BEGIN
+                                INSERT INTO profiles_fts(rowid, name, display_name, nip05, about)
+                                VALUES (new.id, new.name, new.display_name, new.nip05, new.about);
+                            END; """)
+            con.execute(""" CREATE TRIGGER IF NOT EXISTS profiles_ad AFTER DELETE ON profiles BEGIN
+                                INSERT INTO profiles_fts(profiles_fts, rowid, name, display_name, nip05, about)
+                                VALUES ('delete', old.id, old.name, old.display_name, old.nip05, old.about);
+                            END; """)
+            con.execute(""" CREATE TRIGGER IF NOT EXISTS profiles_au
+                                AFTER UPDATE OF name, display_name, nip05, about ON profiles BEGIN
+                                INSERT INTO profiles_fts(profiles_fts, rowid, name, display_name, nip05, about)
+                                VALUES ('delete', old.id, old.name, old.display_name, old.nip05, old.about);
+                                INSERT INTO profiles_fts(rowid, name, display_name, nip05, about)
+                                VALUES (new.id, new.name, new.display_name, new.nip05, new.about);
+                            END; """)
+
+    def add_profiles(self, events):
+        """Index kind 0 events, older profiles than the indexed ones are ignored"""
+        rows = []
+        for event in events:
+            if event.kind().as_u16() != 0:
+                continue
+            name, display_name, nip05, about = parse_profile(event.content())
+            rows.append((event.author().to_hex(), event.created_at().as_secs(), name, display_name, nip05, about))
+        con = self.connection()
+        with self.write_lock, con:
+            con.executemany(""" INSERT INTO profiles(pubkey, created_at, name, display_name, nip05, about)
+                                VALUES (?, ?, ?, ?, ?, ?)
+                                ON CONFLICT(pubkey) DO UPDATE SET created_at=excluded.created_at,
+                                    name=excluded.name, display_name=excluded.display_name,
+                                    nip05=excluded.nip05, about=excluded.about
+                                WHERE excluded.created_at > profiles.created_at """, rows)
+        return len(rows)
+
+    async def index_events(self, database, event_ids):
+        """Index the kind 0 events with these ids (e.g. the ids a sync received) from the database"""
+        event_ids = [event_id if isinstance(event_id, EventId) else EventId.parse(event_id) for event_id in event_ids]
+        indexed = 0
+        for batch in range(0, len(event_ids), self.BATCH_SIZE):
+            filter = Filter().ids(event_ids[batch:batch + self.BATCH_SIZE]).kind(Kind(0))
+            events = await database.query(filter)
+            indexed += self.add_profiles(events.to_vec())
+        return indexed
+
+    async def rebuild(self, database):
+        events = await database.query(Filter().kind(Kind(0)))
+        con = self.connection()
+        with self.write_lock, con:
+            con.execute("DELETE FROM profiles")
+        return self.add_profiles(events.to_vec())
+
+    async def refresh(self, database, received=None):
+        """Add the profiles a sync received, rebuild the index if it isn't in line with the database"""
+        if received:
+            await self.index_events(database, received)
+        if self.count() != await database.count(Filter().kind(Kind(0))):
+            print("Rebuilding profile search index " + self.path + "..")
+            await self.rebuild(database)
+
+    def count(self):
+        return self.connection().execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+
+    def set_wot_scores(self, scores):
+        """scores: {pubkey (hex): score}, profiles that are not in scores get 0"""
+        con = self.connection()
+        with self.write_lock, con:
+            con.execute("DELETE FROM wot_scores")
+            con.executemany("INSERT INTO wot_scores(pubkey, score) VALUES (?, ?)",
+                            [(pubkey, score) for pubkey, score in scores.items()])
+
+    def search(self, query, max_results=100):
+        """pubkeys of the profiles that match all terms of query (as prefixes)"""
+        return self._match(match_all_terms(query), max_results)
+
+    def search_phrases(self, phrases, max_results=100):
+        """pubkeys of the profiles that contain any of the phrases (the last word of a phrase as prefix)"""
+        phrases = [match_phrase(phrase) for phrase in phrases]
+        return self._match(" OR ".join(phrase for phrase in phrases if phrase), max_results)
+
+    def _match(self, match, max_results):
+        if not match:
+            return []
+        rows = self.connection().execute(""" SELECT p.pubkey FROM profiles_fts f JOIN profiles p ON p.id = f.rowid
+                                              LEFT JOIN wot_scores w ON w.pubkey = p.pubkey
+                                              WHERE profiles_fts MATCH ?
+                                              ORDER BY COALESCE(w.score, 0) DESC, f.rank LIMIT ? """,
+                                          (match, int(max_results))).fetchall()
+        return [row[0] for row in rows]
+
+
+def parse_profile(content):
+    """(name, display_name, nip05, about) of a kind 0 content, empty strings for missing or invalid fields"""
+    try:
+        profile = json.loads(content)
+    except Exception:
+        profile = {}
+    if not isinstance(profile, dict):
+        profile = {}
+    fields = []
+    for keys in [("name",), ("display_name", "displayName"), ("nip05",), ("about",)]:
+        value = ""
+        for key in keys:
+            if isinstance(profile.get(key), str) and profile.get(key):
+                value = profile.get(key)
+                break
+        fields.append(value)
+    return tuple(fields)
+
+
+def match_all_terms(query):
+    # quoting the terms keeps FTS5 operators in user input from being interpreted
+    return " ".join('"' + term + '"*' for term in TOKEN.findall(query.lower()))
+
+
+def match_phrase(phrase):
+    terms = TOKEN.findall(phrase.lower())
+    if len(terms) == 0:
+        return ""
+    return '"' + " ".join(terms) + '"*'
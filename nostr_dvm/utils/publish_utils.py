@@ -0,0 +1,275 @@
+import asyncio
+import collections
+import threading
+import time
+
+from nostr_sdk import LogLevel
+
+from nostr_dvm.utils.print_utils import bcolors
+
+PRIORITY_RESULT = 0
+PRIORITY_FEEDBACK = 1
+PRIORITY_ANNOUNCEMENT = 2
+
+
+class TokenBucket:
+    """
+    Rate limit for sending to one relay, shared by all publishers of a process. Tokens are reserved under a lock
+    and the caller sleeps until its token is due, so buckets can be used from the event loops of all DVMs.
+    """
+
+    buckets = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(relay, rate, burst):
+        with TokenBucket.lock:
+            bucket = TokenBucket.buckets.get(relay)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+                TokenBucket.buckets[relay] = bucket
+            return bucket
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returns the seconds to wait until it may be used"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class PublishResult:
+    """Outcome of a published event, with the fields of SendEventOutput over all attempts"""
+    __slots__ = ("id", "success", "failed")
+
+    def __init__(self, event_id):
+        self.id = event_id
+        self.success = []  # relays that accepted the event
+        self.failed = {}  # relay -> error of the last attempt, for relays that never accepted it
+
+
+class PublishJob:
+    __slots__ = ("event", "priority", "relays", "targets", "key", "lane", "futures", "attempts", "superseded",
+                 "started", "fallback", "result")
+
+    def __init__(self, event, priority, relays, key, lane=None):
+        self.event = event
+        self.priority = priority
+        self.relays = relays  # relays for the next attempt, None until they are resolved
+        self.targets = None  # relays passed to publish or resolved for the first attempt, retries stay within them
+        self.key = key
+        self.lane = lane
+        self.futures = []
+        self.attempts = 0
+        self.superseded = False
+        self.started = False
+        self.fallback = False
+        self.result = PublishResult(event.id())
+
+
+class EventPublisher:
+    """
+    Sends the events of a DVM in the background, so handling a job doesn't wait for relays.
+
+    Events are queued by priority (results before feedback before announcements) and sent by a few async
+    workers. A status update queued with the same key as an earlier one that hasn't been sent yet (e.g. "processing"
+    after "payment-required" for the same job) replaces it. Relays that fail are retried with an exponential
+    backoff, sending to a relay waits for its token bucket. If no relay accepted an event after the last retry, it is
+    sent once more to the relays of fallback_function. publish returns a future with a PublishResult.
+
+    Events published with the same lane (e.g. the direct messages to one user) are sent one after another in the
+    order they were published, regardless of their priority: the next one is queued once the previous one is done,
+    including its retries.
+
+    send_function(relays, event) sends an event and returns a SendEventOutput, resolve_function(event) returns the
+    relays of an event (e.g. the inbox relays of its receiver) and is called by the workers, not by publish.
+    retry_function(relays, event) sends retries and the fallback (send_function if None), fallback_function(event,
+    relays) returns the relays for an event none of its relays accepted (no fallback if None).
+    Limits are read from the DVMConfig:
+
+    PUBLISH_WORKERS: number of events sent at the same time
+    PUBLISH_MAX_RETRIES: retries of relays that failed, after the first attempt
+    PUBLISH_RETRY_BACKOFF: seconds before the first retry, doubled for every further retry
+    PUBLISH_RELAY_RATE: events per second sent to one relay, PUBLISH_RELAY_BURST events may be sent at once
+    """
+
+    def __init__(self, dvm_config, send_function, resolve_function, retry_function=None, fallback_function=None):
+        self.dvm_config = dvm_config
+        self.send_function = send_function
+        self.resolve_function = resolve_function
+        self.retry_function = retry_function if retry_function is not None else send_function
+        self.fallback_function = fallback_function
+        self.queue = None
+        self.queued = {}  # key -> job that is waiting in the queue
+        self.lanes = {}  # lane -> deque of jobs waiting for the job of the lane that is queued or being sent
+        self.sequence = 0
+        self.workers = []
+        self.retries = set()
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        for i in range(max(self.dvm_config.PUBLISH_WORKERS, 1)):
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout=5.0):
+        """Stop after sending what's queued (for at most timeout seconds)"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(bcolors.RED + "[" + self.dvm_config.NIP89.NAME + "] " + str(
+                self.queue.qsize()) + " events weren't published" + bcolors.ENDC)
+        for task in self.workers + list(self.retries):
+            task.cancel()
+        self.workers = []
+        self.retries = set()
+
+    def pending(self):
+        if self.queue is None:
+            return 0
+        return self.queue.qsize() + len(self.retries) + sum(len(waiting) for waiting in self.lanes.values())
+
+    def publish(self, event, priority=PRIORITY_FEEDBACK, relays=None, key=None, lane=None):
+        """
+        Queue an event, returns a future with its PublishResult. Pass relays to skip resolve_function, pass a lane
+        to send the event after the events published before with the same lane.
+        """
+        job = PublishJob(event, priority, relays, key, lane)
+        future = asyncio.get_running_loop().create_future()
+        job.futures.append(future)
+        if key is not None:
+            previous = self.queued.get(key)
+            if previous is not None and not previous.started:
+                # the newer status makes the queued one obsolete, whoever waits for it gets the newer result
+                previous.superseded = True
+                job.futures = previous.futures + job.futures
+                self.coalesced += 1
+            self.queued[key] = job
+        if lane is not None:
+            waiting = self.lanes.get(lane)
+            if waiting is not None:
+                waiting.append(job)
+                return future
+            self.lanes[lane] = collections.deque()
+        self._enqueue(job)
+        return future
+
+    def _next_in_lane(self, job):
+        if job.lane is None:
+            return
+        waiting = self.lanes.get(job.lane)
+        if waiting is None:
+            return
+        if len(waiting) > 0:
+            self._enqueue(waiting.popleft())
+        else:
+            del self.lanes[job.lane]
+
+    def _enqueue(self, job):
+        self.sequence += 1
+        self.queue.put_nowait((job.priority, self.sequence, job))
+
+    async def _worker(self):
+        while True:
+            priority, sequence, job = await self.queue.get()
+            try:
+                if not job.superseded:
+                    await self._send(job)
+                else:
+                    self._next_in_lane(job)
+            except Exception as e:
+                print(bcolors.RED + "[" + self.dvm_config.NIP89.NAME + "] Publishing failed: " + str(e) + bcolors.ENDC)
+                self._finish(job)
+            finally:
+                self.queue.task_done()
+
+    async def _send(self, job):
+        job.started = True
+        if job.key is not None and self.queued.get(job.key) is job:
+            del self.queued[job.key]
+        if job.relays is None:
+            job.relays = await self.resolve_function(job.event)
+        if job.targets is None:
+            job.targets = list(job.relays)
+
+        relays = job.relays
+        send_function = self.send_function if job.attempts == 0 else self.retry_function
+        await asyncio.gather(*[TokenBucket.get(relay, self.dvm_config.PUBLISH_RELAY_RATE,
+                                               self.dvm_config.PUBLISH_RELAY_BURST).acquire() for relay in relays])
+        job.attempts += 1
+        error = "not sent"
+        try:
+            output = await send_function(relays, job.event)
+        except Exception as e:
+            output = None
+            error = str(e)
+        if output is None:
+            failed = {relay: error for relay in relays}
+        else:
+            for relay in output.success:
+                if str(relay) not in job.result.success:
+                    job.result.success.append(str(relay))
+            failed = {str(relay): error for relay, error in output.failed.items()}
+        job.result.failed = {relay: error for relay, error in failed.items() if relay not in job.result.success}
+
+        # retries go to the relays of the first attempt that haven't accepted the event yet, the failed relays of
+        # the output can be others (e.g. inbox relays picked by a gossip client)
+        succeeded = [relay.rstrip("/") for relay in job.result.success]
+        remaining = [relay for relay in job.targets if relay.rstrip("/") not in succeeded]
+        if len(job.result.failed) > 0 and len(remaining) > 0 and job.attempts <= self.dvm_config.PUBLISH_MAX_RETRIES \
+                and not job.fallback:
+            job.relays = remaining
+            delay = self.dvm_config.PUBLISH_RETRY_BACKOFF * (2 ** (job.attempts - 1))
+            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
+                print("[" + self.dvm_config.NIP89.NAME + "] Retrying " + job.event.id().to_hex() + " on " + str(
+                    job.relays) + " in " + str(delay) + "s")
+            retry = asyncio.create_task(self._retry(job, delay))
+            self.retries.add(retry)
+            retry.add_done_callback(self.retries.discard)
+        elif len(job.result.success) == 0 and self.fallback_function is not None and not job.fallback:
+            job.fallback = True
+            job.relays = await self.fallback_function(job.event, job.targets)
+            if len(job.relays) == 0:
+                self._finish(job)
+                return
+            if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
+                print("[" + self.dvm_config.NIP89.NAME + "] No relay accepted " + job.event.id().to_hex() +
+                      ", sending it to " + str(job.relays))
+            self._enqueue(job)
+        else:
+            self._finish(job)
+
+    async def _retry(self, job, delay):
+        await asyncio.sleep(delay)
+        self._enqueue(job)
+
+    def _finish(self, job):
+        if len(job.result.success) > 0:
+            self.sent += 1
+        else:
+            self.failed += 1
+        for future in job.futures:
+            if not future.done():
+                future.set_result(job.result)
+        self._next_in_lane(job)
+
+    def stats(self):
+        return {"queued": self.pending(), "sent": self.sent, "failed": self.failed, "coalesced": self.coalesced}
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from nostr_sdk import Filter, PublicKey
+
+from nostr_dvm.utils.definitions import EventDefinitions, relay_timeout
+
+
+class RelayListEntry:
+    __slots__ = ("inbox", "legacy", "created_at", "checked_at")
+
+    def __init__(self, inbox, legacy, created_at, checked_at):
+        self.inbox = inbox  # read relays of the kind 10002 event, None if the user didn't announce any
+        self.legacy = legacy  # relays from the content of the kind 3 event (older clients), None if there are none
+        self.created_at = created_at  # created_at of the kind 10002 event, 0 if there is none
+        self.checked_at = checked_at
+
+
+class RelayListCache:
+    """
+    NIP-65 relay lists of the users DVMs reply to, so sending a result or status doesn't have to look up the
+    inbox relays of its recipient on every event. One cache is shared by all DVMs of a process.
+
+    A relay list is kept for ttl seconds, the answer "no relays announced" only for negative_ttl seconds, so users
+    that announce their relays later are found soon. Lookups fetch the kind 10002 and kind 3 events of all
+    unknown recipients of an event in one request, concurrent lookups of the same user (from any DVM) share one
+    fetch. Kind 10002 events the DVMs see on their subscriptions are added with add_event, so lists are often
+    known (and kept current) before they're needed.
+    """
+
+    caches = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(ttl=3600, negative_ttl=300):
+        with RelayListCache.lock:
+            cache = RelayListCache.caches.get((ttl, negative_ttl))
+            if cache is None:
+                cache = RelayListCache(ttl, negative_ttl)
+                RelayListCache.caches[(ttl, negative_ttl)] = cache
+            return cache
+
+    def __init__(self, ttl=3600, negative_ttl=300, max_size=50000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.cache = OrderedDict()  # user (hex) -> RelayListEntry
+        self.cache_lock = threading.Lock()
+        self.pending = {}  # user (hex) -> Future of the running fetch
+
+        self.hits = 0
+        self.misses = 0
+        self.live_updates = 0
+
+    def _is_fresh(self, entry, now):
+        ttl = self.ttl if entry.inbox else self.negative_ttl
+        return now - entry.checked_at < ttl
+
+    def _set(self, user, entry):
+        # called with cache_lock held
+        self.cache[user] = entry
+        self.cache.move_to_end(user)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def add_event(self, event, now=None):
+        """Store a kind 10002 event if it's newer than the cached list, returns True if the list changed"""
+        if event.kind().as_u16() != EventDefinitions.KIND_RELAY_ANNOUNCEMENT.as_u16():
+            return False
+        if now is None:
+            now = time.time()
+        user = event.author().to_hex()
+        created_at = event.created_at().as_secs()
+        with self.cache_lock:
+            entry = self.cache.get(user)
+            if entry is not None and entry.created_at >= created_at:
+                return False
+            legacy = entry.legacy if entry is not None else None
+            self._set(user, RelayListEntry(parse_read_relays(event), legacy, created_at, now))
+            self.live_updates += 1
+            return True
+
+    async def lookup(self, users, client):
+        """{user (hex): RelayListEntry} for the users (hex or PublicKey), fetched from the relays if not cached"""
+        users = [user.to_hex() if isinstance(user, PublicKey) else user for user in users]
+        now = time.time()
+        entries = {}
+        to_fetch = []
+        waiting = {}
+        with self.cache_lock:
+            for user in dict.fromkeys(users):
+                entry = self.cache.get(user)
+                if entry is not None and self._is_fresh(entry, now):
+                    self.cache.move_to_end(user)
+                    self.hits += 1
+                    entries[user] = entry
+                    continue
+                self.misses += 1
+                future = self.pending.get(user)
+                if future is None:
+                    future = Future()
+                    self.pending[user] = future
+                    to_fetch.append(user)
+                waiting[user] = future
+
+        if len(to_fetch) > 0:
+            await self._fetch(to_fetch, client)
+        for user, future in waiting.items():
+            try:
+                entries[user] = await asyncio.wrap_future(future)
+            except Exception as e:
+                print("Couldn't fetch relay list of " + user + ": " + str(e))
+        return entries
+
+    async def _fetch(self, users, client):
+        fetched = {}
+        try:
+            now = time.time()
+            if len(await client.relays()) == 0:
+                return
+            filter = Filter().kinds([EventDefinitions.KIND_RELAY_ANNOUNCEMENT, EventDefinitions.KIND_FOLLOW_LIST]) \
+                .authors([PublicKey.parse(user) for user in users])
+            events = await client.fetch_events(filter, relay_timeout)
+            newest = {}
+            for event in events.to_vec():
+                key = (event.author().to_hex(), event.kind().as_u16())
+                if key not in newest or event.created_at().as_secs() > newest[key].created_at().as_secs():
+                    newest[key] = event
+            with self.cache_lock:
+                for user in users:
+                    relay_list = newest.get((user, EventDefinitions.KIND_RELAY_ANNOUNCEMENT.as_u16()))
+                    follow_list = newest.get((user, EventDefinitions.KIND_FOLLOW_LIST.as_u16()))
+                    known = self.cache.get(user)
+                    if relay_list is None and known is not None and known.inbox:
+                        # seen on a subscription, but not (yet) on the relays we asked
+                        entry = RelayListEntry(known.inbox, known.legacy, known.created_at, now)
+                    elif relay_list is None:
+                        entry = RelayListEntry(None, None, 0, now)
+                    else:
+                        entry = RelayListEntry(parse_read_relays(relay_list), None, relay_list.created_at().as_secs(),
+                                               now)
+                    if follow_list is not None:
+                        entry.legacy = parse_legacy_relays(follow_list)
+                    self._set(user, entry)
+                    fetched[user] = entry
+        finally:
+            with self.cache_lock:
+                for user in users:
+                    future = self.pending.pop(user, None)
+                    if future is None:
+                        continue
+                    entry = fetched.get(user)
+                    if entry is None:
+                        # the fetch failed, waiting lookups get no relays and the next one tries again
+                        entry = RelayListEntry(None, None, 0, 0)
+                    future.set_result(entry)
+
+    async def get_inbox_relays(self, users, client):
+        """Read relays the users announced (kind 10002)"""
+        return self._merge((await self.lookup(users, client)).values(), "inbox")
+
+    async def get_legacy_relays(self, users, client):
+        """Relays the users put in their follow list (kind 3), for users without a kind 10002 event"""
+        return self._merge((await self.lookup(users, client)).values(), "legacy")
+
+    @staticmethod
+    def _merge(entries, attribute):
+        relays = []
+        for entry in entries:
+            for relay in getattr(entry, attribute) or []:
+                if relay not in relays:
+                    relays.append(relay)
+        return relays
+
+    def stats(self):
+        with self.cache_lock:
+            lookups = self.hits + self.misses
+            return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses,
+                    "live_updates": self.live_updates, "hit_rate": self.hits / lookups if lookups > 0 else 0.0}
+
+
+def parse_read_relays(event):
+    """Relays of a kind 10002 event that are used for reading (marked "read" or not marked at all)"""
+    relays = []
+    for tag in event.tags().to_vec():
+        tag_vec = tag.as_vec()
+        if tag_vec[0] == 'r' and (len(tag_vec) == 2 or (len(tag_vec) == 3 and tag_vec[2] == "read")):
+            if tag_vec[1].startswith("ws") and " " not in tag_vec[1]:
+                relays.append(tag_vec[1])
+    return relays
+
+
+def parse_legacy_relays(event):
+    """Relays in the content of a kind 3 event, as older clients announce them"""
+    try:
+        return [relay for relay in json.loads(event.content()) if isinstance(relay, str)]
+    except Exception:
+        return []
+
+
+def get_relay_list_cache(dvm_config):
+    return RelayListCache.get(dvm_config.RELAY_LIST_TTL, dvm_config.RELAY_LIST_NEGATIVE_TTL)
@@ -0,0 +1,217 @@
+import asyncio
+import threading
+import time
+
+from nostr_sdk import ClientBuilder, Options, RelayLimits, Connection, ConnectionTarget, NostrSigner, Keys
+
+from nostr_dvm.utils.crypto_utils import get_crypto_context
+
+
+class RelayStats:
+    __slots__ = ("url", "sent", "failed", "consecutive_failures", "latency", "last_used", "last_error", "in_use",
+                 "added")
+
+    def __init__(self, url):
+        self.url = url
+        self.sent = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.latency = None  # moving average of the send time in seconds
+        self.last_used = time.time()
+        self.last_error = None
+        self.in_use = 0  # sends in progress, relays in use aren't evicted
+        self.added = False  # added to the client
+
+    def record(self, success, latency, now, error=None):
+        self.last_used = now
+        if success:
+            self.sent += 1
+            self.consecutive_failures = 0
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+        else:
+            self.failed += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+
+    def as_dict(self):
+        return {"sent": self.sent, "failed": self.failed, "consecutive_failures": self.consecutive_failures,
+                "latency": self.latency, "last_used": self.last_used, "last_error": self.last_error}
+
+
+class RelayPool:
+    """
+    Relay connections shared by all DVMs of a process. Every DVM runs its own event loop in its own thread, but
+    the nostr_sdk client behind a pool is thread safe, so DVMs talking to the same relays share one websocket per
+    relay and multiplex their subscriptions over it instead of each opening their own connections.
+
+    Relays are added on first use and stay connected. If idle_timeout is set, relays that haven't been used for
+    that long are removed again (used for the outbox, where every recipient brings their own relays). Relays a
+    send is using are never evicted, and a relay that is being removed is only added again once it's gone.
+
+    The client signs NIP-42 AUTH challenges with the keys of the DVM that created the pool (or with generated
+    keys), so events are signed by the DVMs with their own keys (sign_with_keys) and never through the client. The
+    relays of the client are only changed through the pool, not per event by its users.
+    """
+
+    pools = {}
+    pools_lock = threading.Lock()
+
+    @staticmethod
+    def get(name, opts=None, idle_timeout=0, keys=None):
+        with RelayPool.pools_lock:
+            pool = RelayPool.pools.get(name)
+            if pool is None:
+                pool = RelayPool(name, opts, idle_timeout, keys)
+                RelayPool.pools[name] = pool
+            return pool
+
+    def __init__(self, name, opts=None, idle_timeout=0, keys=None):
+        if opts is None:
+            opts = Options().relay_limits(RelayLimits.disable())
+        if keys is None:
+            keys = Keys.generate()
+        self.name = name
+        self.client = ClientBuilder().signer(NostrSigner.keys(keys)).opts(opts).build()
+        self.idle_timeout = idle_timeout
+        self.relays = {}
+        self.evicting = set()  # relays that are being removed from the client
+        self.lock = threading.Lock()
+        self.last_eviction = time.time()
+
+    async def add_relays(self, relays, hold=False):
+        """
+        Add relays to the pool and connect the new ones. Returns the relays that are part of the pool. With hold,
+        the returned relays are kept from eviction until they're given to release.
+        """
+        added = []
+        new_relays = False
+        for relay in relays:
+            if not relay.startswith("ws://") and not relay.startswith("wss://"):
+                continue
+            while True:
+                with self.lock:
+                    evicting = relay in self.evicting
+                    if not evicting:
+                        stats = self.relays.get(relay)
+                        if stats is None:
+                            # reserved before it's added, so it can't be evicted while we add it
+                            stats = RelayStats(relay)
+                            self.relays[relay] = stats
+                        is_new = not stats.added
+                        stats.last_used = time.time()
+                        stats.in_use += 1
+                if not evicting:
+                    break
+                await asyncio.sleep(0.05)
+            if is_new:
+                try:
+                    # add_relay is a no-op if another DVM added the relay in the meantime
+                    await self.client.add_relay(relay)
+                except Exception as e:
+                    print("Relay pool " + self.name + ": " + relay + " couldn't be added: " + str(e))
+                    with self.lock:
+                        stats.in_use -= 1
+                        if self.relays.get(relay) is stats and stats.in_use == 0 and not stats.added:
+                            del self.relays[relay]
+                    continue
+                with self.lock:
+                    stats.added = True
+                new_relays = True
+            if not hold:
+                self.release([relay])
+            added.append(relay)
+        if new_relays:
+            await self.client.connect()
+        return added
+
+    def release(self, relays):
+        """Allow relays held by add_relays to be evicted again"""
+        now = time.time()
+        with self.lock:
+            for relay in relays:
+                stats = self.relays.get(relay)
+                if stats is not None and stats.in_use > 0:
+                    stats.in_use -= 1
+                    stats.last_used = now
+
+    async def send_event_to(self, relays, event):
+        relays = await self.add_relays(relays, hold=True)
+        if len(relays) == 0:
+            return None
+        try:
+            output = await self._send_event_to(relays, event)
+        finally:
+            self.release(relays)
+        await self.evict_idle()
+        return output
+
+    async def _send_event_to(self, relays, event):
+        tic = time.time()
+        try:
+            output = await self.client.send_event_to(relays, event)
+        except Exception as e:
+            now = time.time()
+            with self.lock:
+                for relay in relays:
+                    stats = self.relays.get(relay)
+                    if stats is not None:
+                        stats.record(False, now - tic, now, str(e))
+            raise
+        now = time.time()
+        with self.lock:
+            for relay in output.success:
+                stats = self.relays.get(str(relay))
+                if stats is not None:
+                    stats.record(True, now - tic, now)
+            for relay, error in output.failed.items():
+                stats = self.relays.get(str(relay))
+                if stats is not None:
+                    stats.record(False, now - tic, now, error)
+        return output
+
+    async def evict_idle(self):
+        if self.idle_timeout <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            if now - self.last_eviction < min(self.idle_timeout, 60):
+                return
+            self.last_eviction = now
+            idle = [relay for relay, stats in self.relays.items()
+                    if stats.in_use == 0 and now - stats.last_used > self.idle_timeout]
+            for relay in idle:
+                del self.relays[relay]
+                self.evicting.add(relay)
+        for relay in idle:
+            try:
+                await self.client.remove_relay(relay)
+            except Exception as e:
+                print("Relay pool " + self.name + ": " + relay + " couldn't be removed: " + str(e))
+            finally:
+                with self.lock:
+                    self.evicting.discard(relay)
+
+    def stats(self):
+        with self.lock:
+            return {relay: stats.as_dict() for relay, stats in self.relays.items()}
+
+
+def get_dvm_relay_pool(dvm_config):
+    """Pool for the main connections of DVMs, DVMs with the same relay list share it."""
+    return RelayPool.get("dvm:" + ",".join(sorted(dvm_config.RELAY_LIST)), keys=get_crypto_context(dvm_config).keys)
+
+
+def get_outbox_relay_pool(dvm_config):
+    """Pool for replying to the inbox relays of users, onion relays are reached via tor."""
+    connection = Connection().addr("127.0.0.1:9050").target(ConnectionTarget.ONION)
+    opts = Options().relay_limits(RelayLimits.disable()).connection(connection)
+    return RelayPool.get("outbox", opts, dvm_config.OUTBOX_RELAY_IDLE_TIMEOUT, get_crypto_context(dvm_config).keys)
+
+
+def relay_pool_stats():
+    with RelayPool.pools_lock:
+        pools = list(RelayPool.pools.values())
+    return {pool.name: pool.stats() for pool in pools}
@@ -0,0 +1,160 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from nostr_sdk import LogLevel
+
+from nostr_dvm.utils.print_utils import bcolors
+
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+
+
+class ScheduledJob:
+    __slots__ = ("event", "amount", "task", "user", "priority")
+
+    def __init__(self, event, amount, task, user, priority):
+        self.event = event
+        self.amount = amount
+        self.task = task
+        self.user = user
+        self.priority = priority
+
+
+class JobScheduler:
+    """
+    Queues NIP90 jobs and runs them on a bounded number of async workers, so one slow job does not block
+    every other request and zap on the DVM.
+
+    Jobs are kept in two lanes (paid and free), each holding one FIFO queue per user. Workers always serve the
+    paid lane first and rotate between users inside a lane, so a burst of requests by one user can't starve
+    the others. Limits are read from the DVMConfig:
+
+    MAX_PARALLEL_JOBS: number of workers (jobs processed at the same time)
+    MAX_JOBS_IN_FLIGHT: max number of queued + running free jobs, further free jobs are rejected
+    MAX_JOBS_PER_TASK: max running jobs per task, 0 means unlimited
+    MAX_JOBS_PER_USER: max running jobs per user, 0 means unlimited
+    PROCESS_IN_THREAD: run the (potentially cpu bound) process function of a task in a thread pool
+    """
+
+    def __init__(self, dvm_config, work_function):
+        self.dvm_config = dvm_config
+        self.work_function = work_function
+        self.lanes = {PRIORITY_PAID: OrderedDict(), PRIORITY_FREE: OrderedDict()}
+        self.queued = {PRIORITY_PAID: 0, PRIORITY_FREE: 0}
+        self.running = 0
+        self.running_per_task = {}
+        self.running_per_user = {}
+        self.workers = []
+        self.condition = None
+        self.executor = None
+
+    def start(self):
+        self.condition = asyncio.Condition()
+        if self.dvm_config.PROCESS_IN_THREAD:
+            self.executor = ThreadPoolExecutor(max_workers=max(self.dvm_config.MAX_PARALLEL_JOBS, 1),
+                                               thread_name_prefix=self.dvm_config.IDENTIFIER + "_process")
+        for i in range(max(self.dvm_config.MAX_PARALLEL_JOBS, 1)):
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def in_flight(self):
+        return self.queued[PRIORITY_PAID] + self.queued[PRIORITY_FREE] + self.running
+
+    async def submit(self, event, amount, task="", paid=None) -> bool:
+        """Add a job to the queue. Returns False if the job was rejected because the DVM is at capacity."""
+        if paid is None:
+            paid = int(amount) > 0
+        priority = PRIORITY_PAID if paid else PRIORITY_FREE
+
+        # Paid jobs are never rejected, limits only apply to free jobs.
+        if (priority == PRIORITY_FREE and self.dvm_config.MAX_JOBS_IN_FLIGHT > 0
+                and self.queued[PRIORITY_FREE] + self.running >= self.dvm_config.MAX_JOBS_IN_FLIGHT):
+            print(bcolors.RED + "[" + self.dvm_config.NIP89.NAME + "] Job queue full (" + str(
+                self.in_flight()) + " jobs in flight), rejecting job " + event.id().to_hex() + bcolors.ENDC)
+            return False
+
+        user = event.author().to_hex()
+        job = ScheduledJob(event, amount, task, user, priority)
+        async with self.condition:
+            lane = self.lanes[priority]
+            if user not in lane:
+                lane[user] = deque()
+            lane[user].append(job)
+            self.queued[priority] += 1
+            self.condition.notify()
+
+        if self.dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
+            print("[" + self.dvm_config.NIP89.NAME + "] Scheduled job " + event.id().to_hex() + " (" + str(
+                self.in_flight()) + " jobs in flight)")
+        return True
+
+    async def run_process(self, dvm, request_form):
+        """Run the process function of a task, either on the event loop or in the thread pool."""
+        if self.executor is None:
+            return await dvm.process(request_form)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: asyncio.run(dvm.process(request_form)))
+
+    def _can_run(self, job):
+        if 0 < self.dvm_config.MAX_JOBS_PER_USER <= self.running_per_user.get(job.user, 0):
+            return False
+        if 0 < self.dvm_config.MAX_JOBS_PER_TASK <= self.running_per_task.get(job.task, 0):
+            return False
+        return True
+
+    def _pick(self):
+        for priority in (PRIORITY_PAID, PRIORITY_FREE):
+            lane = self.lanes[priority]
+            for user in list(lane.keys()):
+                jobs = lane[user]
+                if not self._can_run(jobs[0]):
+                    continue
+                job = jobs.popleft()
+                # round robin: the user goes to the back of the lane
+                del lane[user]
+                if len(jobs) > 0:
+                    lane[user] = jobs
+                self.queued[priority] -= 1
+                return job
+        return None
+
+    async def _next_job(self):
+        async with self.condition:
+            while True:
+                job = self._pick()
+                if job is not None:
+                    self.running += 1
+                    self.running_per_user[job.user] = self.running_per_user.get(job.user, 0) + 1
+                    self.running_per_task[job.task] = self.running_per_task.get(job.task, 0) + 1
+                    return job
+                await self.condition.wait()
+
+    async def _finish_job(self, job):
+        async with self.condition:
+            self.running -= 1
+            self.running_per_user[job.user] -= 1
+            if self.running_per_user[job.user] == 0:
+                del self.running_per_user[job.user]
+            self.running_per_task[job.task] -= 1
+            if self.running_per_task[job.task] == 0:
+                del self.running_per_task[job.task]
+            self.condition.notify_all()
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            try:
+                await self.work_function(job.event, job.amount)
+            except Exception as e:
+                print(bcolors.RED + "[" + self.dvm_config.NIP89.NAME + "] Error in job worker: " + str(
+                    e) + bcolors.ENDC)
+            finally:
+                await self._finish_job(job)
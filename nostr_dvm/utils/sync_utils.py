@@ -0,0 +1,224 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+from nostr_sdk import Keys, ClientBuilder, NostrSigner, Filter, Timestamp, SyncOptions, SyncDirection, LogLevel
+
+from nostr_dvm.utils.database_utils import get_database
+from nostr_dvm.utils.definitions import EventDefinitions
+from nostr_dvm.utils.zap_ledger_utils import ZapLedger
+
+
+class SyncRegistration:
+    __slots__ = ("name", "kinds", "window")
+
+    def __init__(self, name, kinds, window):
+        self.name = name
+        self.kinds = kinds
+        self.window = window
+
+
+class SyncCoordinator:
+    """
+    One coordinator per database and relay set, shared by all DVMs of a process. DVMs declare which kinds they need
+    for which time window, the coordinator merges these into one filter per window and syncs them incrementally:
+    after the first full sync only the time since the last sync (plus SYNC_OVERLAP seconds for late events) is
+    reconciled. Old events are pruned once per sync, using the largest window of each kind, and all DVMs using
+    the database are notified so they can recompute their results (see database_synced).
+    """
+
+    SYNC_OVERLAP = 300
+
+    coordinators = {}
+    listeners = {}  # db name -> {listener key: threading.Event}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(db_name, relays):
+        key = (db_name, tuple(sorted(relays)))
+        with SyncCoordinator.lock:
+            coordinator = SyncCoordinator.coordinators.get(key)
+            if coordinator is None:
+                coordinator = SyncCoordinator(db_name, relays)
+                SyncCoordinator.coordinators[key] = coordinator
+            return coordinator
+
+    @staticmethod
+    def listen(db_name, key):
+        with SyncCoordinator.lock:
+            listeners = SyncCoordinator.listeners.setdefault(db_name, {})
+            event = listeners.get(key)
+            if event is None:
+                event = threading.Event()
+                listeners[key] = event
+            return event
+
+    @staticmethod
+    def notify(db_name):
+        with SyncCoordinator.lock:
+            listeners = list(SyncCoordinator.listeners.get(db_name, {}).values())
+        for event in listeners:
+            event.set()
+
+    def __init__(self, db_name, relays):
+        self.db_name = db_name
+        self.relays = list(relays)
+        self.registrations = {}
+        self.lock = threading.Lock()
+        self.running = None
+        self.last_sync = 0
+        self.synced_windows = {}  # kind -> window that is completely synced
+
+    def register(self, name, kinds, window):
+        with self.lock:
+            self.registrations[name] = SyncRegistration(name, list(kinds), window)
+
+    def merged_windows(self):
+        """kind -> largest window any DVM needs it for"""
+        windows = {}
+        with self.lock:
+            for registration in self.registrations.values():
+                for kind in registration.kinds:
+                    key = kind.as_u16()
+                    if key not in windows or registration.window > windows[key][1]:
+                        windows[key] = (kind, registration.window)
+        return windows
+
+    def has_unsynced_windows(self):
+        """True if a DVM registered a kind, or a larger window, that the last sync didn't cover"""
+        return any(self.synced_windows.get(key, 0) < window for key, (kind, window) in self.merged_windows().items())
+
+    async def sync(self, dvm_config, max_age=0):
+        """
+        Sync unless another DVM synced less than max_age seconds ago and that sync covered all registered kinds
+        and windows. If a sync is running, wait for it, and sync again if it didn't cover them.
+        """
+        for attempt in range(2):
+            unsynced = self.has_unsynced_windows()
+            with self.lock:
+                running = self.running
+                if running is None:
+                    if time.time() - self.last_sync < max_age and not unsynced:
+                        return False
+                    running = Future()
+                    self.running = running
+                    start = True
+                else:
+                    start = False
+
+            if not start:
+                await asyncio.wrap_future(running)
+                if self.has_unsynced_windows():
+                    # registered while that sync was running
+                    continue
+                return True
+
+            try:
+                await self.run_sync(dvm_config)
+                SyncCoordinator.notify(self.db_name)
+            except Exception as e:
+                print("[" + dvm_config.NIP89.NAME + "] Sync of " + self.db_name + " failed: " + str(e))
+            finally:
+                with self.lock:
+                    self.running = None
+                running.set_result(True)
+            return True
+        return True
+
+    async def run_sync(self, dvm_config):
+        now = Timestamp.now().as_secs()
+        windows = self.merged_windows()
+        if len(windows) == 0:
+            return
+
+        # group kinds with the same since timestamp into one filter
+        groups = {}
+        for key, (kind, window) in windows.items():
+            since = now - window
+            if self.synced_windows.get(key, 0) >= window and self.last_sync > 0:
+                since = max(since, int(self.last_sync) - SyncCoordinator.SYNC_OVERLAP)
+            groups.setdefault(since, []).append(kind)
+
+        keys = Keys.parse(dvm_config.PRIVATE_KEY)
+        database = get_database(self.db_name)
+        cli = ClientBuilder().signer(NostrSigner.keys(keys)).database(database).build()
+        for relay in self.relays:
+            await cli.add_relay(relay)
+        await cli.connect()
+
+        started = time.time()
+        if dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
+            print("[" + dvm_config.NIP89.NAME + "] Syncing " + self.db_name + " for " + str(
+                len(self.registrations)) + " DVMs.. this might take a while..")
+        dbopts = SyncOptions().direction(SyncDirection.DOWN)
+        received = []
+        for since, kinds in groups.items():
+            output = await cli.sync(Filter().kinds(kinds).since(Timestamp.from_secs(since)), dbopts)
+            received.extend(output.report.received)
+
+        # Clear old events so db doesn't get too full.
+        prune = {}
+        for key, (kind, window) in windows.items():
+            prune.setdefault(window, []).append(kind)
+        for window, kinds in prune.items():
+            await database.delete(Filter().kinds(kinds).until(Timestamp.from_secs(now - window)))
+        await database.delete(Filter().until(Timestamp.from_secs(now - max(prune.keys()))))
+        await cli.shutdown()
+
+        # keep the zap ledger of the database in line, if a DVM uses one
+        ledger = ZapLedger.find(self.db_name)
+        zap_kind = EventDefinitions.KIND_ZAP.as_u16()
+        if ledger is not None and zap_kind in windows:
+            await ledger.index_events(database, received)
+            ledger.prune(now - windows[zap_kind][1])
+
+        for key, (kind, window) in windows.items():
+            self.synced_windows[key] = window
+        self.last_sync = started
+        if dvm_config.LOGLEVEL.value >= LogLevel.DEBUG.value:
+            print("[" + dvm_config.NIP89.NAME + "] Done syncing " + self.db_name + " in " + str(
+                round(time.time() - started, 2)) + " seconds..")
+
+
+async def sync_database(dvm_config, db_name, kinds, db_since):
+    """
+    Let the SyncCoordinator of db_name sync the kinds of the last db_since seconds, together with the needs of the
+    other DVMs using that database. The sync is skipped if another DVM synced within this DVM's update interval.
+    """
+    coordinator = SyncCoordinator.get(db_name, dvm_config.SYNC_DB_RELAY_LIST)
+    coordinator.register(dvm_config.IDENTIFIER, kinds, db_since)
+    synced = await coordinator.sync(dvm_config, dvm_config.SCHEDULE_UPDATES_SECONDS)
+    # the calling DVM recomputes right after syncing, it doesn't need to be notified
+    SyncCoordinator.listen(db_name, id(dvm_config)).clear()
+    return synced
+
+
+def synced_database(kinds, max_age=600):
+    """
+    (name, since) of the database synced less than max_age seconds ago that has all events of the kinds since
+    `since` (unix time), the one reaching back furthest if there are several. (None, None) if there is none.
+    """
+    now = time.time()
+    with SyncCoordinator.lock:
+        coordinators = list(SyncCoordinator.coordinators.values())
+    best = (None, None)
+    for coordinator in coordinators:
+        if coordinator.last_sync == 0 or now - coordinator.last_sync > max_age:
+            continue
+        windows = [coordinator.synced_windows.get(kind.as_u16(), 0) for kind in kinds]
+        if len(windows) == 0 or not all(window > 0 for window in windows):
+            continue
+        since = int(coordinator.last_sync) - min(windows)
+        if best[1] is None or since < best[1]:
+            best = (coordinator.db_name, since)
+    return best
+
+
+def database_synced(dvm_config, db_name):
+    """True once after each sync of db_name, so DVMs can recompute their results with the new events."""
+    event = SyncCoordinator.listen(db_name, id(dvm_config))
+    if event.is_set():
+        event.clear()
+        return True
+    return False
@@ -0,0 +1,248 @@
+import asyncio
+import re
+import threading
+from concurrent.futures import Future
+from functools import lru_cache
+
+from nostr_sdk import Filter, Timestamp
+
+from nostr_dvm.utils.definitions import EventDefinitions
+
+HASHTAG = re.compile(r"#?\w+", re.UNICODE)
+NO_TERMS = frozenset()
+
+
+def normalize_term(term):
+    return str(term).casefold()
+
+
+def hashtag_of(term):
+    """The hashtag a term stands for (" cat " and "#cat" both stand for the t tag "cat"), None if it isn't one"""
+    word = term.strip()
+    if not HASHTAG.fullmatch(word):
+        return None
+    return word.lstrip("#")
+
+
+class TermSet:
+    """
+    A set of terms compiled into one regex, so a text is scanned once for all of them.
+
+    Terms match as case-folded substrings of the content, like the search of the database does. Terms that are a
+    single word (with or without #) also match a `t` tag with that word.
+    """
+
+    def __init__(self, terms):
+        self.terms = sorted({normalize_term(term) for term in terms if term}, key=len, reverse=True)
+        # the alternatives are tried longest first inside a lookahead, so every position reports the longest term
+        # starting there. Shorter terms starting at the same position are prefixes of it and are added by contains.
+        self.pattern = re.compile("(?=(" + "|".join(re.escape(term) for term in self.terms) + "))") \
+            if self.terms else None
+        self.contains = {term: frozenset(other for other in self.terms if other in term) for term in self.terms}
+        self.hashtags = {}
+        for term in self.terms:
+            hashtag = hashtag_of(term)
+            if hashtag is not None:
+                self.hashtags.setdefault(hashtag, set()).add(term)
+
+    def find(self, content, hashtags=()):
+        """The terms in content or hashtags, as a frozenset"""
+        if self.pattern is None:
+            return NO_TERMS
+        found = set()
+        for longest in {match.group(1) for match in self.pattern.finditer(content.casefold())}:
+            found.update(self.contains[longest])
+        for hashtag in hashtags:
+            terms = self.hashtags.get(hashtag.casefold().lstrip("#"))
+            if terms is not None:
+                found.update(terms)
+        return frozenset(found) if found else NO_TERMS
+
+    def find_in_event(self, event):
+        return self.find(event.content(), event_hashtags(event))
+
+
+class TopicMatcher:
+    """
+    Decides if a note belongs to a topic: it has to contain one of the search terms (if there are any), all of the
+    must terms and none of the avoid terms. All lists are compiled into one TermSet, so each note is scanned once.
+    Use TopicMatcher.get(...) to share matchers for the same lists.
+    """
+
+    def __init__(self, search_list=(), must_list=(), avoid_list=()):
+        self.search = frozenset(normalize_term(term) for term in search_list if term)
+        self.must = frozenset(normalize_term(term) for term in must_list if term)
+        self.avoid = frozenset(normalize_term(term) for term in avoid_list if term)
+        self.terms = self.search | self.must | self.avoid
+        self.term_set = TermSet(self.terms)
+
+    @staticmethod
+    @lru_cache(maxsize=128)
+    def _get(search_list, must_list, avoid_list):
+        return TopicMatcher(search_list, must_list, avoid_list)
+
+    @staticmethod
+    def get(search_list=(), must_list=(), avoid_list=()):
+        return TopicMatcher._get(tuple(search_list), tuple(must_list), tuple(avoid_list))
+
+    def accepts(self, found):
+        """Decide on the terms found in a note (see TermSet.find)"""
+        if self.search and self.search.isdisjoint(found):
+            return False
+        if not self.must <= found:
+            return False
+        return self.avoid.isdisjoint(found)
+
+    def matches(self, content, hashtags=()):
+        return self.accepts(self.term_set.find(content, hashtags))
+
+    def matches_event(self, event):
+        return self.accepts(self.term_set.find_in_event(event))
+
+
+class TopicIndex:
+    """
+    Classifies the notes of a database once for all topic DVMs using it. Each DVM registers its TopicMatcher, the
+    terms of all matchers are compiled into one TermSet and every note is scanned once for all of them. The found
+    terms are kept per note, so asking for the notes of a topic only classifies the notes that came in since the
+    last request (plus OVERLAP seconds for late events). If the number of notes in the database doesn't match the
+    index (e.g. because old events were pruned), the window is queried again and only unknown notes are scanned.
+
+    A matcher with terms the index doesn't know yet resets the index, the next request scans the window again.
+    Use TopicIndex.get(db_name) to get the shared index of a database.
+    """
+
+    OVERLAP = 300
+
+    indexes = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(db_name):
+        with TopicIndex.lock:
+            index = TopicIndex.indexes.get(db_name)
+            if index is None:
+                index = TopicIndex(db_name)
+                TopicIndex.indexes[db_name] = index
+            return index
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.lock = threading.Lock()
+        self.terms = frozenset()
+        self.term_set = TermSet([])
+        self.notes = {}  # event id (hex) -> (created_at, found terms)
+        self.covered_since = None  # all notes since then are classified
+        self.newest = 0
+        self.window = 0  # largest window any DVM asked for, older notes are forgotten
+        self.running = None
+        self.classified = 0
+
+    def register(self, matcher):
+        with self.lock:
+            if matcher.terms <= self.terms:
+                return
+            self.terms = self.terms | matcher.terms
+            self.term_set = TermSet(self.terms)
+            self.notes = {}
+            self.covered_since = None
+            self.newest = 0
+
+    async def matching(self, database, matcher, since):
+        """Ids (hex) of the notes since `since` (unix time) that match the topic, newest first"""
+        for attempt in range(3):
+            self.register(matcher)
+            await self.refresh(database, since)
+            with self.lock:
+                # another DVM might have registered new terms in the meantime, which resets the index
+                if self.covered_since is not None and self.covered_since <= since:
+                    break
+        with self.lock:
+            notes = [(created_at, event_id) for event_id, (created_at, found) in self.notes.items()
+                     if created_at >= since and matcher.accepts(found)]
+        notes.sort(reverse=True)
+        return [event_id for created_at, event_id in notes]
+
+    async def refresh(self, database, since):
+        """Classify the notes since `since` that aren't classified yet. If a refresh is running, wait for it."""
+        while True:
+            with self.lock:
+                running = self.running
+                if running is None:
+                    running = Future()
+                    self.running = running
+                    break
+            await asyncio.wrap_future(running)
+
+        try:
+            await self._refresh(database, since)
+        finally:
+            with self.lock:
+                self.running = None
+            running.set_result(True)
+
+    async def _refresh(self, database, since):
+        with self.lock:
+            term_set = self.term_set
+            covered = self.covered_since is not None and self.covered_since <= since
+            query_since = max(since, self.newest - self.OVERLAP) if covered else since
+
+        self._classify(term_set, await self._query(database, query_since))
+        in_database = await database.count(Filter().kind(EventDefinitions.KIND_NOTE)
+                                           .since(Timestamp.from_secs(since)))
+        if in_database != self._count(since):
+            # late or pruned events, check the whole window. Notes we already know aren't scanned again.
+            events = await self._query(database, since)
+            self._classify(term_set, events)
+            ids = {event.id().to_hex() for event in events}
+            with self.lock:
+                self.notes = {event_id: note for event_id, note in self.notes.items()
+                              if note[0] < since or event_id in ids}
+
+        with self.lock:
+            if self.term_set is term_set:
+                self.covered_since = since if self.covered_since is None else min(since, self.covered_since)
+            self.window = max(self.window, Timestamp.now().as_secs() - since)
+        self.prune(Timestamp.now().as_secs() - self.window - self.OVERLAP)
+
+    async def _query(self, database, since):
+        events = await database.query(Filter().kind(EventDefinitions.KIND_NOTE).since(Timestamp.from_secs(since)))
+        return events.to_vec()
+
+    def _classify(self, term_set, events):
+        classified = {}
+        with self.lock:
+            known = set(self.notes)
+        newest = 0
+        for event in events:
+            event_id = event.id().to_hex()
+            created_at = event.created_at().as_secs()
+            newest = max(newest, created_at)
+            if event_id not in known:
+                classified[event_id] = (created_at, term_set.find_in_event(event))
+        with self.lock:
+            # terms changed while we were scanning, the index has been reset and these results are outdated
+            if self.term_set is not term_set:
+                return
+            self.notes.update(classified)
+            self.newest = max(self.newest, newest)
+            self.classified += len(classified)
+
+    def _count(self, since):
+        with self.lock:
+            return sum(1 for created_at, found in self.notes.values() if created_at >= since)
+
+    def prune(self, until):
+        """Forget the notes older than until (unix time)"""
+        with self.lock:
+            self.notes = {event_id: note for event_id, note in self.notes.items() if note[0] >= until}
+            if self.covered_since is not None:
+                self.covered_since = max(self.covered_since, until)
+
+    def stats(self):
+        with self.lock:
+            return {"notes": len(self.notes), "terms": len(self.terms), "classified": self.classified}
+
+
+def event_hashtags(event):
+    return [tag.as_vec()[1] for tag in event.tags().to_vec() if len(tag.as_vec()) > 1 and tag.as_vec()[0] == "t"]
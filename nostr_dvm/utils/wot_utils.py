@@ -1,22 +1,119 @@
 import asyncio
+import collections
 import datetime
+import hashlib
 # General
 import json
+import os
 import random
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, Future
 from itertools import islice
 
 import networkx as nx
 import nostr_sdk
 import numpy as np
-from nostr_sdk import Options, Keys, NostrSigner, ClientBuilder, Kind, PublicKey, Filter
-from scipy.sparse import lil_matrix, isspmatrix_csr
+from nostr_sdk import Options, Keys, NostrSigner, ClientBuilder, Kind, PublicKey, Filter, RelayLimits
+from scipy.sparse import lil_matrix, isspmatrix_csr, csr_matrix, coo_matrix
 
 from nostr_dvm.utils.definitions import relay_timeout
 from nostr_dvm.utils.dvmconfig import DVMConfig
 from nostr_dvm.utils.nostr_utils import check_and_set_private_key
 
 
+class FollowCrawler:
+    """
+    Fetches follow lists (kind 3) over one connected client. Batches of authors are fetched concurrently, at most
+    `concurrency` at a time, each waiting up to max_time_request seconds for the relays. If relays return
+    different kind 3 events of an author, the newest one is used.
+    """
+
+    def __init__(self, dvm_config=DVMConfig(), max_time_request=10, concurrency=8):
+        self.dvm_config = dvm_config
+        self.timeout = datetime.timedelta(seconds=max_time_request)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.client = None
+
+    async def connect(self):
+        keys = Keys.parse(check_and_set_private_key("test_client"))
+        self.client = ClientBuilder().signer(NostrSigner.keys(keys)).opts(
+            Options().relay_limits(RelayLimits.disable())).build()
+        for relay in self.dvm_config.SYNC_DB_RELAY_LIST:
+            await self.client.add_relay(relay)
+        await self.client.connect()
+
+    async def shutdown(self):
+        if self.client is not None:
+            await self.client.shutdown()
+            self.client = None
+
+    async def fetch(self, pks, newer_than_time=None):
+        """
+        OUTPUT: {author (hex): (timestamp, [followed pubkeys (hex)])} for the authors with a kind 3 event
+        > it's possible to limit the search to events newer_than_time
+        """
+        list_pk = [nostr_sdk.PublicKey.parse(pk) for pk in pks]
+        filter = Filter().authors(list_pk).kind(Kind(3))
+        if newer_than_time is not None:
+            filter = filter.since(nostr_sdk.Timestamp.from_secs(round(newer_than_time)))
+
+        async with self.semaphore:
+            events = await self.client.fetch_events(filter, self.timeout)
+
+        follows = {}
+        for event in events.to_vec():
+            author = event.author().to_hex()
+            timestamp = event.created_at().as_secs()
+            if author in follows and follows[author][0] >= timestamp:
+                continue
+            if not event.verify():
+                continue
+            # converting to hex and removing self-following
+            followed = [pk.to_hex() for pk in event.tags().public_keys() if pk.to_hex() != author]
+            follows[author] = (timestamp, followed)
+        return follows
+
+    async def crawl(self, batches):
+        """
+        Fetches all batches [(pks, newer_than_time), ...] concurrently and yields (pks, follows) as they arrive.
+        follows is None if the batch couldn't be fetched, so callers don't take its authors for following nobody.
+        """
+        tic = time.time()
+        tasks = [asyncio.ensure_future(self._fetch_batch(pks, newer_than_time)) for pks, newer_than_time in batches]
+        done = 0
+        lists = 0
+        try:
+            for task in asyncio.as_completed(tasks):
+                pks, follows = await task
+                done += 1
+                lists += len(follows) if follows is not None else 0
+                print('WOT: ' + str(done) + '/' + str(len(tasks)) + ' batches, ' + str(lists) + ' follow lists, ' +
+                      str(round(lists / max(time.time() - tic, 0.001))) + ' lists/s', end='\r')
+                yield pks, follows
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _fetch_batch(self, pks, newer_than_time):
+        try:
+            return pks, await self.fetch(pks, newer_than_time)
+        except Exception as e:
+            print('WOT: fetching ' + str(len(pks)) + ' follow lists failed: ' + str(e))
+            return pks, None
+
+
+def _following_graph(pks, follows):
+    # a networkx graph, each node with a kind 3 has the timestamp of it
+    following = nx.DiGraph()
+    following.add_nodes_from(pks)
+    for author, (timestamp, followed) in follows.items():
+        if author in following.nodes():
+            following.update(edges=[(author, pk) for pk in followed], nodes=followed)
+            following.nodes[author]['timestamp'] = timestamp
+    return following
+
+
 async def get_following(pks, max_time_request=10, newer_than_time=None, dvm_config=DVMConfig()):
     '''
         OUTPUT: following; a networkx graph
@@ -25,68 +122,22 @@ async def get_following(pks, max_time_request=10, newer_than_time=None, dvm_conf
         > it's possible to limit the search to events newer_than_time
 
         NOTE: do not get_following of more than 1000 pks;
-        instead, divide the request into batches of smaller size (500 recommended)
+        instead, divide the request into batches of smaller size (500 recommended),
+        or use a FollowCrawler to fetch many batches over one connection
     '''
 
     # handling the case of a single key passed
     if type(pks) == str:
         pks = [pks]
 
-    # transforming into PubKey object type
-    list_pk = [nostr_sdk.PublicKey.parse(pk) for pk in pks]
-
-    # newer_than_time provided? If so, it only fetch events that are newer
-    if newer_than_time is None:
-        filter = Filter().authors(list_pk).kind(Kind(3))
-
-    else:
-        newer_than_time = round(newer_than_time)
-        ts = nostr_sdk.Timestamp().from_secs(newer_than_time)
-        filter = Filter().authors(list_pk).kind(Kind(3)).since(ts)
-
-    # fetching events
-    keys = Keys.parse(check_and_set_private_key("test_client"))
-    cli = ClientBuilder().signer(NostrSigner.keys(keys)).build()
-
-    for relay in dvm_config.SYNC_DB_RELAY_LIST:
-        await cli.add_relay(relay)
-
-    await cli.connect()
-
-    events = await cli.fetch_events(filter, relay_timeout)
-
-    for relay in dvm_config.SYNC_DB_RELAY_LIST:
-        await cli.force_remove_relay(relay)
-
-    await cli.shutdown()
-    # initializing the graph structure
-    following = nx.DiGraph()
-    following.add_nodes_from(pks)
-
-    if not events.to_vec():
-        return following
-
-    for event in events.to_vec():
-
-        author = event.author().to_hex()
-
-        # events are returned based on the timestamp,
-        # the first event for each pubkey is the most recent = the one we should use
-
-        if event.verify() and author in following.nodes() and 'timestamp' not in following.nodes[author]:
-            # updating the nodes and edges
-            nodes = event.tags().public_keys() # TODO
-
-            # converting to hex and removing self-following
-            nodes = [pk.to_hex() for pk in nodes if pk.to_hex() != author]
-
-            following.update(edges=[(author, pk) for pk in nodes], nodes=nodes)
-
-            # updating the timestamp
-            tp = event.created_at().as_secs()
-            following.nodes[author]['timestamp'] = tp
+    crawler = FollowCrawler(dvm_config, max_time_request)
+    await crawler.connect()
+    try:
+        follows = await crawler.fetch(pks, newer_than_time)
+    finally:
+        await crawler.shutdown()
 
-    return following
+    return _following_graph(pks, follows)
 
 
 async def build_wot_network(seed_pks, depth=2, max_batch=500, max_time_request=10, dvm_config=DVMConfig()):
@@ -137,40 +188,41 @@ async def _build_network_from(index_map, network_graph, visited_pk=None, depth=2
 
     '''
 
-    # pks to be visited next, splitted in batches
     if visited_pk is None:
         visited_pk = set()
-    to_visit_pk = split_set(index_map.keys() - visited_pk, max_batch)
-
-    for pks in to_visit_pk:
-        # getting the followings as a graph
-        following = await get_following(pks, max_time_request, None, dvm_config)
-
-        # update the visited_pk
-        visited_pk.update(pks)
 
-        # add the new pub_keys to the index_map
-        index_map = _extend_index_map(index_map, following)
+    crawler = FollowCrawler(dvm_config, max_time_request)
+    await crawler.connect()
+    try:
+        for hop in range(depth):
+            # pks to be visited next, splitted in batches that are fetched concurrently
+            to_visit_pk = split_set(index_map.keys() - visited_pk, max_batch)
 
-        # re-lable nodes using the index_map to use storage more efficiently
-        nx.relabel_nodes(following, index_map, copy=False)
+            try:
+                async for pks, follows in crawler.crawl([(pks, None) for pks in to_visit_pk]):
+                    if follows is None:
+                        # not visited, the next hop tries again
+                        continue
+                    # getting the followings as a graph
+                    following = _following_graph(pks, follows)
 
-        # extend the network graph
-        network_graph.update(following)
+                    # update the visited_pk
+                    visited_pk.update(pks)
 
-    if depth == 1:
-        return index_map, network_graph
+                    # add the new pub_keys to the index_map
+                    index_map = _extend_index_map(index_map, following)
 
-    else:
+                    # re-lable nodes using the index_map to use storage more efficiently
+                    nx.relabel_nodes(following, index_map, copy=False)
 
-        # recursive call
-        try:
-            index_map, network_graph = await _build_network_from(index_map, network_graph, visited_pk, depth - 1, max_batch,
-                                                                 max_time_request, dvm_config=dvm_config)
-        except BaseException as e:
-            print(e)
+                    # extend the network graph
+                    network_graph.update(following)
+            except BaseException as e:
+                print(e)
 
-    print('current network: ' + str(len(network_graph.nodes())) + ' npubs', end='\r')
+            print('\ncurrent network: ' + str(len(network_graph.nodes())) + ' npubs', end='\r')
+    finally:
+        await crawler.shutdown()
 
     return index_map, network_graph
 
@@ -202,23 +254,9 @@ def save_network(index_map, network_graph, name=None):
     if name is None:
         # adding unix time to file name to avoid replacing an existing file
         name = str(round(time.time()))
-    # filename = os.path.join('/cache/', 'index_map_' + name + '.json')
-    filename = 'index_map_' + name + '.json'
-    # saving the index_map as a json file
-    with open(filename, 'w') as f:
-        json.dump(index_map, f, indent=4)
-
-    # Convert to node-link format suitable for JSON
-    data = nx.node_link_data(network_graph)
 
-    # saving the network_graph as a json file
-    # filename = os.path.join('/cache/', 'network_graph_' + name + '.json')
-    filename = 'network_graph_' + name + '.json'
-    with open(filename, 'w') as f:
-        json.dump(data, f)
-
-    print(' > index_map_' + name + '.json')
-    print(' > network_graph_' + name + '.json')
+    directory = WotGraph.from_network(index_map, network_graph).save(name)
+    print(' > ' + directory)
 
     return
 
@@ -227,11 +265,13 @@ def load_network(name):
     if type(name) != str:
         name = str(name)
 
-    # loading the index_map
+    if WotGraph.exists(name):
+        return WotGraph.load(name).to_network()
+
+    # networks saved as json by previous versions
     with open('index_map_' + name + '.json', 'r') as f:
         index_map = json.load(f)
 
-    # loading the JSON for the graph
     with open('network_graph_' + name + '.json', 'r') as f:
         data = json.load(f)
 
@@ -241,10 +281,353 @@ def load_network(name):
     return index_map, network_graph
 
 
-def get_mc_pagerank(G, R, nodelist=None, alpha=0.85):
+class WotGraph:
+    """
+    Compact follow graph: every pubkey is interned once as a 32 byte row of a NumPy array and referred to by its
+    index. Follows are stored as a CSR adjacency (node i follows indices[indptr[i]:indptr[i + 1]]) and every node
+    has the timestamp of its latest known kind 3 event (0 if it is a leaf or we don't know its follows).
+
+    Graphs are saved as one .npy file per array and loaded memory-mapped, so loading takes milliseconds
+    regardless of the size of the graph. The pubkey -> index table is built on first use.
+    """
+
+    FILES = ("pubkeys", "indptr", "indices", "timestamps")
+
+    def __init__(self, pubkeys, indptr, indices, timestamps):
+        self.pubkeys = pubkeys  # (N, 32) uint8
+        self.indptr = indptr  # (N + 1) int64
+        self.indices = indices  # (E) int32
+        self.timestamps = timestamps  # (N) int64
+        self._index = None
+
+    @staticmethod
+    def from_edges(pubkeys, sources, targets, timestamps=None):
+        """
+        pubkeys: list of pubkeys (hex) or (N, 32) uint8 array, sources/targets: indices of follower and followed.
+        Duplicate edges are kept once.
+        """
+        if not isinstance(pubkeys, np.ndarray):
+            pubkeys = intern_pubkeys(pubkeys)
+        N = len(pubkeys)
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+
+        # sort by (source, target) and drop duplicates
+        order = np.lexsort((targets, sources))
+        sources, targets = sources[order], targets[order]
+        if len(sources) > 0:
+            keep = np.ones(len(sources), dtype=bool)
+            keep[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+            sources, targets = sources[keep], targets[keep]
+
+        indptr = np.zeros(N + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=N), out=indptr[1:])
+        if timestamps is None:
+            timestamps = np.zeros(N, dtype=np.int64)
+        return WotGraph(pubkeys, indptr, targets.astype(np.int32), np.asarray(timestamps, dtype=np.int64))
+
+    @staticmethod
+    def from_network(index_map, network_graph):
+        """Converts the (index_map, networkx graph) pair returned by build_wot_network"""
+        pubkeys = [None] * len(index_map)
+        for pubkey, index in index_map.items():
+            pubkeys[int(index)] = pubkey
+        edges = np.array(list(network_graph.edges()), dtype=np.int64).reshape(-1, 2)
+        timestamps = np.zeros(len(pubkeys), dtype=np.int64)
+        for node, timestamp in network_graph.nodes(data='timestamp'):
+            if timestamp is not None:
+                timestamps[int(node)] = timestamp
+        return WotGraph.from_edges(pubkeys, edges[:, 0], edges[:, 1], timestamps)
+
+    def to_network(self):
+        """Returns the (index_map, networkx graph) pair, as build_wot_network does"""
+        network_graph = nx.DiGraph()
+        network_graph.add_nodes_from(range(len(self)))
+        for node in np.flatnonzero(self.timestamps):
+            network_graph.nodes[int(node)]['timestamp'] = int(self.timestamps[node])
+        sources = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        network_graph.add_edges_from(zip(sources.tolist(), self.indices.tolist()))
+        return self.index_map(), network_graph
+
+    def __len__(self):
+        return len(self.pubkeys)
+
+    def number_of_edges(self):
+        return int(self.indptr[-1])
+
+    def successors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def out_degrees(self):
+        return np.diff(self.indptr)
+
+    def index(self, pubkey):
+        """index of a pubkey (hex, npub or 32 bytes), None if it is not part of the graph"""
+        if self._index is None:
+            data = self.pubkeys.tobytes()
+            index = {}
+            for i in range(len(self)):
+                index.setdefault(data[i * 32:(i + 1) * 32], i)
+            self._index = index
+        if not isinstance(pubkey, bytes):
+            pubkey = _pubkey_to_bytes(pubkey)
+        return self._index.get(pubkey)
+
+    def hex(self, node):
+        return self.pubkeys[node].tobytes().hex()
+
+    def hex_keys(self, nodes=None):
+        pubkeys = self.pubkeys if nodes is None else self.pubkeys[np.asarray(nodes, dtype=np.int64)]
+        data = pubkeys.tobytes().hex()
+        return [data[i:i + 64] for i in range(0, len(data), 64)]
+
+    def public_keys(self, nodes=None):
+        return [PublicKey.parse(pubkey) for pubkey in self.hex_keys(nodes)]
+
+    def index_map(self):
+        return {pubkey: i for i, pubkey in enumerate(self.hex_keys())}
+
+    def save(self, name, directory=''):
+        directory = os.path.join(directory, 'wot_graph_' + str(name))
+        os.makedirs(directory, exist_ok=True)
+        for file in WotGraph.FILES:
+            np.save(os.path.join(directory, file + '.npy'), getattr(self, file))
+        return directory
+
+    @staticmethod
+    def load(name, mmap=True, directory=''):
+        directory = os.path.join(directory, 'wot_graph_' + str(name))
+        arrays = [np.load(os.path.join(directory, file + '.npy'), mmap_mode='r' if mmap else None)
+                  for file in WotGraph.FILES]
+        return WotGraph(*arrays)
+
+    @staticmethod
+    def exists(name, directory=''):
+        return os.path.exists(os.path.join(directory, 'wot_graph_' + str(name), WotGraph.FILES[-1] + '.npy'))
+
+
+def _pubkey_to_bytes(pubkey):
+    if len(pubkey) != 64:
+        pubkey = PublicKey.parse(pubkey).to_hex()
+    return bytes.fromhex(pubkey)
+
+
+def intern_pubkeys(pubkeys):
+    """list of pubkeys (hex or npub) -> (N, 32) uint8 array"""
+    try:
+        data = bytes.fromhex("".join(pubkeys))
+    except ValueError:
+        data = b"".join(_pubkey_to_bytes(pubkey) for pubkey in pubkeys)
+    if len(data) != 32 * len(pubkeys):
+        data = b"".join(_pubkey_to_bytes(pubkey) for pubkey in pubkeys)
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, 32).copy()
+
+
+def sparse_pagerank(sources, targets, N, alpha=0.85, personalization=None, max_iter=100, tol=1e-06):
+    '''
+        Pagerank by power iteration on a scipy sparse matrix, same results as networkx.pagerank on the graph
+
+        INPUTS
+        ------
+        sources, targets: arrays
+            the edges of the graph as node indices, duplicate edges count once
+
+        N: int
+            the number of nodes
+
+        alpha: float, optional
+            It is the dampening factor of Pagerank. default value is 0.85
+
+        personalization: dict, optional
+            {node index: weight}, the random walks restart at these nodes (and dangling nodes link to them).
+            default is uniform over all nodes
+
+        OUTPUTS
+        -------
+        pagerank: numpy array
+            the pagerank value of each node index
+    '''
+
+    if N == 0:
+        return np.zeros(0)
+
+    A = coo_matrix((np.ones(len(sources), dtype=np.float64), (sources, targets)), shape=(N, N)).tocsr()
+    # duplicate edges have been summed up
+    A.data[:] = 1.0
+    out_degree = np.asarray(A.sum(axis=1)).flatten()
+    is_dangling = out_degree == 0
+    out_degree[~is_dangling] = 1.0 / out_degree[~is_dangling]
+    Q = csr_matrix(A.multiply(out_degree[:, np.newaxis]))
+
+    if personalization is None:
+        p = np.full(N, 1.0 / N)
+    else:
+        p = np.zeros(N)
+        for node, weight in personalization.items():
+            p[node] = weight
+        p = p / p.sum()
+
+    x = np.full(N, 1.0 / N)
+    for _ in range(max_iter):
+        xlast = x
+        x = alpha * (x @ Q + x[is_dangling].sum() * p) + (1 - alpha) * p
+        # same convergence criterion as networkx
+        if np.abs(x - xlast).sum() < N * tol:
+            return x
+    print('pagerank: power iteration did not converge in ' + str(max_iter) + ' iterations')
+    return x
+
+
+def get_mc_pagerank(G, R, nodelist=None, alpha=0.85, seed=None, batch_size=1000000, processes=1):
     '''
         Monte-Carlo complete path stopping at dandling nodes
 
+        Same algorithm as get_mc_pagerank_python, but G is converted to a CSR adjacency once and all walks
+        are performed in parallel as NumPy batches.
+
+        INPUTS
+        ------
+        G: graph
+            A directed Networkx graph. This function cannot work on directed graphs.
+
+        R: int
+            The number of random walks to be performed per node
+
+        nodelist: list, optional
+            the list of nodes in G networkx graph.
+            It is used to order the nodes in a specified way
+
+        alpha: float, optional
+            It is the dampening factor of Pagerank. default value is 0.85
+
+        seed: int, optional
+            seed of the random number generator, for reproducible results
+
+        batch_size: int, optional
+            the maximum number of walks performed at once, limits the memory used
+
+        processes: int, optional
+            the number of processes the walks are split across. default value is 1
+
+        OUTPUTS
+        -------
+        walk_visited_count: CSR matrix
+            a Compressed Sparse Row (CSR) matrix; element (i,j) is equal to
+            the number of times v_j has been visited by a random walk started from v_i
+
+        mc_pagerank: dict
+            The dictionary {node: pg} of the pagerank value for each node in G
+
+        References
+        ----------
+        [1] K.Avrachenkov, N. Litvak, D. Nemirovsky, N. Osipova
+        "Monte Carlo methods in PageRank computation: When one iteration is sufficient"
+        https://www-sop.inria.fr/members/Konstantin.Avratchenkov/pubs/mc.pdf
+    '''
+
+    # validate all the inputs and initialize variables
+    N, nodelist, inverse_nodelist = _validate_inputs_and_init_mc(G, R, nodelist, alpha)
+
+    indptr, indices = _graph_to_csr(G, nodelist, inverse_nodelist)
+
+    # R walks for each node
+    starts = np.repeat(np.arange(N, dtype=np.int64), R)
+
+    walk_visited_count = _run_walks(indptr, indices, starts, alpha, seed, batch_size, processes, N)
+
+    # sum all visits for each node into a numpy array
+    total_visited_count = np.array(walk_visited_count.sum(axis=0)).flatten()
+
+    # reciprocal of the number of total visits
+    one_over_s = 1 / total_visited_count.sum()
+
+    mc_pagerank = {nodelist[j]: total_visited_count[j] * one_over_s for j in range(N)}
+
+    print('Total walks performed: ', N * R)
+
+    return walk_visited_count, mc_pagerank
+
+
+def _graph_to_csr(G, nodelist, inverse_nodelist):
+    '''
+    This function converts the adjacency of G into CSR arrays (indptr, indices) in the order of nodelist
+    '''
+
+    N = len(nodelist)
+    degrees = np.fromiter((G.out_degree(node) for node in nodelist), dtype=np.int64, count=N)
+    indptr = np.zeros(N + 1, dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+    indices = np.fromiter((inverse_nodelist[succ] for node in nodelist for succ in G.successors(node)),
+                          dtype=np.int64, count=int(indptr[-1]))
+    return indptr, indices
+
+
+def _csr_walks(indptr, indices, starts, alpha, rng):
+    '''
+    This function performs one random walk from each position in starts on the CSR graph (indptr, indices).
+    Like the pure python walks, a walk continues with probability alpha and stops at dangling nodes.
+    It returns two arrays (walk index, visited position) with one entry per visit, including the start.
+    '''
+
+    current = starts.copy()
+    walk_ids = np.arange(len(starts), dtype=np.int64)
+    visited_walks = [walk_ids]
+    visited_nodes = [current]
+
+    while len(current) > 0:
+        start = indptr[current]
+        degree = indptr[current + 1] - start
+        go_on = (rng.random(len(current)) < alpha) & (degree > 0)
+        if not go_on.any():
+            break
+        current = indices[start[go_on] + (rng.random(int(go_on.sum())) * degree[go_on]).astype(np.int64)]
+        walk_ids = walk_ids[go_on]
+        visited_walks.append(walk_ids)
+        visited_nodes.append(current)
+
+    return np.concatenate(visited_walks), np.concatenate(visited_nodes)
+
+
+def _walk_batches(indptr, indices, starts, alpha, seed, batch_size, N):
+    '''
+    This function performs the walks for starts in batches, and returns the (start, visited) count matrix as CSR
+    '''
+
+    rng = np.random.default_rng(seed)
+    visited_count = csr_matrix((N, N), dtype=np.int64)
+    for batch in range(0, len(starts), batch_size):
+        batch_starts = starts[batch:batch + batch_size]
+        walks, visited = _csr_walks(indptr, indices, batch_starts, alpha, rng)
+        # duplicate (row, col) pairs are summed up when converting to CSR
+        visited_count = visited_count + coo_matrix((np.ones(len(walks), dtype=np.int64),
+                                                    (batch_starts[walks], visited)), shape=(N, N)).tocsr()
+    return visited_count
+
+
+def _run_walks(indptr, indices, starts, alpha, seed, batch_size, processes, N):
+    '''
+    This function performs the walks, optionally split across a process pool with independent random streams
+    '''
+
+    if processes <= 1 or len(starts) < 2 * batch_size:
+        return _walk_batches(indptr, indices, starts, alpha, seed, batch_size, N)
+
+    seeds = np.random.SeedSequence(seed).spawn(processes)
+    shards = np.array_split(starts, processes)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(_walk_batches, [indptr] * processes, [indices] * processes, shards,
+                               [alpha] * processes, seeds, [batch_size] * processes, [N] * processes)
+        visited_count = csr_matrix((N, N), dtype=np.int64)
+        for result in results:
+            visited_count = visited_count + result
+    return visited_count
+
+
+def get_mc_pagerank_python(G, R, nodelist=None, alpha=0.85):
+    '''
+        Monte-Carlo complete path stopping at dandling nodes, one walk at a time in pure python.
+        This is the reference implementation of get_mc_pagerank, which is much faster.
+
         INPUTS
         ------
         G: graph
@@ -364,7 +747,7 @@ def _validate_inputs_and_init_mc(G, R, nodelist, alpha):
     return N, nodelist, inverse_nodelist
 
 
-def get_subrank(S, G, walk_visited_count, nodelist, alpha=0.85):
+def get_subrank(S, G, walk_visited_count, nodelist, alpha=0.85, seed=None):
     '''
         Subrank algorithm (stopping at dandling nodes);
         it aims to approximate the Pagerank over S subgraph of G
@@ -387,6 +770,9 @@ def get_subrank(S, G, walk_visited_count, nodelist, alpha=0.85):
        alpha: float, optional
             It is the dampening factor of Pagerank. default value is 0.85
 
+        seed: int, optional
+            seed of the random number generator, for reproducible results
+
         OUTPUTS
         -------
         subrank: dict
@@ -411,8 +797,9 @@ def get_subrank(S, G, walk_visited_count, nodelist, alpha=0.85):
     print(f'walks performed = {sum(positive_walks.values()) + sum(negative_walks.values())}')
 
     # perform the walks and get the visited counts
-    positive_count = _perform_walks(S_nodes, S, positive_walks, alpha)
-    negative_count = _perform_walks(S_nodes, S, negative_walks, alpha)
+    positive_seed, negative_seed = np.random.SeedSequence(seed).spawn(2)
+    positive_count = _perform_walks(S_nodes, S, positive_walks, alpha, positive_seed)
+    negative_count = _perform_walks(S_nodes, S, negative_walks, alpha, negative_seed)
 
     # add the effects of the random walk to the count of G
     new_visited_count = {node: visited_count_from_S[node] + positive_count[node] - negative_count[node]
@@ -545,10 +932,38 @@ def _get_walks_to_do(S_nodes, G_nodes, S, G, visited_count_from_S, alpha):
     return positive_walks_to_do, negative_walks_to_do
 
 
-def _perform_walks(S_nodes, S, walks_to_do, alpha):
+def _perform_walks(S_nodes, S, walks_to_do, alpha, seed=None, batch_size=1000000):
     '''
     This function performs a certain number of random walks on S for each node;
     It then returns the visited count for each node in S.
+    The walks are performed in NumPy batches on a CSR adjacency of S.
+    '''
+
+    nodelist = list(S_nodes)
+    inverse_nodelist = {nodelist[j]: j for j in range(len(nodelist))}
+
+    starting_nodes = [node for node, num in walks_to_do.items() if num > 0]
+    if len(starting_nodes) == 0:
+        return {node: 0 for node in S_nodes}
+
+    indptr, indices = _graph_to_csr(S, nodelist, inverse_nodelist)
+    starts = np.repeat(np.array([inverse_nodelist[node] for node in starting_nodes], dtype=np.int64),
+                       np.array([walks_to_do[node] for node in starting_nodes], dtype=np.int64))
+
+    rng = np.random.default_rng(seed)
+    visited = np.zeros(len(nodelist), dtype=np.int64)
+    for batch in range(0, len(starts), batch_size):
+        _, visited_nodes = _csr_walks(indptr, indices, starts[batch:batch + batch_size], alpha, rng)
+        visited += np.bincount(visited_nodes, minlength=len(nodelist))
+
+    return {nodelist[j]: int(visited[j]) for j in range(len(nodelist))}
+
+
+def _perform_walks_python(S_nodes, S, walks_to_do, alpha):
+    '''
+    This function performs a certain number of random walks on S for each node;
+    It then returns the visited count for each node in S.
+    Reference implementation of _perform_walks, one walk at a time in pure python.
     '''
 
     # initializing the visited count
@@ -580,6 +995,274 @@ def _perform_walks(S_nodes, S, walks_to_do, alpha):
     return visited_count
 
 
+class WotChanges:
+    __slots__ = ("generation", "added", "removed")
+
+    def __init__(self, generation, added, removed):
+        self.generation = generation
+        self.added = added
+        self.removed = removed
+
+
+class WotMaintainer:
+    """
+    Keeps a web of trust up to date incrementally instead of rebuilding it. The follow graph is persisted as a
+    WotGraph; on every update only kind 3 events newer than each author's stored timestamp are fetched, the
+    follow lists that changed are replaced, and follow lists are fetched only for nodes that became reachable.
+
+    One maintainer per seeds, depth and relays is shared by all DVMs of a process. Every update that changes the
+    set of trusted keys gets a new generation; DVMs remember the generation they applied and get the added and
+    removed keys since then from changes_since, so they only push the difference into their client's filtering.
+    If follow lists couldn't be fetched, the update adds keys but removes none, until a later update fetches them.
+    """
+
+    MAX_CHANGES = 50
+    MAX_FAILED_ROUNDS = 3
+
+    maintainers = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(seed_pks, depth, relays, directory='db'):
+        if type(seed_pks) == str:
+            seed_pks = [seed_pks]
+        seeds = tuple(sorted(_pubkey_to_bytes(pk).hex() for pk in seed_pks))
+        key = (seeds, depth, tuple(sorted(relays)))
+        with WotMaintainer.lock:
+            maintainer = WotMaintainer.maintainers.get(key)
+            if maintainer is None:
+                name = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+                maintainer = WotMaintainer(list(seeds), depth, directory, name)
+                WotMaintainer.maintainers[key] = maintainer
+            return maintainer
+
+    def __init__(self, seed_pks, depth, directory, name):
+        self.seed_pks = seed_pks
+        self.depth = depth
+        self.directory = directory
+        self.name = name
+        self.lock = threading.Lock()
+        self.running = None
+        self.last_update = 0
+        self.loaded = False
+
+        self.pubkeys = []  # index -> pubkey (hex)
+        self.index = {}  # pubkey (hex) -> index
+        self.follows = {}  # index -> set of followed indices, for all authors whose follow list was fetched
+        self.timestamps = {}  # index -> created_at of the kind 3 the follow list is from
+        self.trusted = set()  # indices within depth hops of the seeds
+        self.generation = 0
+        self.changes = collections.deque(maxlen=WotMaintainer.MAX_CHANGES)
+        self.ranked = None  # (generation, pagerank of the trusted keys)
+
+    def _intern(self, pubkey):
+        i = self.index.get(pubkey)
+        if i is None:
+            i = len(self.pubkeys)
+            self.pubkeys.append(pubkey)
+            self.index[pubkey] = i
+        return i
+
+    def _distances(self):
+        # breadth first search from the seeds, up to depth hops
+        distances = {self._intern(pk): 0 for pk in self.seed_pks}
+        frontier = list(distances)
+        for hop in range(1, self.depth + 1):
+            next_frontier = []
+            for node in frontier:
+                for followed in self.follows.get(node, ()):
+                    if followed not in distances:
+                        distances[followed] = hop
+                        next_frontier.append(followed)
+            frontier = next_frontier
+        return distances
+
+    def load(self):
+        if not WotGraph.exists(self.name, self.directory):
+            return
+        wot = WotGraph.load(self.name, directory=self.directory)
+        self.pubkeys = wot.hex_keys()
+        self.index = {pubkey: i for i, pubkey in enumerate(self.pubkeys)}
+        indptr = np.asarray(wot.indptr)
+        timestamps = np.asarray(wot.timestamps)
+        # authors with follows or a kind 3 timestamp have been fetched, the others are leaves
+        for node in np.flatnonzero((np.diff(indptr) > 0) | (timestamps > 0)):
+            self.follows[int(node)] = set(wot.successors(node).tolist())
+            self.timestamps[int(node)] = int(timestamps[node])
+
+    def save(self):
+        sources = [node for node, followed in self.follows.items() for _ in followed]
+        targets = [target for followed in self.follows.values() for target in followed]
+        timestamps = np.zeros(len(self.pubkeys), dtype=np.int64)
+        for node, timestamp in self.timestamps.items():
+            timestamps[node] = timestamp
+        WotGraph.from_edges(self.pubkeys, sources, targets, timestamps).save(self.name, self.directory)
+
+    async def update(self, dvm_config, max_age=0):
+        """Update unless another DVM updated less than max_age seconds ago. If an update is running, wait for it."""
+        with self.lock:
+            running = self.running
+            if running is None:
+                if time.time() - self.last_update < max_age:
+                    return False
+                running = Future()
+                self.running = running
+                start = True
+            else:
+                start = False
+
+        if not start:
+            await asyncio.wrap_future(running)
+            return True
+
+        try:
+            await self.run_update(dvm_config)
+        except Exception as e:
+            print("[" + dvm_config.NIP89.NAME + "] WOT update failed: " + str(e))
+        finally:
+            with self.lock:
+                self.running = None
+            running.set_result(True)
+        return True
+
+    async def run_update(self, dvm_config):
+        tic = time.time()
+        if not self.loaded:
+            self.load()
+            self.loaded = True
+
+        # authors we already know: only kind 3 events newer than the stored one
+        distances = self._distances()
+        known = [node for node, distance in distances.items() if distance < self.depth and node in self.follows]
+        changed, failed = await self._fetch_follows(known, dvm_config)
+
+        # expand the frontier for nodes that became reachable (on the first run, this builds the whole network).
+        # Nodes of batches that failed stay unfetched and are tried again, up to MAX_FAILED_ROUNDS rounds in a row
+        fetched = len(known)
+        failed_rounds = 0
+        while True:
+            distances = self._distances()
+            new = [node for node, distance in distances.items()
+                   if distance < self.depth and node not in self.follows]
+            if len(new) == 0 or failed_rounds >= self.MAX_FAILED_ROUNDS:
+                break
+            new_changed, failed = await self._fetch_follows(new, dvm_config)
+            changed += new_changed
+            fetched += len(new) - len(failed)
+            failed_rounds = failed_rounds + 1 if len(failed) == len(new) else 0
+
+        trusted = set(distances)
+        incomplete = len([node for node, distance in distances.items()
+                          if distance < self.depth and node not in self.follows])
+        if incomplete > 0:
+            # we don't know whom the unfetched nodes follow, keep what was trusted until they are fetched
+            print("[" + dvm_config.NIP89.NAME + "] WOT: " + str(incomplete) + " follow lists couldn't be fetched")
+            trusted |= self.trusted
+        added = trusted - self.trusted
+        removed = self.trusted - trusted
+        with self.lock:
+            self.trusted = trusted
+            if len(added) > 0 or len(removed) > 0:
+                self.generation += 1
+                self.changes.append(WotChanges(self.generation, added, removed))
+            self.last_update = tic
+        if changed > 0:
+            self.save()
+
+        print("[" + dvm_config.NIP89.NAME + "] WOT updated: " + str(len(trusted)) + " npubs (+" + str(
+            len(added)) + " -" + str(len(removed)) + "), " + str(changed) + " of " + str(
+            fetched) + " follow lists changed in " + str(round(time.time() - tic, 2)) + " seconds")
+
+    async def _fetch_follows(self, nodes, dvm_config, max_batch=500, max_time_request=10):
+        # batches of authors with similar timestamps, so the since of a batch doesn't fetch too many old events
+        nodes = sorted(nodes, key=lambda node: self.timestamps.get(node, 0))
+        batches = []
+        for batch in range(0, len(nodes), max_batch):
+            batch_nodes = nodes[batch:batch + max_batch]
+            since = min(self.timestamps.get(node, 0) for node in batch_nodes)
+            batches.append(([self.pubkeys[node] for node in batch_nodes], since if since > 0 else None))
+
+        changed = 0
+        failed = []
+        crawler = FollowCrawler(dvm_config, max_time_request)
+        await crawler.connect()
+        try:
+            async for pks, follows in crawler.crawl(batches):
+                if follows is None:
+                    # unknown, not following nobody: new nodes stay unfetched, known ones keep their follows
+                    failed += [self.index[pk] for pk in pks]
+                    continue
+                for pk in pks:
+                    node = self.index[pk]
+                    timestamp, followed = follows.get(pk, (None, None))
+                    if timestamp is not None and timestamp > self.timestamps.get(node, 0):
+                        self.follows[node] = {self._intern(followed_pk) for followed_pk in followed}
+                        self.timestamps[node] = timestamp
+                        changed += 1
+                    elif node not in self.follows:
+                        # no kind 3 found, the node follows nobody
+                        self.follows[node] = set()
+        finally:
+            await crawler.shutdown()
+        return changed, failed
+
+    def pagerank(self):
+        """{pubkey (hex): pagerank} of the trusted keys, personalized on the seeds. Computed once per generation."""
+        with self.lock:
+            if self.ranked is not None and self.ranked[0] == self.generation:
+                return self.ranked[1]
+            generation = self.generation
+            trusted = list(self.trusted)
+
+        position = {node: i for i, node in enumerate(trusted)}
+        sources = []
+        targets = []
+        for node in trusted:
+            for followed in self.follows.get(node, ()):
+                if followed in position:
+                    sources.append(position[node])
+                    targets.append(position[followed])
+        seeds = {position[self.index[pk]]: 1 for pk in self.seed_pks if self.index.get(pk) in position}
+        pr = sparse_pagerank(np.array(sources, dtype=np.int32), np.array(targets, dtype=np.int32), len(trusted),
+                             personalization=seeds if len(seeds) > 0 else None)
+        ranked = {self.pubkeys[node]: float(pr[i]) for i, node in enumerate(trusted)}
+        with self.lock:
+            self.ranked = (generation, ranked)
+        return ranked
+
+    def changes_since(self, generation):
+        """
+        Returns (generation, added pubkeys, removed pubkeys) since the given generation. If generation is None or
+        too old, all trusted pubkeys are returned as added and removed is None: the caller has to replace its keys.
+        """
+        with self.lock:
+            if generation == self.generation:
+                return generation, [], []
+            changes = [change for change in self.changes if change.generation > (generation or 0)]
+            if generation is None or len(changes) == 0 or changes[0].generation != generation + 1:
+                return self.generation, [self.pubkeys[node] for node in self.trusted], None
+            added = set()
+            removed = set()
+            for change in changes:
+                added = (added - change.removed) | change.added
+                removed = (removed - change.added) | change.removed
+            return self.generation, [self.pubkeys[node] for node in added], [self.pubkeys[node] for node in removed]
+
+
+async def apply_wot_filtering(cli, maintainer, generation):
+    """Push the trusted keys that changed since generation into the client's filtering, returns the new generation"""
+    generation, added, removed = maintainer.changes_since(generation)
+    filtering = cli.filtering()
+    if removed is None:
+        await filtering.overwrite_public_keys([PublicKey.parse(pk) for pk in added])
+    else:
+        if len(removed) > 0:
+            await filtering.remove_public_keys([PublicKey.parse(pk) for pk in removed])
+        if len(added) > 0:
+            await filtering.add_public_keys([PublicKey.parse(pk) for pk in added])
+    return generation
+
+
 async def get_metadata(npub):
     name = ""
     nip05 = ""
@@ -613,9 +1296,18 @@ async def get_metadata(npub):
     return name, nip05, lud16
 
 
+def _index_to_pubkey(index_map):
+    # index_map can be a WotGraph or an index_map = {pk0: 0, pk1: 1, ...}
+    if isinstance(index_map, WotGraph):
+        return index_map.hex
+    inverse_index_map = {id: pubkey for pubkey, id in index_map.items()}
+    return inverse_index_map.get
+
+
 async def print_results(graph, index_map, show_results_num, getmetadata=True):
+    index_to_pubkey = _index_to_pubkey(index_map)
     for item in islice(graph, show_results_num):
-        key = next((PublicKey.parse(pubkey).to_bech32() for pubkey, id in index_map.items() if id == item), None)
+        key = PublicKey.parse(index_to_pubkey(item)).to_bech32()
         name = ""
         if getmetadata:
             name, nip05, lud16 = await get_metadata(key)
@@ -624,8 +1316,9 @@ async def print_results(graph, index_map, show_results_num, getmetadata=True):
 
 async def convert_index_to_hex(graph, index_map, show_results_num):
     result = {}
+    index_to_pubkey = _index_to_pubkey(index_map)
     for item in islice(graph, show_results_num):
-        key = next((pubkey for pubkey, id in index_map.items() if id == item), None)
+        key = index_to_pubkey(item)
         result[key] = graph[item]
 
     return result
@@ -0,0 +1,208 @@
+import heapq
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from nostr_sdk import Filter, EventId, Timestamp
+
+from nostr_dvm.utils.definitions import EventDefinitions
+
+# hrp of a bolt11 invoice: ln + network + optional amount with multiplier, followed by the separator "1"
+BOLT11_AMOUNT = re.compile(r"ln(?:bcrt|bc|tbs|tb|sb)(\d*)([munp]?)1", re.IGNORECASE)
+# msats per unit of each multiplier, one bitcoin is 10^11 msats
+MSATS_PER_UNIT = {"": 100000000000, "m": 100000000, "u": 100000, "n": 100}
+
+
+class ZapLedger:
+    """
+    Parsed zap receipts (kind 9735) of a database, kept in an sqlite table next to it.
+
+    Each receipt is parsed once when it is added: the amount of its bolt11 invoice, the sender (the pubkey of the
+    zap request in the description), the zapped event and user (e and p tags) and if it has a preimage. The
+    SyncCoordinator adds the receipts every sync receives and prunes the ledger with the database, refresh adds
+    what's missing and rebuilds the ledger if it doesn't have the same number of zaps as the database.
+    Use ZapLedger.get(db_name) to get the shared ledger of a database.
+    """
+
+    BATCH_SIZE = 500
+
+    ledgers = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def get(db_name):
+        with ZapLedger.lock:
+            ledger = ZapLedger.ledgers.get(db_name)
+            if ledger is None:
+                ledger = ZapLedger(os.path.splitext(db_name)[0] + "_zaps.sqlite")
+                ZapLedger.ledgers[db_name] = ledger
+            return ledger
+
+    @staticmethod
+    def find(db_name):
+        """The ledger of db_name if a DVM uses one, None otherwise"""
+        with ZapLedger.lock:
+            return ZapLedger.ledgers.get(db_name)
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self._create()
+
+    def connection(self):
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, cached_statements=64)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self.local.con = con
+        return con
+
+    def _create(self):
+        con = self.connection()
+        with con:
+            con.execute(""" CREATE TABLE IF NOT EXISTS zaps (
+                                id TEXT PRIMARY KEY,
+                                created_at INTEGER NOT NULL,
+                                amount_msat INTEGER NOT NULL,
+                                sender TEXT,
+                                receiver TEXT,
+                                event_id TEXT,
+                                has_preimage INTEGER NOT NULL
+                            ) WITHOUT ROWID; """)
+            con.execute("CREATE INDEX IF NOT EXISTS zaps_event ON zaps(event_id, created_at)")
+            con.execute("CREATE INDEX IF NOT EXISTS zaps_receiver ON zaps(receiver, created_at)")
+            con.execute("CREATE INDEX IF NOT EXISTS zaps_sender ON zaps(sender, created_at)")
+            con.execute("CREATE INDEX IF NOT EXISTS zaps_created_at ON zaps(created_at)")
+
+    def add_zaps(self, events):
+        """Parse and add zap receipts, receipts that are already in the ledger are skipped"""
+        rows = []
+        for event in events:
+            if event.kind().as_u16() != EventDefinitions.KIND_ZAP.as_u16():
+                continue
+            rows.append((event.id().to_hex(), event.created_at().as_secs()) + parse_zap_receipt(event))
+        con = self.connection()
+        with self.write_lock, con:
+            con.executemany(""" INSERT OR IGNORE INTO zaps(id, created_at, amount_msat, sender, receiver, event_id,
+                                                           has_preimage)
+                                VALUES (?, ?, ?, ?, ?, ?, ?) """, rows)
+        return len(rows)
+
+    async def index_events(self, database, event_ids):
+        """Add the zap receipts with these ids (e.g. the ids a sync received) from the database"""
+        event_ids = [event_id if isinstance(event_id, EventId) else EventId.parse(event_id) for event_id in event_ids]
+        added = 0
+        for batch in range(0, len(event_ids), self.BATCH_SIZE):
+            filter = Filter().ids(event_ids[batch:batch + self.BATCH_SIZE]).kind(EventDefinitions.KIND_ZAP)
+            events = await database.query(filter)
+            added += self.add_zaps(events.to_vec())
+        return added
+
+    async def rebuild(self, database, since):
+        events = await database.query(Filter().kind(EventDefinitions.KIND_ZAP).since(Timestamp.from_secs(since)))
+        con = self.connection()
+        with self.write_lock, con:
+            con.execute("DELETE FROM zaps WHERE created_at >= ?", (since,))
+        return self.add_zaps(events.to_vec())
+
+    async def refresh(self, database, since):
+        """Make sure the ledger has the zaps of the database since `since` (unix time), rebuild that window if not"""
+        in_database = await database.count(Filter().kind(EventDefinitions.KIND_ZAP).since(Timestamp.from_secs(since)))
+        if self.count(since) != in_database:
+            print("Rebuilding zap ledger " + self.path + "..")
+            await self.rebuild(database, since)
+
+    def prune(self, until):
+        """Remove the zaps older than until (unix time)"""
+        con = self.connection()
+        with self.write_lock, con:
+            con.execute("DELETE FROM zaps WHERE created_at < ?", (until,))
+
+    def count(self, since=0):
+        return self.connection().execute("SELECT COUNT(*) FROM zaps WHERE created_at >= ?", (since,)).fetchone()[0]
+
+    def top_events(self, since, max_results=100, min_zaps=1, event_ids=None, require_preimage=False):
+        """
+        Returns the max_results (event id, sats) pairs with the most zapped sats since `since` (unix time), most
+        zapped first. Zaps of a user to themselves don't count, events with less than min_zaps zaps are skipped.
+        If event_ids is given, only these events are considered.
+        """
+        rows = self.connection().execute(""" SELECT event_id, SUM(amount_msat) / 1000, COUNT(*) FROM zaps
+                                              WHERE created_at >= ? AND event_id IS NOT NULL
+                                                AND (sender IS NULL OR receiver IS NULL OR sender != receiver)
+                                                AND has_preimage >= ?
+                                              GROUP BY event_id HAVING COUNT(*) >= ? """,
+                                         (since, 1 if require_preimage else 0, int(min_zaps))).fetchall()
+        if event_ids is not None:
+            rows = [row for row in rows if row[0] in event_ids]
+        return [(row[0], row[1]) for row in heapq.nlargest(int(max_results), rows, key=lambda row: row[1])]
+
+    def received_by(self, pubkeys, since=0):
+        """{pubkey (hex): zapped sats since `since`} for the pubkeys that received zaps"""
+        return self._sum_by("receiver", pubkeys, since)
+
+    def sent_by(self, pubkeys, since=0):
+        """{pubkey (hex): sats zapped since `since`} for the pubkeys that sent zaps"""
+        return self._sum_by("sender", pubkeys, since)
+
+    def zapped_sats(self, event_id, since=0):
+        row = self.connection().execute(""" SELECT SUM(amount_msat) / 1000 FROM zaps
+                                             WHERE event_id = ? AND created_at >= ? """, (event_id, since)).fetchone()
+        return row[0] or 0
+
+    def _sum_by(self, column, pubkeys, since):
+        pubkeys = list(pubkeys)
+        sums = {}
+        con = self.connection()
+        # stay below sqlite's limit of host parameters per statement
+        for batch in range(0, len(pubkeys), self.BATCH_SIZE):
+            keys = pubkeys[batch:batch + self.BATCH_SIZE]
+            rows = con.execute("SELECT " + column + ", SUM(amount_msat) / 1000 FROM zaps WHERE created_at >= ? AND " +
+                               column + " IN (" + ",".join("?" * len(keys)) + ") GROUP BY " + column,
+                               [since] + keys).fetchall()
+            sums.update(rows)
+        return sums
+
+
+def parse_bolt11_amount_msat(bolt11_invoice):
+    """Amount of a bolt11 invoice in msats, 0 if the invoice has no (valid) amount"""
+    match = BOLT11_AMOUNT.match(bolt11_invoice)
+    if match is None or match.group(1) == "":
+        return 0
+    number = int(match.group(1))
+    multiplier = match.group(2).lower()
+    if multiplier == "p":
+        # pico bitcoin are 1/10 msat
+        return number // 10
+    return number * MSATS_PER_UNIT[multiplier]
+
+
+def parse_zap_receipt(event):
+    """(amount in msats, sender, receiver, zapped event id, has preimage) of a zap receipt"""
+    amount = 0
+    sender = None
+    receiver = None
+    zapped_event = None
+    has_preimage = 0
+    for tag in event.tags().to_vec():
+        tag_vec = tag.as_vec()
+        if len(tag_vec) < 2:
+            continue
+        if tag_vec[0] == "bolt11":
+            amount = parse_bolt11_amount_msat(tag_vec[1])
+        elif tag_vec[0] == "p" and receiver is None:
+            receiver = tag_vec[1]
+        elif tag_vec[0] == "e" and zapped_event is None:
+            zapped_event = tag_vec[1]
+        elif tag_vec[0] == "preimage" and tag_vec[1] != "":
+            has_preimage = 1
+        elif tag_vec[0] == "description":
+            try:
+                sender = json.loads(tag_vec[1]).get("pubkey")
+            except Exception:
+                sender = None
+    return amount, sender, receiver, zapped_event, has_preimage
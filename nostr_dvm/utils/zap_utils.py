@@ -2,6 +2,7 @@
 import json
 import os
 import random
+import secrets
 import string
 import urllib.parse
 from hashlib import sha256
@@ -16,6 +17,7 @@ from bech32 import bech32_decode, convertbits, bech32_encode
 from nostr_sdk import PublicKey, SecretKey, Event, EventBuilder, Tag, Keys, generate_shared_key, Kind, \
     Timestamp
 
+from nostr_dvm.utils.event_index_utils import DECRYPT_OWN_TAGS
 from nostr_dvm.utils.nostr_utils import get_event_by_id, check_and_decrypt_own_tags, update_profile_lnaddress
 
 # tor connection to lnbits
@@ -27,7 +29,7 @@ from nostr_dvm.utils.nostr_utils import get_event_by_id, check_and_decrypt_own_t
 proxies = {}
 
 
-async def parse_zap_event_tags(zap_event, keys, name, client, config):
+async def parse_zap_event_tags(zap_event, keys, name, client, config, event_index=None):
     zapped_event = None
     invoice_amount = 0
     anon = False
@@ -37,9 +39,17 @@ async def parse_zap_event_tags(zap_event, keys, name, client, config):
         if tag.as_vec()[0] == 'bolt11':
             invoice_amount = parse_amount_from_bolt11_invoice(tag.as_vec()[1])
         elif tag.as_vec()[0] == 'e':
-            zapped_event = await get_event_by_id(tag.as_vec()[1], client=client, config=config)
-            if zapped_event is not None:
-                zapped_event = check_and_decrypt_own_tags(zapped_event, config)
+            if event_index is not None:
+                # most zaps are on events we published, the index knows them and their decrypted tags
+                zapped_event = await event_index.fetch(tag.as_vec()[1], client, config)
+                if zapped_event is not None:
+                    zapped_event = event_index.decrypt(zapped_event,
+                                                       lambda event: check_and_decrypt_own_tags(event, config),
+                                                       DECRYPT_OWN_TAGS)
+            else:
+                zapped_event = await get_event_by_id(tag.as_vec()[1], client=client, config=config)
+                if zapped_event is not None:
+                    zapped_event = check_and_decrypt_own_tags(zapped_event, config)
         elif tag.as_vec()[0] == 'p':
             p_tag = tag.as_vec()[1]
         elif tag.as_vec()[0] == 'description':
@@ -94,11 +104,24 @@ def parse_amount_from_bolt11_invoice(bolt11_invoice: str) -> int:
     return int(number)
 
 
+def get_webhook_token(config):
+    """Secret last path segment of the LNbits webhook url, generated once per DVM if none is configured"""
+    if config.LNBITS_WEBHOOK_TOKEN == "":
+        config.LNBITS_WEBHOOK_TOKEN = secrets.token_urlsafe(24)
+    return config.LNBITS_WEBHOOK_TOKEN
+
+
+def get_webhook_url(config):
+    return config.LNBITS_WEBHOOK_URL.rstrip("/") + "/" + get_webhook_token(config)
+
+
 def create_bolt11_ln_bits(sats: int, config) -> (str, str):
     if config.LNBITS_URL == "":
         return None, None
     url = config.LNBITS_URL + "/api/v1/payments"
     data = {'out': False, 'amount': sats, 'memo': "Nostr-DVM " + config.NIP89.NAME}
+    if config.LNBITS_WEBHOOK_URL != "":
+        data['webhook'] = get_webhook_url(config)
     headers = {'X-API-Key': config.LNBITS_INVOICE_KEY, 'Content-Type': 'application/json', 'charset': 'UTF-8'}
     try:
         res = requests.post(url, json=data, headers=headers)
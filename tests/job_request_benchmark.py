@@ -0,0 +1,148 @@
+import random
+import time
+
+from nostr_sdk import Keys, EventBuilder, Kind, Tag
+
+from nostr_dvm.utils.job_request_utils import JobRequest
+
+# Benchmark of the tag parsing of a job on a replay of synthetic NIP90 requests: every step of the pipeline
+# walking event.tags() on its own (how the tags were read before) versus one JobRequest per event, whose parsed
+# tags are used by all steps. Only tag parsing is timed, no relays or tasks are involved.
+
+EVENTS = 10000
+KIND = 5050
+
+
+def build_events():
+    keys = [Keys.generate() for _ in range(50)]
+    relays = ["relays"] + ["wss://relay" + str(i) + ".example.com" for i in range(5)]
+    events = []
+    for i in range(EVENTS):
+        tags = [Tag.parse(["i", "prompt number " + str(i), "text"]),
+                Tag.parse(["param", "model", random.choice(["small", "large"])]),
+                Tag.parse(["param", "max_tokens", str(random.randint(100, 1000))]),
+                Tag.parse(["param", "temperature", "0.7"]),
+                Tag.parse(["output", "text/plain"]),
+                Tag.parse(relays),
+                Tag.parse(["bid", str(random.randint(1, 100) * 1000)]),
+                Tag.parse(["client", "benchmark"]),
+                Tag.parse(["expiration", str(2000000000 + i)])]
+        if i % 3 == 0:
+            tags.append(Tag.parse(["i", "second input " + str(i), "text"]))
+        if i % 10 == 0:
+            tags.append(Tag.parse(["p", keys[0].public_key().to_hex()]))
+        events.append(EventBuilder(Kind(KIND), "").tags(tags).sign_with_keys(random.choice(keys)))
+    return events
+
+
+def task_hooks(event):
+    # what a typical task does in is_input_supported and create_request_from_nostr_event
+    prompt = ""
+    options = {}
+    for tag in event.tags().to_vec():
+        if tag.as_vec()[0] == 'i':
+            if tag.as_vec()[2] != "text":
+                return None
+    for tag in event.tags().to_vec():
+        if tag.as_vec()[0] == 'i':
+            prompt = tag.as_vec()[1]
+        elif tag.as_vec()[0] == 'param':
+            options[tag.as_vec()[1]] = tag.as_vec()[2]
+    return prompt, options
+
+
+def walk_tags(event):
+    # the tag walks of one paid job before JobRequest, in pipeline order
+    cashu, p_tag = "", ""
+    for tag in event.tags().to_vec():  # handle_nip90_job_event
+        if tag.as_vec()[0] == "cashu":
+            cashu = tag.as_vec()[1]
+        elif tag.as_vec()[0] == "p":
+            p_tag = tag.as_vec()[1]
+    for tag in event.tags().to_vec():  # is_input_supported_generic
+        if tag.as_vec()[0] == 'i' and len(tag.as_vec()) < 3:
+            return None
+    bid = 0
+    for tag in event.tags().to_vec():  # payment required
+        if tag.as_vec()[0] == 'bid':
+            bid = int(tag.as_vec()[1])
+    for _ in range(2):  # payment-required and processing status
+        relay_tag, expiration_tag = None, None
+        for tag in event.tags().to_vec():
+            if tag.as_vec()[0] == "relays":
+                relay_tag = tag
+                break
+        for tag in event.tags().to_vec():
+            if tag.as_vec()[0] == "expiration":
+                expiration_tag = tag
+    for tag in event.tags().to_vec():  # check_event_has_not_unfinished_job_input
+        if tag.as_vec()[0] == 'i':
+            input_type = tag.as_vec()[2]
+    for tag in event.tags().to_vec():  # input_data_file_duration
+        if tag.as_vec()[0] == 'i':
+            input_value = tag.as_vec()[1]
+    form = task_hooks(event)
+    output = None
+    for tag in event.tags().to_vec():  # post_process_result
+        if tag.as_vec()[0] == "output":
+            output = tag.as_vec()[1]
+    reply_tags = []
+    for tag in event.tags().to_vec():  # send_nostr_reply_event
+        if tag.as_vec()[0] in ("relays", "client"):
+            reply_tags.append(tag)
+    for tag in event.tags().to_vec():
+        if tag.as_vec()[0] == "encrypted":
+            reply_tags.append(tag)
+    for tag in event.tags().to_vec():
+        if tag.as_vec()[0] in ("i", "expiration"):
+            reply_tags.append(tag)
+    return cashu, p_tag, bid, relay_tag, expiration_tag, form, output, reply_tags
+
+
+def use_request(event):
+    # the same steps with one JobRequest
+    request = JobRequest.of(event)
+    cashu, p_tag = request.cashu, request.p
+    for input_tag in request.inputs:
+        if len(input_tag) < 3:
+            return None
+    bid = int(request.bid) if request.bid is not None else 0
+    for _ in range(2):
+        relay_tag = request.tag("relays")
+        expiration_tag = request.tags_named("expiration")
+    for input_tag in JobRequest.of(event).inputs:
+        input_type = input_tag[2]
+    for input_tag in JobRequest.of(event).inputs:
+        input_value = input_tag[1]
+    form = task_hooks(request.parsed_event)
+    output = JobRequest.of(event).output
+    reply_tags = [tag.tag for tag in request.tags_named("client") + request.tags_named("relays")]
+    for tag in request.tags:
+        if tag.vec[0] in ("i", "expiration"):
+            reply_tags.append(tag.tag)
+    return cashu, p_tag, bid, relay_tag, expiration_tag, form, output, reply_tags
+
+
+def replay(events, function):
+    start = time.perf_counter()
+    for event in events:
+        function(event)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    print("Creating " + str(EVENTS) + " job requests..")
+    events = build_events()
+
+    before = replay(events, walk_tags)
+    after = replay(events, use_request)
+    # JobRequests are kept on the events now, a second replay only reads them
+    cached = replay(events, use_request)
+
+    print("Tag walks per step:        " + str(round(before, 3)) + "s, " + str(
+        round(before / EVENTS * 1e6, 1)) + "us per job")
+    print("JobRequest:                " + str(round(after, 3)) + "s, " + str(
+        round(after / EVENTS * 1e6, 1)) + "us per job")
+    print("JobRequest (already built): " + str(round(cached, 3)) + "s")
+    print("Speedup: " + str(round(before / after, 1)) + "x")
@@ -0,0 +1,117 @@
+import json
+import os
+import random
+import string
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+# A local mock of the LNbits payments API, so DVMs and the payment watcher can be tested offline.
+# Run it with "python tests/lnbits_mock.py" and set LNBITS_HOST=http://127.0.0.1:5001 in your .env
+#
+# Supported endpoints:
+# POST /api/v1/payments                 create an invoice ({"out": false, "amount": sats, "webhook": url})
+#                                       or pay one ({"out": true, "bolt11": ...})
+# GET  /api/v1/payments                 list the latest payments of the wallet
+# GET  /api/v1/payments/<payment_hash>  check a single payment
+# POST /mock/pay/<payment_hash>         settle an invoice, calls its webhook if one was given
+
+payments = {}
+lock = threading.Lock()
+
+
+def random_hash():
+    return ''.join(random.choices(string.hexdigits.lower()[:16], k=64))
+
+
+def settle(payment_hash):
+    with lock:
+        payment = payments.get(payment_hash)
+        if payment is None:
+            return None
+        payment["status"] = "success"
+        payment["pending"] = False
+    if payment.get("webhook"):
+        try:
+            requests.post(payment["webhook"], json=payment, timeout=5)
+        except Exception as e:
+            print("Mock LNbits: webhook failed: " + str(e))
+    return payment
+
+
+class MockLNbitsHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/api/v1/payments":
+            with lock:
+                latest = sorted(payments.values(), key=lambda x: x["time"], reverse=True)
+            self.send_json(latest)
+        elif path.startswith("/api/v1/payments/"):
+            payment = payments.get(path.split("/")[-1])
+            if payment is None:
+                self.send_json({"detail": "Payment does not exist."}, 404)
+            else:
+                self.send_json({"paid": payment["status"] == "success", "details": payment})
+        else:
+            self.send_json({"detail": "Not found"}, 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        data = self.read_json()
+        if path == "/api/v1/payments":
+            payment_hash = random_hash()
+            if data.get("out"):
+                payment = {"payment_hash": payment_hash, "bolt11": data.get("bolt11"), "amount": 0,
+                           "status": "success", "pending": False, "time": time.time()}
+            else:
+                amount = int(data.get("amount", 0))
+                bolt11 = "lnbc" + str(amount * 10) + "n1" + ''.join(random.choices(string.ascii_lowercase, k=100))
+                payment = {"payment_hash": payment_hash, "bolt11": bolt11, "payment_request": bolt11,
+                           "amount": amount * 1000, "memo": data.get("memo", ""), "webhook": data.get("webhook"),
+                           "status": "pending", "pending": True, "time": time.time()}
+            with lock:
+                payments[payment_hash] = payment
+            self.send_json({"payment_hash": payment_hash, "payment_request": payment["bolt11"]}, 201)
+        elif path.startswith("/mock/pay/"):
+            payment = settle(path.split("/")[-1])
+            if payment is None:
+                self.send_json({"detail": "Payment does not exist."}, 404)
+            else:
+                self.send_json(payment)
+        else:
+            self.send_json({"detail": "Not found"}, 404)
+
+    def log_message(self, format, *args):
+        print("Mock LNbits: " + format % args)
+
+
+def run_mock_lnbits(host="127.0.0.1", port=5001):
+    server = ThreadingHTTPServer((host, port), MockLNbitsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    port = int(os.getenv("LNBITS_MOCK_PORT", 5001))
+    print("Mock LNbits running on http://127.0.0.1:" + str(port))
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockLNbitsHandler)
+    server.serve_forever()
@@ -0,0 +1,112 @@
+import random
+import time
+
+import networkx as nx
+import numpy as np
+
+from nostr_dvm.utils.wot_utils import get_mc_pagerank, get_mc_pagerank_python, get_subrank, _perform_walks, \
+    _perform_walks_python
+
+# Benchmark and statistical equivalence check for the Monte-Carlo pagerank: the pure python walks (one walk at a
+# time, how pagerank was computed before) versus the vectorized CSR walks in NumPy batches.
+# Both implementations estimate the same distribution, so their results are compared with networkx's exact
+# pagerank and with each other, not value by value.
+
+NODES = 5000
+AVG_FOLLOWS = 20
+DANGLING = 0.1  # share of nodes following nobody
+R = 10
+ALPHA = 0.85
+SUBGRAPH = 500
+SEED = 42
+
+
+def random_follow_graph(nodes, avg_follows, dangling, seed):
+    # preferential attachment like follow graphs, some users follow nobody
+    rng = random.Random(seed)
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(nodes))
+    weights = [1 / (i + 1) for i in range(nodes)]
+    for node in range(nodes):
+        if rng.random() < dangling:
+            continue
+        follows = set(rng.choices(range(nodes), weights=weights, k=rng.randint(1, 2 * avg_follows)))
+        follows.discard(node)
+        graph.add_edges_from((node, follow) for follow in follows)
+    return graph
+
+
+def to_array(pagerank, nodelist):
+    return np.array([pagerank[node] for node in nodelist])
+
+
+def compare(name, estimate, reference):
+    # L1 distance between the distributions and correlation of the values
+    l1 = np.abs(estimate - reference).sum()
+    correlation = np.corrcoef(estimate, reference)[0, 1]
+    print(name + ": L1 distance " + str(round(l1, 4)) + ", correlation " + str(round(correlation, 4)))
+    return l1, correlation
+
+
+def perform_walks_check(S, rng_seed):
+    # both walkers must produce the same expected number of visits per node
+    S_nodes = set(S.nodes())
+    walks_to_do = {node: 200 for node in S_nodes}
+    random.seed(rng_seed)
+    python_count = _perform_walks_python(S_nodes, S, walks_to_do, ALPHA)
+    numpy_count = _perform_walks(S_nodes, S, walks_to_do, ALPHA, rng_seed)
+    nodes = sorted(S_nodes)
+    python_visits = np.array([python_count[node] for node in nodes], dtype=float)
+    numpy_visits = np.array([numpy_count[node] for node in nodes], dtype=float)
+    # the total number of visits is a sum of independent geometric walk lengths, compare within 4 sigma
+    total = len(nodes) * 200
+    print("Walk visits: python " + str(int(python_visits.sum())) + ", numpy " + str(int(numpy_visits.sum())) +
+          " (" + str(total) + " walks)")
+    compare("Walk visit distribution (numpy vs python)", numpy_visits / numpy_visits.sum(),
+            python_visits / python_visits.sum())
+    return abs(python_visits.sum() - numpy_visits.sum()) < 4 * np.sqrt(2 * total * ALPHA) / (1 - ALPHA)
+
+
+if __name__ == '__main__':
+    G = random_follow_graph(NODES, AVG_FOLLOWS, DANGLING, SEED)
+    nodelist = list(G.nodes())
+    print("Graph: " + str(G.number_of_nodes()) + " nodes, " + str(G.number_of_edges()) + " edges")
+
+    exact = to_array(nx.pagerank(G, alpha=ALPHA), nodelist)
+
+    random.seed(SEED)
+    tic = time.perf_counter()
+    _, python_pagerank = get_mc_pagerank_python(G, R, nodelist, ALPHA)
+    toc = time.perf_counter()
+    print("Pure python walks: " + str(round(toc - tic, 2)) + "s")
+
+    tic = time.perf_counter()
+    walk_visited_count, numpy_pagerank = get_mc_pagerank(G, R, nodelist, ALPHA, seed=SEED)
+    toc = time.perf_counter()
+    print("NumPy CSR walks:   " + str(round(toc - tic, 2)) + "s")
+
+    tic = time.perf_counter()
+    get_mc_pagerank(G, R, nodelist, ALPHA, seed=SEED, batch_size=NODES * R // 4, processes=4)
+    toc = time.perf_counter()
+    print("NumPy CSR walks, 4 processes: " + str(round(toc - tic, 2)) + "s")
+
+    python_l1, _ = compare("Pure python vs exact", to_array(python_pagerank, nodelist), exact)
+    numpy_l1, _ = compare("NumPy CSR vs exact", to_array(numpy_pagerank, nodelist), exact)
+    compare("NumPy CSR vs pure python", to_array(numpy_pagerank, nodelist), to_array(python_pagerank, nodelist))
+
+    # same seed, same result
+    _, repeated = get_mc_pagerank(G, R, nodelist, ALPHA, seed=SEED)
+    print("Reproducible with seed: " + str(repeated == numpy_pagerank))
+
+    # subrank on the subgraph of the most followed users, compared with the exact pagerank of that subgraph
+    S = G.subgraph(sorted(G.nodes(), key=lambda node: G.in_degree(node), reverse=True)[:SUBGRAPH]).copy()
+    subrank = get_subrank(S, G, walk_visited_count, nodelist, ALPHA, seed=SEED)
+    S_nodes = list(S.nodes())
+    subrank_l1, _ = compare("Subrank vs exact pagerank of S", to_array(subrank, S_nodes),
+                            to_array(nx.pagerank(S, alpha=ALPHA), S_nodes))
+
+    walks_ok = perform_walks_check(S, SEED)
+
+    # the estimates of the vectorized walks have to be as close to the exact values as the pure python ones
+    equivalent = numpy_l1 < 1.5 * python_l1 + 0.01 and walks_ok
+    print("Statistically equivalent: " + str(equivalent))
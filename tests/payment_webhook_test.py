@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+import requests
+
+from lnbits_mock import run_mock_lnbits
+from nostr_dvm.utils.dvmconfig import DVMConfig
+from nostr_dvm.utils.nip89_utils import NIP89Config
+from nostr_dvm.utils.payment_utils import PaymentWatcher
+from nostr_dvm.utils.zap_utils import create_bolt11_ln_bits
+
+# Two DVMs in one process get paid through the LNbits webhook, against the local LNbits mock (tests/lnbits_mock.py).
+# Both DVMs listen on the same webhook port, each invoice has to resolve on the watcher of the DVM that created it.
+
+MOCK_PORT = 5001
+WEBHOOK_PORT = 8899
+DVMS = 2
+
+
+def build_config(name):
+    dvm_config = DVMConfig()
+    dvm_config.NIP89 = NIP89Config()
+    dvm_config.NIP89.NAME = name
+    dvm_config.LNBITS_URL = "http://127.0.0.1:" + str(MOCK_PORT)
+    dvm_config.LNBITS_INVOICE_KEY = "mock"
+    dvm_config.LNBITS_WEBHOOK_URL = "http://127.0.0.1:" + str(WEBHOOK_PORT) + "/lnbits"
+    dvm_config.LNBITS_WEBHOOK_HOST = "127.0.0.1"
+    dvm_config.LNBITS_WEBHOOK_PORT = WEBHOOK_PORT
+    # only the webhook may resolve the invoices
+    dvm_config.PAYMENT_CHECK_MIN_INTERVAL = 3600
+    dvm_config.PAYMENT_CHECK_MAX_INTERVAL = 3600
+    return dvm_config
+
+
+def run_dvm(dvm_config, results):
+    # every DVM runs its own event loop in its own thread, like in DVMFramework
+    async def main():
+        paid = asyncio.Event()
+
+        async def on_paid(payment_hash):
+            results[dvm_config.NIP89.NAME] = payment_hash
+            paid.set()
+
+        watcher = PaymentWatcher(dvm_config, on_paid)
+        await watcher.start()
+        invoice, payment_hash = create_bolt11_ln_bits(21, dvm_config)
+        watcher.watch(payment_hash)
+        results[dvm_config.NIP89.NAME + " invoice"] = payment_hash
+        try:
+            await asyncio.wait_for(paid.wait(), 10)
+        except asyncio.TimeoutError:
+            pass
+        await watcher.stop()
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    run_mock_lnbits(port=MOCK_PORT)
+    results = {}
+    configs = [build_config("DVM " + str(i)) for i in range(DVMS)]
+    threads = [threading.Thread(target=run_dvm, args=(config, results)) for config in configs]
+    for thread in threads:
+        thread.start()
+
+    while len([key for key in results if key.endswith(" invoice")]) < DVMS:
+        time.sleep(0.1)
+    unknown = requests.post("http://127.0.0.1:" + str(WEBHOOK_PORT) + "/lnbits/unknown", json={})
+    print("Unknown token: " + str(unknown.status_code))
+    for config in configs:
+        requests.post("http://127.0.0.1:" + str(MOCK_PORT) + "/mock/pay/" + results[config.NIP89.NAME + " invoice"])
+    for thread in threads:
+        thread.join()
+
+    for config in configs:
+        name = config.NIP89.NAME
+        print(name + ": " + ("paid" if results.get(name) == results[name + " invoice"] else "not paid"))
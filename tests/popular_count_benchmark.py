@@ -0,0 +1,90 @@
+import asyncio
+import os
+import random
+import shutil
+import time
+
+from nostr_sdk import Keys, EventBuilder, Filter, NostrDatabase, Tag, Timestamp
+
+from nostr_dvm.utils.definitions import EventDefinitions
+from nostr_dvm.utils.popularity_utils import count_interactions, top_events, INTERACTION_KINDS
+
+# Benchmark for one tick of the popular content discovery DVMs on a synthetic LMDB with 200k events:
+# one reaction query per note (how popular notes were counted before) versus a single query for all
+# interactions grouped by their e tags (popularity_utils).
+
+DB = "db/popular_count_benchmark"
+NOTES = 20000
+INTERACTIONS = 180000
+AUTHORS = 1000
+MAX_RESULTS = 200
+MIN_REACTIONS = 2
+
+
+async def build_database(since):
+    if os.path.exists(DB):
+        shutil.rmtree(DB)
+    database = NostrDatabase.lmdb(DB)
+    authors = [Keys.generate() for _ in range(AUTHORS)]
+
+    print("Creating " + str(NOTES) + " notes and " + str(INTERACTIONS) + " interactions..")
+    note_ids = []
+    for i in range(NOTES):
+        created_at = Timestamp.from_secs(since + random.randint(60, 3500))
+        note = EventBuilder.text_note("note " + str(i)).custom_created_at(created_at).sign_with_keys(
+            random.choice(authors))
+        await database.save_event(note)
+        note_ids.append(note.id())
+
+    kinds = [EventDefinitions.KIND_REACTION] * 6 + [EventDefinitions.KIND_REPOST] * 2 + [
+        EventDefinitions.KIND_NOTE, EventDefinitions.KIND_ZAP]
+    for i in range(INTERACTIONS):
+        # a few notes get most of the attention
+        target = note_ids[min(int(random.paretovariate(1.2)) - 1, NOTES - 1) if random.random() < 0.5
+                          else random.randrange(NOTES)]
+        created_at = Timestamp.from_secs(since + random.randint(60, 3500))
+        interaction = EventBuilder(random.choice(kinds), "+").tags([Tag.parse(["e", target.to_hex()])]) \
+            .custom_created_at(created_at).sign_with_keys(random.choice(authors))
+        await database.save_event(interaction)
+    return database
+
+
+async def count_per_note(database, since, notes):
+    # the previous implementation, one query per note
+    finallist = {}
+    for event in notes:
+        filt = Filter().kinds(INTERACTION_KINDS).event(event.id()).since(since)
+        reactions = await database.query(filt)
+        if len(reactions.to_vec()) >= MIN_REACTIONS:
+            finallist[event.id().to_hex()] = len(reactions.to_vec())
+    return sorted(finallist.items(), key=lambda x: x[1], reverse=True)[:MAX_RESULTS]
+
+
+async def count_single_query(database, since, notes):
+    event_ids = [event.id().to_hex() for event in notes]
+    counts = await count_interactions(database, since, event_ids=set(event_ids))
+    return top_events(counts, event_ids, MAX_RESULTS, MIN_REACTIONS)
+
+
+async def benchmark():
+    timestamp_since = Timestamp.now().as_secs() - 3600
+    database = await build_database(timestamp_since)
+    since = Timestamp.from_secs(timestamp_since)
+    notes = (await database.query(Filter().kind(EventDefinitions.KIND_NOTE).since(since))).to_vec()
+
+    tic = time.perf_counter()
+    before = await count_per_note(database, since, notes)
+    toc = time.perf_counter()
+    print("Query per note: " + str(round(toc - tic, 2)) + "s")
+
+    tic = time.perf_counter()
+    after = await count_single_query(database, since, notes)
+    toc = time.perf_counter()
+    print("Single query:   " + str(round(toc - tic, 2)) + "s")
+
+    # ties may be ordered differently, the counts have to match
+    print("Same result: " + str([count for _, count in before] == [count for _, count in after]))
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark())
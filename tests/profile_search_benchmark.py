@@ -0,0 +1,72 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import time
+
+from nostr_sdk import Keys, EventBuilder, Filter, Kind, NostrDatabase, Timestamp
+
+from nostr_dvm.utils.profile_index_utils import ProfileIndex
+
+# Benchmark for profile search on a synthetic profile database: querying all kind 0 events and searching their
+# raw json for the term (how search_users searched before) versus the sqlite FTS5 ProfileIndex.
+
+DB = "db/profile_search_benchmark.db"
+PROFILES = 100000
+QUERIES = ["alice", "bitcoin", "pleb", "nostr developer", "zzzz"]
+WORDS = ["bitcoin", "nostr", "developer", "artist", "pleb", "photographer", "music", "freedom", "coffee", "runner",
+         "writer", "hodl", "zap", "builder", "lightning", "garden", "cats", "travel", "design", "privacy"]
+NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi", "ivan", "judy", "mallory", "oscar"]
+
+
+async def build_database():
+    if os.path.exists(DB):
+        shutil.rmtree(DB)
+    database = NostrDatabase.lmdb(DB)
+    print("Creating " + str(PROFILES) + " profiles..")
+    for i in range(PROFILES):
+        name = random.choice(NAMES) + str(random.randint(0, 99999))
+        profile = {"name": name, "display_name": name.capitalize(),
+                   "about": " ".join(random.choices(WORDS, k=random.randint(3, 12))),
+                   "nip05": name + "@example.com"}
+        event = EventBuilder(Kind(0), json.dumps(profile)).custom_created_at(
+            Timestamp.from_secs(1700000000 + i)).sign_with_keys(Keys.generate())
+        await database.save_event(event)
+    return database
+
+
+async def scan(database, query, max_results):
+    # the previous implementation
+    events = await database.query(Filter().kind(Kind(0)))
+    result = []
+    for event in events.to_vec():
+        if len(result) >= max_results:
+            break
+        if query.lower() in event.content().lower():
+            result.append(event.author().to_hex())
+    return result
+
+
+async def benchmark():
+    database = await build_database()
+    index = ProfileIndex(DB + "_search.sqlite")
+
+    tic = time.perf_counter()
+    await index.refresh(database)
+    print("Building the index: " + str(round(time.perf_counter() - tic, 2)) + "s")
+
+    for query in QUERIES:
+        tic = time.perf_counter()
+        before = await scan(database, query, 100)
+        toc = time.perf_counter()
+        after = index.search(query, 100)
+        tac = time.perf_counter()
+        print(query + ": scan " + str(round((toc - tic) * 1000, 1)) + "ms (" + str(len(before)) + "), index " +
+              str(round((tac - toc) * 1000, 1)) + "ms (" + str(len(after)) + ")")
+
+    os.remove(DB + "_search.sqlite")
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark())
@@ -0,0 +1,50 @@
+import os
+import random
+import sqlite3
+import time
+
+from nostr_dvm.utils.database_utils import create_sql_table, add_to_sql_table, get_from_sql_table, UserStore
+
+# Microbenchmark for user lookups: a fresh sqlite connection per lookup (how users were read before)
+# versus the pooled UserStore with its LRU cache.
+
+DB = "db/user_store_benchmark.db"
+USERS = 10000
+LOOKUPS = 50000
+HOT_USERS = 500
+
+
+def lookup_reconnecting(db, npub):
+    con = sqlite3.connect(db)
+    cur = con.cursor()
+    cur.execute("SELECT * FROM users WHERE npub=?", (npub,))
+    row = cur.fetchone()
+    con.close()
+    return row
+
+
+def benchmark(name, function, npubs):
+    tic = time.perf_counter()
+    for npub in npubs:
+        function(npub)
+    toc = time.perf_counter()
+    print(name + ": " + str(round(len(npubs) / (toc - tic))) + " lookups/s")
+
+
+if __name__ == '__main__':
+    if os.path.exists(DB):
+        os.remove(DB)
+    create_sql_table(DB)
+    npubs = [os.urandom(32).hex() for _ in range(USERS)]
+    for npub in npubs:
+        add_to_sql_table(DB, npub, 100, False, False, "", "", "bench", 0, 0)
+
+    # most requests come from a small set of active users
+    hot = npubs[:HOT_USERS]
+    workload = [random.choice(hot) if random.random() < 0.9 else random.choice(npubs) for _ in range(LOOKUPS)]
+
+    benchmark("sqlite3.connect per lookup", lambda npub: lookup_reconnecting(DB, npub), workload)
+    UserStore.get(DB).cache_size = 0
+    benchmark("UserStore, no cache", lambda npub: get_from_sql_table(DB, npub), workload)
+    UserStore.get(DB).cache_size = 1000
+    benchmark("UserStore, LRU cache", lambda npub: get_from_sql_table(DB, npub), workload)
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+
+import networkx as nx
+import numpy as np
+
+from nostr_dvm.utils.wot_utils import WotGraph, save_network, load_network, convert_index_to_hex
+
+# Benchmark for storing a web of trust graph: networkx + json node-link files (how networks were saved before)
+# versus the WotGraph arrays, loaded memory-mapped. Also compares mapping node indices back to pubkeys by
+# scanning the index_map per node with the WotGraph lookup.
+
+NODES = 500000
+AVG_FOLLOWS = 30
+LOOKUPS = 200
+NAME = "benchmark"
+
+
+def random_wot_graph(nodes, avg_follows):
+    rng = np.random.default_rng(42)
+    pubkeys = rng.integers(0, 256, size=(nodes, 32), dtype=np.uint8)
+    edges = nodes * avg_follows
+    sources = rng.integers(0, nodes, size=edges)
+    # most follows go to a few popular accounts
+    targets = np.minimum(rng.pareto(1.2, size=edges) * 10, nodes - 1).astype(np.int64)
+    timestamps = rng.integers(1600000000, 1700000000, size=nodes)
+    return WotGraph.from_edges(pubkeys, sources, targets, timestamps)
+
+
+def timed(name, function):
+    tic = time.perf_counter()
+    result = function()
+    toc = time.perf_counter()
+    print(name + ": " + str(round(toc - tic, 3)) + "s")
+    return result
+
+
+if __name__ == '__main__':
+    wot = random_wot_graph(NODES, AVG_FOLLOWS)
+    print("Graph: " + str(len(wot)) + " nodes, " + str(wot.number_of_edges()) + " edges")
+    index_map, network_graph = wot.to_network()
+
+    def save_json():
+        with open('index_map_' + NAME + '.json', 'w') as f:
+            json.dump(index_map, f)
+        with open('network_graph_' + NAME + '.json', 'w') as f:
+            json.dump(nx.node_link_data(network_graph), f)
+
+    timed("Save json", save_json)
+    timed("Load json", lambda: load_network(NAME))
+    timed("Save WotGraph", lambda: save_network(index_map, network_graph, NAME))
+    loaded = timed("Load WotGraph (mmap)", lambda: WotGraph.load(NAME))
+    print("Same graph: " + str(np.array_equal(loaded.indices, wot.indices) and
+                               np.array_equal(loaded.pubkeys, wot.pubkeys)))
+
+    # pagerank like result for the last LOOKUPS nodes
+    ranks = {node: 1 / (node + 1) for node in range(NODES - LOOKUPS, NODES)}
+    scan = timed("Index -> pubkey, scanning index_map", lambda: {
+        next((pubkey for pubkey, id in index_map.items() if id == item), None): ranks[item] for item in ranks})
+    timed("Index -> pubkey, convert_index_to_hex(index_map)",
+          lambda: asyncio.run(convert_index_to_hex(ranks, index_map, LOOKUPS)))
+    lookup = timed("Index -> pubkey, convert_index_to_hex(WotGraph)",
+                   lambda: asyncio.run(convert_index_to_hex(ranks, loaded, LOOKUPS)))
+    print("Same result: " + str(scan == lookup))
+    timed("Pubkey -> index, first lookup (builds table)", lambda: loaded.index(wot.hex(NODES - 1)))
+    timed("Pubkey -> index, " + str(LOOKUPS) + " lookups",
+          lambda: [loaded.index(wot.hex(node)) for node in range(LOOKUPS)])
+
+    for file in ['index_map_' + NAME + '.json', 'network_graph_' + NAME + '.json']:
+        os.remove(file)
+    shutil.rmtree('wot_graph_' + NAME)
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import time
+
+from nostr_sdk import Keys, EventBuilder, Filter, NostrDatabase, Tag, Timestamp
+
+from nostr_dvm.utils.definitions import EventDefinitions
+from nostr_dvm.utils.zap_ledger_utils import ZapLedger
+from nostr_dvm.utils.zap_utils import parse_amount_from_bolt11_invoice
+
+# Benchmark for one tick of the top zaps discovery DVM on a synthetic LMDB: one zap query per note with the
+# bolt11 invoices parsed on every tick (how top zaps were computed before) versus the ZapLedger, where receipts
+# are parsed once and the top notes are a single aggregate query.
+
+DB = "db/zap_ledger_benchmark"
+NOTES = 5000
+ZAPS = 50000
+AUTHORS = 500
+MAX_RESULTS = 200
+
+
+async def build_database(since):
+    if os.path.exists(DB):
+        shutil.rmtree(DB)
+    database = NostrDatabase.lmdb(DB)
+    authors = [Keys.generate() for _ in range(AUTHORS)]
+    senders = [Keys.generate().public_key().to_hex() for _ in range(AUTHORS)]
+    provider = Keys.generate()
+
+    print("Creating " + str(NOTES) + " notes and " + str(ZAPS) + " zap receipts..")
+    notes = []
+    for i in range(NOTES):
+        created_at = Timestamp.from_secs(since + random.randint(60, 3500))
+        note = EventBuilder.text_note("note " + str(i)).custom_created_at(created_at).sign_with_keys(
+            random.choice(authors))
+        await database.save_event(note)
+        notes.append(note)
+
+    for i in range(ZAPS):
+        # a few notes get most of the zaps
+        target = notes[min(int(random.paretovariate(1.2)) - 1, NOTES - 1) if random.random() < 0.5
+                       else random.randrange(NOTES)]
+        sender = random.choice(senders)
+        tags = [Tag.parse(["p", target.author().to_hex()]), Tag.parse(["e", target.id().to_hex()]),
+                Tag.parse(["bolt11", "lnbc" + str(random.randint(1, 5000) * 10) + "n1p" + "q" * 300]),
+                Tag.parse(["description", json.dumps({"pubkey": sender, "kind": 9734, "content": ""})]),
+                Tag.parse(["preimage", "00" * 32])]
+        created_at = Timestamp.from_secs(since + random.randint(60, 3500))
+        zap = EventBuilder(EventDefinitions.KIND_ZAP, "").tags(tags).custom_created_at(created_at) \
+            .sign_with_keys(provider)
+        await database.save_event(zap)
+    return database
+
+
+async def zaps_per_note(database, since, notes):
+    # the previous implementation, one query per note and every invoice parsed again
+    finallist = {}
+    for event in notes:
+        filt = Filter().kinds([EventDefinitions.KIND_ZAP]).event(event.id()).since(since)
+        zaps = await database.query(filt)
+        overall_amount = 0
+        for zap in zaps.to_vec():
+            for tag in zap.tags().to_vec():
+                if tag.as_vec()[0] == 'bolt11':
+                    overall_amount += parse_amount_from_bolt11_invoice(tag.as_vec()[1])
+        if len(zaps.to_vec()) > 0:
+            finallist[event.id().to_hex()] = overall_amount
+    return sorted(finallist.items(), key=lambda x: x[1], reverse=True)[:MAX_RESULTS]
+
+
+async def benchmark():
+    timestamp_since = Timestamp.now().as_secs() - 3600
+    database = await build_database(timestamp_since)
+    since = Timestamp.from_secs(timestamp_since)
+    notes = (await database.query(Filter().kind(EventDefinitions.KIND_NOTE).since(since))).to_vec()
+
+    tic = time.perf_counter()
+    before = await zaps_per_note(database, since, notes)
+    toc = time.perf_counter()
+    print("Query per note: " + str(round(toc - tic, 2)) + "s")
+
+    ledger = ZapLedger.get(DB)
+    tic = time.perf_counter()
+    await ledger.refresh(database, timestamp_since)
+    toc = time.perf_counter()
+    print("Building the ledger (once): " + str(round(toc - tic, 2)) + "s")
+
+    event_ids = {event.id().to_hex() for event in notes}
+    tic = time.perf_counter()
+    await ledger.refresh(database, timestamp_since)
+    after = ledger.top_events(timestamp_since, MAX_RESULTS, event_ids=event_ids)
+    toc = time.perf_counter()
+    print("Ledger, per tick: " + str(round(toc - tic, 3)) + "s")
+
+    # ties may be ordered differently, the amounts have to match
+    print("Same result: " + str([amount for _, amount in before] == [amount for _, amount in after]))
+    os.remove(ledger.path)
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark())